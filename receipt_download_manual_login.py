@@ -1,80 +1,1869 @@
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from webdriver_manager.chrome import ChromeDriverManager
 import time
 import os
+import sys
 import logging
+import logging.handlers
 import base64
 from datetime import datetime
 import argparse
 import json
 import re
+import hashlib
+import csv
+import io
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import zipfile
+import sqlite3
+import atexit
+import threading
+import queue
+import contextvars
+import uuid
+import signal
+import mmap
+import multiprocessing
+import importlib.util
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait as wait_futures
+from html import escape
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit
+from dataclasses import dataclass, field, fields
+
+# Selenium と webdriver_manager はブラウザを使う処理でだけ読み込む（load_browser_modules）
+webdriver = Service = Options = By = WebDriverWait = EC = ChromeDriverManager = None
+
+def load_browser_modules():
+    """ブラウザの操作に必要なモジュールを読み込む（検索や集計などのコマンドを速く起動するため遅延させる）"""
+    global webdriver, Service, Options, By, WebDriverWait, EC, ChromeDriverManager
+    if webdriver is not None:
+        return
+    from selenium import webdriver as selenium_webdriver
+    from selenium.webdriver.chrome.service import Service as ChromeService
+    from selenium.webdriver.chrome.options import Options as ChromeOptions
+    from selenium.webdriver.common.by import By as SeleniumBy
+    from selenium.webdriver.support.ui import WebDriverWait as SeleniumWait
+    from selenium.webdriver.support import expected_conditions
+    from webdriver_manager.chrome import ChromeDriverManager as DriverManager
+    webdriver, Service, Options, By = selenium_webdriver, ChromeService, ChromeOptions, SeleniumBy
+    WebDriverWait, EC, ChromeDriverManager = SeleniumWait, expected_conditions, DriverManager
 
-# ロギングの設定
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("receipt_download_manual.log"),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
+# ログの各行に付ける処理の文脈（実行ID、ワーカー、領収書、処理段階）
+LOG_CONTEXT_FIELDS = ("run_id", "worker_id", "receipt_id", "phase")
+log_context_var = contextvars.ContextVar("log_context", default={})
+# ファイルへの書き込みを行うスレッド（setup_logging で開始）
+log_listener = None
+
+@contextmanager
+def log_context(**values):
+    """ブロック内で出力するログに文脈（receipt_id、phase など）を付ける"""
+    token = log_context_var.set({**log_context_var.get(), **values})
+    try:
+        yield
+    finally:
+        log_context_var.reset(token)
+
+class LogContextFilter(logging.Filter):
+    """ログを出したスレッドの文脈をレコードに付ける（キューに入れる前、出力元のスレッドで実行される）"""
+
+    def filter(self, record):
+        context = log_context_var.get()
+        for name in LOG_CONTEXT_FIELDS:
+            setattr(record, name, context.get(name))
+        if record.worker_id is None:
+            record.worker_id = record.threadName
+        return True
+
+class JsonLogFormatter(logging.Formatter):
+    """1行に1レコードのJSONで出力する（文脈のない項目は省く）"""
+
+    def format(self, record):
+        entry = {"time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+                 "level": record.levelname, "message": record.getMessage()}
+        for name in LOG_CONTEXT_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """キューに入れるハンドラ（例外のスタックトレースを本文に混ぜず、exc_text として書き込み側に渡す）"""
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # トレースバックはフレームを保持するため、出力元のスレッドで文字列にしておく
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+# クラウドワークスのURL
+BASE_URL = "https://crowdworks.jp"
+
+def payments_page_url(page_num=1):
+    """支払一覧ページのURLを返す"""
+    if page_num == 1:
+        return f"{BASE_URL}/payments?ref=login_header"
+    return f"{BASE_URL}/payments?page={page_num}&ref=login_header"
+
 # グローバル変数としてdownload_dirを定義
 download_dir = None
 
+# 領収書とファイルの対応を記録するマニフェスト
+MANIFEST_FILE_NAME = "manifest.jsonl"
+manifest = None
+
+# 領収書の出力先（ディレクトリまたはアーカイブ）
+output_backend = None
+
+# 領収書の保存後に呼び出す出力処理（月別PDF、メタデータ出力など）
+receipt_sinks = []
+
+# 領収書ごとのファイルを出力するか（月別PDFのみを出力する場合はFalse）
+write_individual_files = True
+
+# アーカイブ内の索引に書き出す項目
+ARCHIVE_INDEX_FIELDS = ["file", "receipt_number", "date", "amount", "source_url", "sha256", "size"]
+
 # ダウンロードディレクトリの設定を修正
-def create_download_dir():
-    """タイムスタンプ付きのダウンロードディレクトリを作成する"""
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    download_dir = os.path.join(os.getcwd(), f'receipts_{timestamp}')
+def create_download_dir(base_dir=None):
+    """ダウンロードディレクトリを作成する（指定がない場合はタイムスタンプ付き）"""
+    if base_dir:
+        download_dir = os.path.abspath(base_dir)
+    else:
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        download_dir = os.path.join(os.getcwd(), f'receipts_{timestamp}')
     os.makedirs(download_dir, exist_ok=True)
     logger.info(f"ダウンロードディレクトリを作成しました: {download_dir}")
     return download_dir
 
+def receipt_key_from_url(url):
+    """URLから領収書を識別するIDを取り出す"""
+    if not url:
+        return None
+    patterns = [
+        r'receipt_sheets/(\d+)',
+        r'payment_id=(\d+)',
+        r'payments/(\d+)',
+        r'receipts?/(\d+)',
+        r'invoices?/(\d+)'
+    ]
+    for pattern in patterns:
+        match = re.search(pattern, url)
+        if match:
+            return match.group(1)
+    return None
+
+# Chromeが出力するPDFには作成日時が埋め込まれるため、同じ領収書でも毎回バイト列が変わる
+PDF_DATE_PATTERN = re.compile(rb'/(CreationDate|ModDate)\s{0,16}\(D:[^)]{0,64}\)')
+# ファイルを分割して読む場合に、日時の記述が分割位置をまたがないよう持ち越すバイト数（記述の最大長より長くする）
+PDF_DATE_OVERLAP = 128
+
+def content_fingerprint(data):
+    """ファイル内容のハッシュを計算する（PDFの作成日時は除外する）"""
+    return hashlib.sha256(PDF_DATE_PATTERN.sub(b'', data)).hexdigest()
+
+def chunked_fingerprint(chunks):
+    """分割したバイト列から content_fingerprint と同じハッシュを計算する（全体をメモリに置かない）"""
+    digest = hashlib.sha256()
+    pending = b""
+    for chunk in chunks:
+        buffer = pending + chunk
+        cut = max(len(buffer) - PDF_DATE_OVERLAP, 0)
+        # 分割位置をまたぐ記述は、記述の終わりまでを今回の範囲に含める
+        for match in PDF_DATE_PATTERN.finditer(buffer):
+            if match.start() < cut < match.end():
+                cut = match.end()
+        digest.update(PDF_DATE_PATTERN.sub(b'', buffer[:cut]))
+        pending = buffer[cut:]
+    digest.update(PDF_DATE_PATTERN.sub(b'', pending))
+    return digest.hexdigest()
+
+def file_fingerprint(path, chunk_size=1024 * 1024):
+    """ファイルを分割して読み、content_fingerprint と同じハッシュを計算する"""
+    with open(path, "rb") as f:
+        return chunked_fingerprint(iter(lambda: f.read(chunk_size), b""))
+
 # PDFファイル名の生成関数を修正
-def generate_pdf_filename(index, receipt_number=None):
-    """PDFファイル名を生成する（通し番号と領収書/請求書番号を組み合わせる）"""
-    # 日付を取得
-    date_str = datetime.now().strftime("%Y%m%d")
+def generate_pdf_filename(receipt_key, content_hash, extension="pdf"):
+    """PDFファイル名を生成する（領収書番号またはURLのIDと内容ハッシュを組み合わせる）"""
+    # 内容ハッシュの先頭部分（必ず含める）
+    hash_str = content_hash[:10]
     
-    # 通し番号部分（必ず含める）
-    index_str = f"{index:03d}"
-    
-    # 領収書/請求書番号がある場合はそれを組み合わせる
-    if receipt_number:
+    # 領収書/請求書番号またはURLのIDがある場合はそれを組み合わせる
+    if receipt_key:
+        receipt_key = re.sub(r'[\\/:*?"<>|\s]', '', str(receipt_key))
         # 番号が長すぎる場合は短くする
-        if len(receipt_number) > 20:
-            receipt_number = receipt_number[:20]
-        return f"領収書_{index_str}_{receipt_number}.pdf"
+        if len(receipt_key) > 20:
+            receipt_key = receipt_key[:20]
+    if receipt_key:
+        return f"領収書_{receipt_key}_{hash_str}.{extension}"
     else:
-        # 番号がない場合は通し番号のみ
-        return f"領収書_{index_str}.pdf"
+        # 番号がない場合はハッシュのみ
+        return f"領収書_{hash_str}.{extension}"
+
+class ReceiptManifest:
+    """領収書とファイルの対応を記録するマニフェスト（追記型のJSON Lines）"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.by_hash = {}
+        self.by_url = {}
+        self._load()
+
+    def _load(self):
+        """既存のマニフェストを読み込む（同じキーは後の行が優先）"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    self._index(json.loads(line))
+                except ValueError:
+                    logger.warning(f"マニフェストの不正な行を無視しました: {line[:80]}")
+        logger.info(f"マニフェストから {len(self.entries)} 件の記録を読み込みました: {self.path}")
+
+    def _index(self, entry):
+        self.entries[entry['receipt_key']] = entry
+        self.by_hash[entry['sha256']] = entry
+        if entry.get('source_url'):
+            self.by_url[entry['source_url']] = entry
+
+    def find_by_hash(self, content_hash):
+        return self.by_hash.get(content_hash)
+
+    def find_by_url(self, url):
+        return self.by_url.get(url)
+
+    def record(self, entry):
+        """エントリを追記する"""
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._index(entry)
+
+def load_manifest(directory):
+    """ダウンロードディレクトリのマニフェストを読み込む"""
+    return ReceiptManifest(os.path.join(directory, MANIFEST_FILE_NAME))
+
+class DirectoryOutput:
+    """領収書をディレクトリにファイルとして出力する"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def local_path(self, name):
+        return os.path.join(self.directory, name)
 
-# ダウンロードの完了を待機する関数
-def wait_for_download_complete(directory, timeout=30):
-    """ダウンロードの完了を待機する関数"""
-    start_time = time.time()
-    initial_files = set(os.listdir(directory))
+    def exists(self, name):
+        return os.path.exists(self.local_path(name))
+
+    def write(self, name, data, entry=None):
+        """一時ファイルに書き込んでから置き換える（途中で中断しても壊れたファイルを残さない）"""
+        path = self.local_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + ".part"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def write_file(self, name, source_path, entry=None):
+        """一時ファイルを出力先に移動する"""
+        path = self.local_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(source_path, path)
+
+    def close(self):
+        pass
+
+class ArchiveOutput:
+    """領収書をZIP/tarアーカイブに逐次書き込む（ディスクに展開せず、メモリには1件分のみ保持）"""
+
+    def __init__(self, path, archive_format="zip"):
+        self.path = path
+        self.archive_format = archive_format
+        self.names = set()
+        if archive_format == "zip":
+            self.archive = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED)
+        else:
+            self.archive = tarfile.open(path, "w:gz")
+        # 索引は一時ファイルに追記し、クローズ時にアーカイブへ流し込む
+        self.index_csv = tempfile.TemporaryFile("w+", encoding="utf-8", newline="")
+        self.index_jsonl = tempfile.TemporaryFile("w+", encoding="utf-8")
+        self.index_writer = csv.DictWriter(self.index_csv, fieldnames=ARCHIVE_INDEX_FIELDS, extrasaction="ignore")
+        self.index_writer.writeheader()
+        logger.info(f"アーカイブへの出力を開始します: {path}")
+
+    def local_path(self, name):
+        return None
+
+    def exists(self, name):
+        return name in self.names
+
+    def write(self, name, data, entry=None):
+        if self.archive_format == "zip":
+            info = zipfile.ZipInfo(name, date_time=datetime.now().timetuple()[:6])
+            # PDF/PNGは既に圧縮されているため無圧縮で格納する
+            if name.endswith((".pdf", ".png")):
+                info.compress_type = zipfile.ZIP_STORED
+            else:
+                info.compress_type = zipfile.ZIP_DEFLATED
+            self.archive.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            self.archive.addfile(info, io.BytesIO(data))
+        self._add_index(name, entry)
+
+    def write_file(self, name, source_path, entry=None):
+        """ディスク上のファイルをメモリに読み込まずにアーカイブへ流し込む"""
+        if self.archive_format == "zip":
+            self.archive.write(source_path, arcname=name, compress_type=zipfile.ZIP_STORED)
+        else:
+            self.archive.add(source_path, arcname=name)
+        self._add_index(name, entry)
+
+    def _add_index(self, name, entry):
+        self.names.add(name)
+        if entry:
+            self.index_writer.writerow(entry)
+            self.index_jsonl.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def _add_stream(self, name, stream):
+        """一時ファイルの内容をアーカイブに流し込む"""
+        stream.flush()
+        stream.seek(0)
+        raw = stream.buffer if hasattr(stream, "buffer") else stream
+        if self.archive_format == "zip":
+            with self.archive.open(name, "w") as dest:
+                shutil.copyfileobj(raw, dest)
+        else:
+            raw.seek(0, os.SEEK_END)
+            info = tarfile.TarInfo(name)
+            info.size = raw.tell()
+            info.mtime = time.time()
+            raw.seek(0)
+            self.archive.addfile(info, raw)
+
+    def close(self):
+        """索引を書き込んでアーカイブを閉じる"""
+        self._add_stream("manifest.csv", self.index_csv)
+        self._add_stream("manifest.jsonl", self.index_jsonl)
+        self.index_csv.close()
+        self.index_jsonl.close()
+        self.archive.close()
+        logger.info(f"アーカイブを作成しました: {self.path}（{len(self.names)} 件）")
+
+def create_output_backend(output_format, directory, archive_path=None):
+    """出力形式に応じた出力先を作成する"""
+    if output_format in ("zip", "tar"):
+        if not archive_path:
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+            extension = "zip" if output_format == "zip" else "tar.gz"
+            archive_path = os.path.join(directory, f"receipts_{timestamp}.{extension}")
+        return ArchiveOutput(archive_path, output_format)
+    return DirectoryOutput(directory)
+
+def get_output_backend():
+    """現在の出力先を返す（未設定の場合はダウンロードディレクトリ）"""
+    global output_backend
+    if output_backend is None:
+        output_backend = DirectoryOutput(download_dir)
+    return output_backend
+
+def output_exists(entry):
+    """マニフェストのエントリに対応する出力が存在するかを判定する"""
+    if get_output_backend().exists(entry['file']):
+        return True
+    merged_file = entry.get('merged_file')
+    return bool(merged_file) and os.path.exists(os.path.join(download_dir, merged_file))
+
+def is_already_downloaded(source_url):
+    """一覧ページのURLから、保存済みの領収書かどうかを判定する（検証で再取得が必要とされたものは未保存扱い）"""
+    if manifest is None or not source_url or source_url in requeued_urls:
+        return False
+    entry = manifest.find_by_url(source_url)
+    return bool(entry) and output_exists(entry)
+
+# マニフェストと出力先への書き込みをスレッド間で直列化する
+store_lock = threading.RLock()
+
+def store_receipt_output(data, receipt_number=None, source_url=None, extension="pdf", record=None, capture=None):
+    """領収書データを安定したファイル名で保存する（同一内容は再書き込みしない）"""
+    return _store_receipt(
+        content_fingerprint(data), len(data), lambda: data,
+        lambda backend, file_name, entry: backend.write(file_name, data, entry),
+        receipt_number, source_url, extension, record, capture
+    )
+
+def store_receipt_file(path, content_hash, receipt_number=None, source_url=None, extension="pdf", record=None):
+    """ディスク上のファイルを領収書として保存する（ディレクトリ出力では移動のみでコピーしない）"""
+    def read_data():
+        with open(path, "rb") as f:
+            return f.read()
     
-    while time.time() - start_time < timeout:
-        current_files = set(os.listdir(directory))
-        new_files = current_files - initial_files
+    try:
+        return _store_receipt(
+            content_hash, os.path.getsize(path), read_data,
+            lambda backend, file_name, entry: backend.write_file(file_name, path, entry),
+            receipt_number, source_url, extension, record
+        )
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+def _store_receipt(content_hash, size, read_data, write, receipt_number, source_url, extension, record, capture=None):
+    backend = get_output_backend()
+    with store_lock:
+        # 同一内容が既に保存されていれば書き込まない
+        existing = manifest.find_by_hash(content_hash) if manifest else None
+        if existing and output_exists(existing) and source_url in requeued_urls:
+            return _restore_requeued(existing, size, write, source_url, record, capture)
+        if existing and output_exists(existing):
+            logger.info(f"同一内容の領収書が既に保存されています: {existing['file']}")
+            if source_url and not manifest.find_by_url(source_url):
+                manifest.record(dict(existing, source_url=source_url))
+            return existing['file']
         
-        # 新しいファイルが見つかった場合
-        if new_files:
-            # .crdownload や .tmp ファイルがなければダウンロード完了
-            if not any(f.endswith('.crdownload') or f.endswith('.tmp') for f in new_files):
-                return list(new_files)
+        receipt_key = receipt_number or receipt_key_from_url(source_url)
+        file_name = generate_pdf_filename(receipt_key, content_hash, extension)
+        entry = {
+            "receipt_key": receipt_key or content_hash[:10],
+            "receipt_number": receipt_number,
+            "file": file_name,
+            "date": record.payment_date or record.issue_date if record else None,
+            "amount": record.amount if record else None,
+            "sha256": content_hash,
+            "size": size,
+            "source_url": source_url,
+            "saved_at": datetime.now().isoformat(timespec='seconds')
+        }
+        # スクリーンショットで代替した場合は、検証で本文の有無を確認しないよう記録しておく
+        if capture:
+            entry["capture"] = capture
         
-        time.sleep(1)
+        # 内容を使う出力（月別PDF）がある場合だけ、ファイルを移動する前に読んでおく
+        # （メタデータや索引などは内容を使わないため、ストリーミング保存したファイルを読み込まない）
+        data = read_data() if any(getattr(sink, "needs_data", False) for sink in receipt_sinks) else b""
+        if write_individual_files and not backend.exists(file_name):
+            write(backend, file_name, entry)
+            if progress_tracker is not None:
+                progress_tracker.add_saved(size)
+        
+        # 新しく保存した領収書を月別PDFやメタデータ出力などに渡す
+        if record:
+            record.file = file_name
+        for sink in receipt_sinks:
+            try:
+                sink.on_receipt_saved(entry, data, record)
+            except Exception as e:
+                logger.error(f"{type(sink).__name__} の処理に失敗: {str(e)}")
+        
+        if manifest:
+            manifest.record(entry)
+        requeued_urls.discard(source_url)
+        return entry['file']
+
+def _restore_requeued(existing, size, write, source_url, record, capture):
+    """検証に失敗して取得し直した領収書が保存済みと同じ内容だった場合に、ファイルを書き直して検証をやり直す
+
+    月別PDFやメタデータには記録済みのため、検証だけを再実行する。保存日時を更新するため、
+    検証に通れば次回は再取得の対象から外れる。
+    """
+    backend = get_output_backend()
+    entry = dict(existing, source_url=source_url, size=size, saved_at=datetime.now().isoformat(timespec='seconds'))
+    if capture:
+        entry["capture"] = capture
+    else:
+        entry.pop("capture", None)
+    # 壊れたファイルが残っている可能性があるため、個別のファイルは取得した内容で置き換える
+    if write_individual_files and isinstance(backend, DirectoryOutput) and entry["file"] != entry.get("merged_file"):
+        write(backend, entry["file"], entry)
+    logger.info(f"取得し直した領収書を保存し直しました（内容は保存済みのものと同一）: {entry['file']}")
+    if record:
+        record.file = entry["file"]
+    for sink in receipt_sinks:
+        if isinstance(sink, ReceiptVerifier):
+            sink.on_receipt_saved(entry, b"", record)
+    manifest.record(entry)
+    requeued_urls.discard(source_url)
+    return entry["file"]
+
+# 検証に失敗して再取得が必要な領収書（requeue.jsonl に記録し、次回の実行で取得し直す）
+REQUEUE_FILE_NAME = "requeue.jsonl"
+requeued_urls = set()
+
+# 領収書PDFとして妥当な大きさとページ数の目安（Chromeで印刷した1〜2ページの領収書は数十KB）
+MIN_RECEIPT_PDF_BYTES = 2 * 1024
+MIN_BYTES_PER_PAGE = 1024
+MAX_RECEIPT_PAGES = 5
+PDF_PAGE_PATTERN = re.compile(rb'/Type\s*/Page(?![A-Za-z])')
+
+def verify_receipt_file(path, receipt_number=None, expected_sha256=None, expect_text=True, merged=False):
+    """保存した領収書ファイルを検査し、結果（問題の一覧を含む）を返す（プロセスプールで実行する）
+
+    merged は複数の領収書をまとめた月別PDFで、ページ数とページあたりのサイズは確認しない。
+    """
+    result = {"path": path, "size": None, "pages": None, "problems": []}
+    problems = result["problems"]
+    if not os.path.exists(path):
+        problems.append("ファイルがありません")
+        return result
+    size = result["size"] = os.path.getsize(path)
+    if not path.lower().endswith(".pdf"):
+        problems.append("PDFではありません（スクリーンショットなどで代替）")
+        return result
+    if size < MIN_RECEIPT_PDF_BYTES:
+        problems.append(f"サイズが小さすぎます（{size} バイト）")
+        if size == 0:
+            return result
     
-    return []
+    # 大きなファイルも読み込まずに済むよう、メモリマップで検査する
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if data.find(b"%PDF-", 0, 1024) < 0:
+            problems.append("PDFのヘッダーがありません")
+            return result
+        if data.rfind(b"%%EOF", max(size - 2048, 0)) < 0:
+            problems.append("PDFの終端（%%EOF）がありません（書き込み途中の可能性）")
+        chunks = (data[start:start + 1024 * 1024] for start in range(0, size, 1024 * 1024))
+        if expected_sha256 and chunked_fingerprint(chunks) != expected_sha256:
+            problems.append("内容がマニフェストの記録と一致しません")
+        # オブジェクトストリーム内のページは数えられないため、pypdfがない場合の目安
+        result["pages"] = len(PDF_PAGE_PATTERN.findall(data)) or None
+        try:
+            from pypdf import PdfReader
+        except ImportError:
+            return result
+        try:
+            reader = PdfReader(data)
+            result["pages"] = len(reader.pages)
+            text = "".join(page.extract_text() or "" for page in reader.pages)
+        except Exception as e:
+            problems.append(f"PDFを読み込めません: {str(e)}")
+            return result
+    
+    if not result["pages"]:
+        problems.append("ページがありません")
+        return result
+    if not merged and result["pages"] > MAX_RECEIPT_PAGES:
+        problems.append(f"ページ数が多すぎます（{result['pages']} ページ、別のページを保存した可能性）")
+    if not merged and size / result["pages"] < MIN_BYTES_PER_PAGE:
+        problems.append("ページあたりのサイズが小さすぎます（空白のページの可能性）")
+    compact_text = re.sub(r"\s+", "", text)
+    if not expect_text:
+        # スクリーンショットから作成したPDFには本文がない
+        return result
+    if not compact_text:
+        problems.append("本文がありません（空白のページの可能性）")
+    elif receipt_number and re.sub(r"\s+", "", str(receipt_number)) not in compact_text:
+        problems.append(f"領収書番号 {receipt_number} が本文にありません")
+    return result
+
+def append_requeue(directory, entry, problems):
+    """再取得が必要な領収書を requeue.jsonl に追記する"""
+    item = {
+        "receipt_key": entry.get("receipt_key"),
+        "receipt_number": entry.get("receipt_number"),
+        "file": entry.get("file"),
+        "source_url": entry.get("source_url"),
+        "problems": problems,
+        "verified_at": datetime.now().isoformat(timespec='seconds')
+    }
+    with open(os.path.join(directory, REQUEUE_FILE_NAME), "a", encoding="utf-8") as f:
+        f.write(json.dumps(item, ensure_ascii=False) + "\n")
+
+def load_requeue(directory, receipt_manifest):
+    """再取得が必要な領収書のURLを返す（検証の後に保存し直したものは除く）"""
+    path = os.path.join(directory, REQUEUE_FILE_NAME)
+    urls = set()
+    if not os.path.exists(path):
+        return urls
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                item = json.loads(line)
+            except ValueError:
+                continue
+            saved = receipt_manifest.find_by_url(item.get("source_url")) if item.get("source_url") else None
+            if saved and (saved.get("saved_at") or "") <= (item.get("verified_at") or ""):
+                urls.add(item["source_url"])
+    if urls:
+        logger.info(f"検証に失敗した {len(urls)} 件の領収書を取得し直します")
+    return urls
+
+def create_verification_pool(max_workers):
+    """検証用のプロセスプールを作成する（ブラウザ操作のスレッドを引き継がないよう spawn で起動）"""
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+class ReceiptVerifier:
+    """保存した領収書を別プロセスで検査し、問題があれば requeue.jsonl に追記する（ブラウザ側の処理は待たせない）"""
+
+    def __init__(self, directory, max_workers=2):
+        self.directory = directory
+        self.executor = create_verification_pool(max_workers)
+        self.lock = threading.Lock()
+        self.counts = {"ok": 0, "failed": 0}
+
+    def on_receipt_saved(self, entry, data, record):
+        # 個別のファイルがディスク上にある場合だけ検査する（アーカイブ出力・月別PDFのみの場合は対象外）
+        if not write_individual_files or not isinstance(get_output_backend(), DirectoryOutput):
+            return
+        future = self.executor.submit(verify_receipt_file, os.path.join(self.directory, entry["file"]),
+                                      entry.get("receipt_number"), None, entry.get("capture") != "screenshot")
+        # 結果は別スレッドで受け取るため、ログの文脈（実行ID・領収書ID）を引き継ぐ
+        context = contextvars.copy_context()
+        future.add_done_callback(lambda done, entry=entry: context.run(self._on_verified, entry, done))
+
+    def _on_verified(self, entry, future):
+        log_context_var.set({**log_context_var.get(), "phase": "verify"})
+        try:
+            problems = future.result()["problems"]
+        except Exception as e:
+            # 検査自体の失敗（プロセスの異常終了など）では領収書を再取得しない
+            logger.error(f"領収書の検証を実行できませんでした: {entry['file']}: {str(e)}")
+            return
+        with self.lock:
+            if problems:
+                self.counts["failed"] += 1
+                logger.warning(f"領収書の検証に失敗しました: {entry['file']}: {'、'.join(problems)}")
+                append_requeue(self.directory, entry, problems)
+            else:
+                self.counts["ok"] += 1
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        logger.info(f"領収書の検証: 正常 {self.counts['ok']} 件、再取得が必要 {self.counts['failed']} 件")
+        if self.counts["failed"]:
+            print(f"\n{self.counts['failed']} 件の領収書が検証に失敗しました。次回の実行で取得し直します"
+                  f"（{os.path.join(self.directory, REQUEUE_FILE_NAME)}）")
+
+# 代替保存で撮影するページの高さの上限（px）と、PDF1件あたりのサイズの目安
+MAX_CAPTURE_HEIGHT = 8000
+MAX_FALLBACK_PDF_BYTES = 1536 * 1024
+# サイズが目安を超えたときに順に試す (JPEG品質, 縮小率)
+FALLBACK_CAPTURE_STEPS = [(80, 1.0), (60, 1.0), (60, 0.75), (45, 0.5)]
+# A4の幅（pt）、画像はこの幅に合わせて縦長の1ページにする
+PDF_PAGE_WIDTH = 595.28
+
+# 代替保存のPDF化と保存を行うスレッド（ブラウザは撮影後すぐ次の領収書に進む）
+capture_executor = None
+# PDF化を待っている代替保存（取得元URL → Future）
+pending_captures = {}
+
+def capture_full_page_jpeg(driver):
+    """ページ全体をJPEGで撮影する（表示領域の外も含め、サイズが目安を超えたら品質と解像度を下げる）"""
+    metrics = driver.execute_cdp_cmd("Page.getLayoutMetrics", {})
+    size = metrics.get("cssContentSize") or metrics["contentSize"]
+    width = max(int(size["width"]), 1)
+    height = max(min(int(size["height"]), MAX_CAPTURE_HEIGHT), 1)
+    for quality, scale in FALLBACK_CAPTURE_STEPS:
+        params = {"format": "jpeg", "quality": quality, "captureBeyondViewport": True,
+                  "clip": {"x": 0, "y": 0, "width": width, "height": height, "scale": scale}}
+        data = driver.execute_cdp_cmd("Page.captureScreenshot", params)["data"]
+        # base64は4/3倍になるため、デコードせずにおおよそのサイズを判定する
+        if len(data) * 3 // 4 <= MAX_FALLBACK_PDF_BYTES:
+            break
+    return data
+
+def jpeg_dimensions(data):
+    """JPEGのSOFマーカーから (幅, 高さ, 色成分数) を読み取る"""
+    offset = 2
+    while offset + 9 < len(data):
+        if data[offset] != 0xFF:
+            offset += 1
+            continue
+        marker = data[offset + 1]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = int.from_bytes(data[offset + 5:offset + 7], "big")
+            width = int.from_bytes(data[offset + 7:offset + 9], "big")
+            return width, height, data[offset + 9]
+        offset += 2 + int.from_bytes(data[offset + 2:offset + 4], "big")
+    raise ValueError("JPEGの画像サイズを読み取れません")
+
+def jpeg_to_pdf(data):
+    """JPEGをそのまま（DCTDecodeで）埋め込んだ1ページのPDFを作成する"""
+    width, height, components = jpeg_dimensions(data)
+    color_space = {1: "/DeviceGray", 4: "/DeviceCMYK"}.get(components, "/DeviceRGB")
+    page_width = PDF_PAGE_WIDTH
+    page_height = round(page_width * height / width, 2)
+    content = f"q {page_width} 0 0 {page_height} 0 0 cm /Im0 Do Q".encode("ascii")
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        (f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_width} {page_height}] "
+         f"/Resources << /XObject << /Im0 4 0 R >> >> /Contents 5 0 R >>").encode("ascii"),
+        (f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} /ColorSpace {color_space} "
+         f"/BitsPerComponent 8 /Filter /DCTDecode /Length {len(data)} >>\nstream\n").encode("ascii")
+        + data + b"\nendstream",
+        f"<< /Length {len(content)} >>\nstream\n".encode("ascii") + content + b"\nendstream",
+    ]
+    return build_pdf(objects)
+
+def build_pdf(objects):
+    """オブジェクト（番号は1から順）を並べ、相互参照表を付けたPDFを作成する（1番目をカタログとする）"""
+    pdf = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += f"{number} 0 obj\n".encode("ascii") + body + b"\nendobj\n"
+    xref_offset = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("ascii")
+    pdf += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode("ascii")
+    pdf += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode("ascii")
+    return bytes(pdf)
+
+def store_capture_pdf(jpeg_base64, receipt_number, source_url, record):
+    """撮影したJPEGをPDFにして保存する（代替保存のスレッドで実行）"""
+    with log_context(phase="capture"):
+        pdf = jpeg_to_pdf(base64.b64decode(jpeg_base64))
+        file_name = store_receipt_output(pdf, receipt_number, source_url, record=record, capture="screenshot")
+        logger.info(f"スクリーンショットをPDFにして保存しました: {file_name}（{len(pdf) // 1024}KB）")
+        return file_name
+
+def wait_for_captures(source_url=None):
+    """PDF化を待っている代替保存が終わるまで待つ（source_url を指定した場合はその1件だけ）"""
+    futures = [pending_captures.get(source_url)] if source_url else list(pending_captures.values())
+    for future in futures:
+        if future is not None:
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"スクリーンショットのPDF化に失敗しました: {str(e)}")
+
+def save_screenshot_fallback(driver, index, source_url=None, receipt_number=None, record=None):
+    """PDF保存に失敗した場合に、ページ全体のスクリーンショットを1ページのPDFとして保存する
+
+    ブラウザでは撮影だけを行い、PDF化と保存は別スレッドで行う。
+    """
+    global capture_executor
+    logger.info("スクリーンショットとして保存を試みます...")
+    source_url = source_url or driver.current_url
+    try:
+        jpeg_base64 = capture_full_page_jpeg(driver)
+    except Exception as e:
+        # 表示領域の外を撮影できない場合は、表示されている範囲だけを撮影する
+        logger.warning(f"ページ全体を撮影できませんでした。表示領域のみ撮影します: {str(e)}")
+        jpeg_base64 = driver.execute_cdp_cmd("Page.captureScreenshot", {"format": "jpeg", "quality": 70})["data"]
+    if capture_executor is None:
+        capture_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="capture")
+    future = capture_executor.submit(contextvars.copy_context().run, store_capture_pdf,
+                                     jpeg_base64, receipt_number, source_url, record)
+    pending_captures[source_url] = future
+    # 保存が終わったら待ち一覧から外す（既に終わっていればその場で外れる）
+    future.add_done_callback(
+        lambda done: pending_captures.pop(source_url, None) if pending_captures.get(source_url) is done else None)
+    logger.info(f"領収書 {index} をスクリーンショットとして撮影しました（PDF化は別スレッドで行います）")
+    return future
+
+def adopt_saved_file(file_path, receipt_number=None, source_url=None):
+    """手動で保存されたファイルをマニフェストに取り込む（内容ハッシュ付きの名前に揃える）"""
+    with open(file_path, "rb") as f:
+        data = f.read()
+    file_name = store_receipt_output(data, receipt_number, source_url)
+    stored_path = get_output_backend().local_path(file_name)
+    if not stored_path or os.path.abspath(stored_path) != os.path.abspath(file_path):
+        os.remove(file_path)
+    return file_name
+
+class RateLimiter:
+    """リクエストの間隔を全体で制限する（スレッド間で共有）"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def acquire(self):
+        """次のリクエストを送ってよい時刻まで待機する"""
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+# サーバーへのリクエストは全体で毎秒この回数まで
+DEFAULT_RATE_LIMIT = 1.0
+rate_limiter = RateLimiter(DEFAULT_RATE_LIMIT)
+
+def create_http_session(driver=None, pool_size=8):
+    """接続を再利用するHTTPセッションを作成する（ブラウザのCookieとUser-Agentを引き継ぐ）"""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=["GET", "HEAD"])
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if driver is not None:
+        for cookie in driver.get_cookies():
+            session.cookies.set(cookie['name'], cookie['value'],
+                                domain=cookie.get('domain'), path=cookie.get('path', '/'))
+        session.headers['User-Agent'] = driver.execute_script("return navigator.userAgent")
+    if traffic_recorder is not None:
+        session.hooks["response"].append(traffic_recorder.on_http_response)
+    return session
+
+class PdfHttpDownloader:
+    """共有セッションでPDFをストリーミング保存するダウンローダー（中断したファイルは続きから再開）"""
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, session, directory, timeout=(10, 60), max_attempts=3):
+        self.session = session
+        self.directory = directory
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        os.makedirs(directory, exist_ok=True)
+
+    def fetch(self, url):
+        """URLをディスクにストリーミングし、一時ファイルのパスを返す"""
+        import requests
+        
+        part_path = os.path.join(self.directory, hashlib.sha1(url.encode("utf-8")).hexdigest()[:16] + ".part")
+        for attempt in range(self.max_attempts):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            headers = {"Range": f"bytes={offset}-"} if offset else {}
+            rate_limiter.acquire()
+            try:
+                with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                    if response.status_code == 416 and offset:
+                        # 既に最後まで取得済み
+                        return part_path
+                    response.raise_for_status()
+                    # Rangeに対応していないサーバーは最初から返すため、上書きする
+                    mode = "ab" if response.status_code == 206 else "wb"
+                    with open(part_path, mode) as f:
+                        for chunk in response.iter_content(self.CHUNK_SIZE):
+                            f.write(chunk)
+                return part_path
+            except (requests.ConnectionError, requests.Timeout) as e:
+                logger.warning(f"PDFのダウンロードが中断しました。続きから再開します ({attempt + 1}/{self.max_attempts}): {str(e)}")
+            except requests.HTTPError as e:
+                logger.error(f"PDFのダウンロードに失敗しました: {str(e)}")
+                break
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        return None
+
+    def download(self, url, receipt_number=None, source_url=None, record=None):
+        """PDFをダウンロードしてチェックサム付きでマニフェストに記録し、ファイル名を返す"""
+        part_path = self.fetch(url)
+        if not part_path:
+            return None
+        with open(part_path, "rb") as f:
+            header = f.read(5)
+        if header != b"%PDF-":
+            logger.warning(f"ダウンロードしたファイルがPDFではありません（ログイン切れの可能性があります）: {url}")
+            os.remove(part_path)
+            return None
+        return store_receipt_file(part_path, file_fingerprint(part_path), receipt_number,
+                                  source_url or url, record=record)
+
+    def close(self):
+        self.session.close()
+
+http_session = None
+http_downloader = None
+
+def get_http_session(driver=None):
+    """共有のHTTPセッションを返す（初回はブラウザのCookieを引き継いで作成）"""
+    global http_session
+    if http_session is None:
+        http_session = create_http_session(driver)
+    return http_session
+
+def get_http_downloader(driver):
+    """共有のHTTPダウンローダーを返す"""
+    global http_downloader
+    if http_downloader is None:
+        http_downloader = PdfHttpDownloader(get_http_session(driver), os.path.join(download_dir, ".downloads"))
+    return http_downloader
+
+def response_encoding(response):
+    """レスポンスの文字コードを返す（Content-Typeに指定がなければUTF-8とみなす）"""
+    if "charset" in response.headers.get("Content-Type", "").lower():
+        return response.encoding
+    return "utf-8"
+
+class CachedResponse:
+    """キャッシュまたはサーバーから取得したページ"""
+
+    def __init__(self, url, content, encoding, from_cache):
+        self.url = url
+        self.content = content
+        self.encoding = encoding or "utf-8"
+        self.from_cache = from_cache
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, errors="replace")
+
+class HttpCache:
+    """Cookieで取得するページのディスクキャッシュ（ETag/Last-Modifiedで再検証し、サイズ上限を超えたら古いものから削除）"""
+    # 発行済みの領収書ページは内容が変わらないため再検証しない
+    IMMUTABLE_URL_PATTERN = re.compile(r'/receipt_sheets/\d+(?:[/?#]|$)')
+
+    def __init__(self, directory, max_bytes=200 * 1024 * 1024, namespace=""):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.stats = {"hit": 0, "revalidated": 0, "miss": 0, "evicted": 0}
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, "index.sqlite"), check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                url TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                encoding TEXT,
+                immutable INTEGER,
+                size INTEGER,
+                last_access REAL
+            )
+        """)
+        self.db.commit()
+
+    def _key(self, url):
+        # アカウントごとに内容が異なるため、名前空間をキーに含める
+        return hashlib.sha1((self.namespace + "\n" + url).encode("utf-8")).hexdigest()
+
+    def _body_path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _read_body(self, key):
+        try:
+            with open(self._body_path(key), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def get(self, session, url):
+        """ページを取得する（キャッシュがあれば条件付きGETで再検証し、変更がなければ通信しない）"""
+        key = self._key(url)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT etag, last_modified, encoding, immutable FROM entries WHERE key = ?", (key,)).fetchone()
+        body = self._read_body(key) if row else None
+        if body is not None and row[3]:
+            self._touch(key)
+            self.stats["hit"] += 1
+            return CachedResponse(url, body, row[2], True)
+        
+        headers = {}
+        if body is not None:
+            if row[0]:
+                headers["If-None-Match"] = row[0]
+            if row[1]:
+                headers["If-Modified-Since"] = row[1]
+        rate_limiter.acquire()
+        response = session.get(url, headers=headers, timeout=(10, 60))
+        if response.status_code == 304 and body is not None:
+            self._touch(key)
+            self.stats["revalidated"] += 1
+            return CachedResponse(url, body, row[2], True)
+        
+        response.raise_for_status()
+        self.stats["miss"] += 1
+        # ログインページへリダイレクトされた場合などはキャッシュしない
+        if not response.history:
+            self._store(key, url, response)
+        return CachedResponse(response.url, response.content, response_encoding(response), False)
+
+    def _store(self, key, url, response):
+        path = self._body_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + ".part"
+        with open(temp_path, "wb") as f:
+            f.write(response.content)
+        os.replace(temp_path, path)
+        with self.lock:
+            self.db.execute("""
+                INSERT OR REPLACE INTO entries (key, url, etag, last_modified, encoding, immutable, size, last_access)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (key, url, response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                  response_encoding(response), int(bool(self.IMMUTABLE_URL_PATTERN.search(url))),
+                  len(response.content), time.time()))
+            self.db.commit()
+        self._evict()
+
+    def _touch(self, key):
+        with self.lock:
+            self.db.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+
+    def _evict(self):
+        """合計サイズが上限を超えたら、最後に使われた時刻が古いものから削除する"""
+        with self.lock:
+            total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            for key, size in self.db.execute("SELECT key, size FROM entries ORDER BY last_access").fetchall():
+                if total <= self.max_bytes * 0.9:
+                    break
+                try:
+                    os.remove(self._body_path(key))
+                except OSError:
+                    pass
+                self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                total -= size
+                self.stats["evicted"] += 1
+            self.db.commit()
+
+    def summary(self):
+        """ヒット率などの統計を文字列で返す"""
+        requests_total = self.stats["hit"] + self.stats["revalidated"] + self.stats["miss"]
+        hit_rate = (self.stats["hit"] + self.stats["revalidated"]) / requests_total * 100 if requests_total else 0.0
+        return (f"キャッシュ: ヒット {self.stats['hit']} 件、再検証(304) {self.stats['revalidated']} 件、"
+                f"取得 {self.stats['miss']} 件、削除 {self.stats['evicted']} 件（ヒット率 {hit_rate:.1f}%）")
+
+    def close(self):
+        self.db.close()
+
+# Cookieで取得するページのキャッシュ（--no-cache で無効）
+DEFAULT_CACHE_DIR = ".http_cache"
+http_cache = None
+
+def fetch_html(session, url):
+    """Cookieを使ってページのHTMLを取得する（キャッシュが有効なら再検証のみ）"""
+    if http_cache is not None:
+        response = http_cache.get(session, url)
+    else:
+        rate_limiter.acquire()
+        raw = session.get(url, timeout=(10, 60))
+        raw.raise_for_status()
+        response = CachedResponse(raw.url, raw.content, response_encoding(raw), False)
+    if "/login" in response.url and "/login" not in url:
+        raise RuntimeError(f"ログインページにリダイレクトされました。セッションが切れている可能性があります: {url}")
+    return response.text
+
+def iter_receipt_pages_http(session, max_pages=None):
+    """支払一覧ページをHTTPで順に取得し、(ページ番号, 領収書エントリ一覧) を返す（ブラウザを使わない）"""
+    seen = set()
+    page_num = 1
+    while max_pages is None or page_num <= max_pages:
+        url = payments_page_url(page_num)
+        started = time.time()
+        with log_context(phase="list"):
+            html = fetch_html(session, url)
+        entries = [entry for entry in parse_payment_list_html(html, url, page_num) if entry.href not in seen]
+        get_phase_timings().record("list_page_http", time.time() - started)
+        # 最終ページより先は空か、同じ内容が返される
+        if not entries:
+            break
+        seen.update(entry.href for entry in entries)
+        logger.info(f"ページ {page_num} で {len(entries)} 件の領収書を検出しました（HTTP）")
+        yield page_num, entries
+        page_num += 1
+
+# 支払一覧ページの取得方法（browser: ブラウザで巡回、http: Cookieを引き継いだHTTPで取得）
+list_source = "browser"
+
+# 領収書の発行方法（browser: ボタンをクリック、http: 発行フォームを直接送信）
+issue_backend = "browser"
+# HTTPで発行した領収書の、一覧ページのURLから発行後のページのURLへの対応
+issued_pages = {}
+
+ISSUE_BUTTON_LABEL = "この内容で発行する"
+PREVIEW_BUTTON_LABEL = "プレビューで内容を確認する"
+
+class IssueFormParser(HTMLParser):
+    """発行ページのHTMLから、フォームごとの送信先・入力値・送信ボタンを取り出す"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.forms = []
+        self.csrf_token = None
+        self.form = None
+        self.button = None
+        self.textarea = None
+        self.select = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {name: value or "" for name, value in attrs}
+        if tag == "meta" and attrs.get("name") == "csrf-token":
+            self.csrf_token = attrs.get("content")
+        elif tag == "form":
+            self.form = {"action": attrs.get("action", ""), "method": attrs.get("method", "get").lower(),
+                         "fields": [], "submits": []}
+            self.forms.append(self.form)
+        elif self.form is None or not attrs.get("name") and tag not in ("input", "button", "option"):
+            return
+        elif tag == "input":
+            input_type = attrs.get("type", "text").lower()
+            if input_type in ("submit", "image"):
+                self.form["submits"].append((attrs.get("name"), attrs.get("value", ""), attrs.get("value", "")))
+            elif input_type in ("checkbox", "radio"):
+                if "checked" in attrs and attrs.get("name"):
+                    self.form["fields"].append((attrs["name"], attrs.get("value", "on")))
+            elif input_type not in ("button", "reset", "file") and attrs.get("name"):
+                self.form["fields"].append((attrs["name"], attrs.get("value", "")))
+        elif tag == "button" and attrs.get("type", "submit").lower() == "submit":
+            self.button = [attrs.get("name"), attrs.get("value", ""), ""]
+        elif tag == "textarea":
+            self.textarea = [attrs["name"], ""]
+        elif tag == "select":
+            self.select = [attrs["name"], None]
+        elif tag == "option" and self.select is not None:
+            if self.select[1] is None or "selected" in attrs:
+                self.select[1] = attrs.get("value", "")
+
+    def handle_data(self, data):
+        if self.button is not None:
+            self.button[2] += data
+        if self.textarea is not None:
+            self.textarea[1] += data
+
+    def handle_endtag(self, tag):
+        if tag == "form":
+            self.form = None
+        elif tag == "button" and self.button is not None:
+            if self.form is not None:
+                self.form["submits"].append((self.button[0], self.button[1], self.button[2].strip()))
+            self.button = None
+        elif tag == "textarea" and self.textarea is not None:
+            if self.form is not None:
+                self.form["fields"].append(tuple(self.textarea))
+            self.textarea = None
+        elif tag == "select" and self.select is not None:
+            if self.form is not None and self.select[1] is not None:
+                self.form["fields"].append(tuple(self.select))
+            self.select = None
+
+def find_submit_form(html, page_url, label):
+    """指定した送信ボタンを含むフォームを探し、(送信先URL, 送信内容) を返す（想定と異なる形なら None）"""
+    parser = IssueFormParser()
+    parser.feed(html)
+    candidates = [(form, submit) for form in parser.forms for submit in form["submits"] if label in submit[2]]
+    if len(candidates) != 1:
+        return None
+    form, (name, value, _) = candidates[0]
+    action = urljoin(page_url, form["action"] or page_url)
+    # 同じサイト（スキームとホストが一致）へのPOSTで、CSRFトークンを含むフォームだけを送信する
+    action_parts, base_parts = urlsplit(action), urlsplit(BASE_URL)
+    if form["method"] != "post" or (action_parts.scheme, action_parts.netloc) != (base_parts.scheme, base_parts.netloc):
+        return None
+    data = list(form["fields"])
+    if not any(field_name == "authenticity_token" for field_name, _ in data):
+        if not parser.csrf_token:
+            return None
+        data.append(("authenticity_token", parser.csrf_token))
+    if name:
+        data.append((name, value))
+    return action, data
+
+def submit_form(session, page_url, action, data):
+    """フォームを送信し、最終的に表示されるページの (URL, HTML) を返す"""
+    rate_limiter.acquire()
+    response = session.post(action, data=data, headers={"Referer": page_url, "Origin": BASE_URL}, timeout=(10, 60))
+    response.raise_for_status()
+    return response.url, response.content.decode(response_encoding(response), errors="replace")
+
+def issue_receipt_http(session, url):
+    """発行フォームを直接送信して領収書を発行し、発行後のページのURLを返す（想定外の場合は None）"""
+    try:
+        rate_limiter.acquire()
+        response = session.get(url, timeout=(10, 60))
+        response.raise_for_status()
+        page_url, html = response.url, response.content.decode(response_encoding(response), errors="replace")
+        if "print_button" in html:
+            # 既に発行済み
+            return page_url
+        
+        form = find_submit_form(html, page_url, ISSUE_BUTTON_LABEL)
+        if form is None:
+            # 発行ボタンがプレビュー画面にしかない場合は、先にプレビューを送信する
+            preview = find_submit_form(html, page_url, PREVIEW_BUTTON_LABEL)
+            if preview is None:
+                logger.info(f"発行フォームが想定と異なるため、ブラウザで発行します: {url}")
+                return None
+            page_url, html = submit_form(session, page_url, *preview)
+            form = find_submit_form(html, page_url, ISSUE_BUTTON_LABEL)
+            if form is None:
+                logger.info(f"プレビュー画面の発行フォームが想定と異なるため、ブラウザで発行します: {url}")
+                return None
+        
+        # 確認ダイアログ（「はい」）は画面上の確認だけのため、フォームをそのまま送信する
+        issued_url, html = submit_form(session, page_url, *form)
+        if "print_button" not in html or "/login" in issued_url:
+            logger.warning(f"HTTPでの発行後に印刷ボタンが見つかりません。ブラウザで確認します: {url}")
+            return None
+        logger.info(f"HTTPで領収書を発行しました: {url} -> {issued_url}")
+        return issued_url
+    except Exception as e:
+        logger.error(f"HTTPでの発行に失敗しました。ブラウザで発行します: {url}: {str(e)}")
+        return None
+
+def issue_pending_http(session, entries):
+    """未発行の領収書をHTTPでまとめて発行する（発行できたものは issued_pages に記録）"""
+    pending = [entry for entry in entries
+               if not entry.issued and entry.href not in issued_pages and not is_already_downloaded(entry.href)]
+    for i, entry in enumerate(pending, 1):
+        with log_context(receipt_id=entry.row_id, phase="issue"):
+            issued_url = issue_receipt_http(session, entry.href)
+        if issued_url:
+            issued_pages[entry.href] = issued_url
+        print(f"\r領収書を発行中: {i}/{len(pending)}", end='          \r')
+    if pending:
+        print()
+        logger.info(f"HTTPで {sum(1 for entry in pending if entry.href in issued_pages)}/{len(pending)} 件の領収書を発行しました")
+    return len(pending)
+
+# 記録した通信（フィクスチャ）の索引ファイル名
+FIXTURE_INDEX_NAME = "index.jsonl"
+# 通信を記録する場合の記録先（--record）
+traffic_recorder = None
+# 通信の記録側が読み出したパフォーマンスログのうち、Network 以外のイベント（ダウンロードの追跡に渡す）
+pending_performance_messages = []
+# 読み手がいない間に溜めておくイベントの上限
+MAX_PENDING_PERFORMANCE_MESSAGES = 10000
+
+# 記録時に伏せる個人情報（メールアドレス、電話番号、郵便番号）
+DEFAULT_SCRUB_PATTERNS = [
+    r'(?<![/\w.-])[\w.+-]+@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)*\.[A-Za-z]{2,}(?![\w.])',
+    r'(?<![\w-])0\d{1,4}-\d{1,4}-\d{4}(?![\w-])',
+    r'〒\s?\d{3}-?\d{4}',
+]
+SCRUB_REPLACEMENT = "＊＊＊"
+# 記録しないヘッダー（認証情報と、本文を展開して保存するため不要になる転送用のヘッダー）
+SCRUB_HEADERS = {"set-cookie", "cookie", "authorization", "content-encoding", "content-length", "transfer-encoding"}
+# 個人情報を伏せる対象の本文
+SCRUB_MIME_PATTERN = re.compile(r'text/html|json')
+# 再生時にオリジンを書き換える対象の本文
+TEXT_MIME_PATTERN = re.compile(r'text/|json|javascript|xml')
+
+def fixture_key(method, url):
+    """記録した通信を探すためのキー（オリジンを除いたパスとクエリ、別のURLで再生できるようにする）"""
+    parts = urlsplit(url)
+    return f"{method.upper()} {parts.path or '/'}" + (f"?{parts.query}" if parts.query else "")
+
+class Scrubber:
+    """記録する本文から個人情報を伏せる（指定した文字列と、メールアドレスなどのパターン）"""
+
+    def __init__(self, texts=(), patterns=DEFAULT_SCRUB_PATTERNS):
+        # 長い文字列から置き換える（氏名と姓だけを両方指定した場合など）
+        self.texts = sorted((text for text in texts if text), key=len, reverse=True)
+        self.pattern = re.compile("|".join(patterns)) if patterns else None
+
+    def scrub(self, text):
+        for value in self.texts:
+            text = text.replace(value, SCRUB_REPLACEMENT)
+        if self.pattern is not None:
+            text = self.pattern.sub(SCRUB_REPLACEMENT, text)
+        return text
+
+class FixtureStore:
+    """記録した通信を保存・検索する（索引は index.jsonl、本文は内容のハッシュ名で bodies/ に保存）"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.entries = {}
+        os.makedirs(os.path.join(directory, "bodies"), exist_ok=True)
+        index_path = os.path.join(directory, FIXTURE_INDEX_NAME)
+        if os.path.exists(index_path):
+            with open(index_path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        # 同じリクエストを複数回記録した場合は最後のものを使う
+                        entry = json.loads(line)
+                        self.entries[entry["key"]] = entry
+
+    def _body_path(self, digest):
+        return os.path.join(self.directory, "bodies", digest)
+
+    def add(self, method, url, status, headers, body, elapsed=0.0):
+        digest = hashlib.sha256(body).hexdigest()
+        entry = {"key": fixture_key(method, url), "method": method.upper(), "url": url, "status": status,
+                 "headers": headers, "body": digest, "size": len(body), "elapsed": round(elapsed, 3),
+                 "recorded_at": datetime.now().isoformat(timespec="seconds")}
+        with self.lock:
+            path = self._body_path(digest)
+            if not os.path.exists(path):
+                with open(path + ".part", "wb") as f:
+                    f.write(body)
+                os.replace(path + ".part", path)
+            with open(os.path.join(self.directory, FIXTURE_INDEX_NAME), "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.entries[entry["key"]] = entry
+        return entry
+
+    def find(self, method, url):
+        return self.entries.get(fixture_key(method, url))
+
+    def read_body(self, entry):
+        with open(self._body_path(entry["body"]), "rb") as f:
+            return f.read()
+
+    def bodies(self, path_prefix):
+        """パスが指定した文字列で始まるGETの本文を、記録順に返す"""
+        for entry in self.entries.values():
+            if entry["key"].startswith(f"GET {path_prefix}") and entry["status"] == 200:
+                yield entry, self.read_body(entry)
+
+class TrafficRecorder:
+    """実行中の通信をフィクスチャとして記録する（ブラウザはNetworkドメインのイベント、HTTPはセッションのフック）"""
+
+    def __init__(self, store, scrubber=None):
+        self.store = store
+        self.scrubber = scrubber or Scrubber()
+        self.requests = {}
+        self.finished = []
+        self.count = 0
+
+    def record(self, method, url, status, headers, body, mime_type="", elapsed=0.0):
+        # 304はキャッシュの本文を使うため、本文のないデータURLと合わせて記録しない
+        if url.startswith("data:") or status == 304:
+            return
+        headers = {name.lower(): value for name, value in headers.items() if name.lower() not in SCRUB_HEADERS}
+        if SCRUB_MIME_PATTERN.search(mime_type or headers.get("content-type", "")):
+            # 文字コードが分からなくてもバイト列を壊さないよう、surrogateescape で往復する
+            body = self.scrubber.scrub(body.decode("utf-8", "surrogateescape")).encode("utf-8", "surrogateescape")
+        self.store.add(method, url, status, headers, body, elapsed)
+        self.count += 1
+
+    def on_message(self, message):
+        """パフォーマンスログの Network イベントを受け取る（本文は poll で取得する）"""
+        method = message.get("method", "")
+        params = message.get("params", {})
+        request_id = params.get("requestId")
+        if method == "Network.requestWillBeSent":
+            previous = self.requests.get(request_id)
+            redirect = params.get("redirectResponse")
+            if previous is not None and redirect:
+                # リダイレクトは同じIDで届くため、前のリクエストの応答として本文なしで記録する
+                self.record(previous["method"], previous["url"], redirect["status"], redirect.get("headers", {}),
+                            b"", redirect.get("mimeType", ""))
+            self.requests[request_id] = {"method": params["request"]["method"], "url": params["request"]["url"],
+                                         "started": params.get("timestamp", 0.0)}
+        elif method == "Network.responseReceived" and request_id in self.requests:
+            response = params["response"]
+            self.requests[request_id].update(status=response["status"], headers=response.get("headers", {}),
+                                             mime_type=response.get("mimeType", ""),
+                                             received=params.get("timestamp", 0.0))
+        elif method == "Network.loadingFinished" and request_id in self.requests:
+            self.finished.append(request_id)
+        elif method == "Network.loadingFailed":
+            self.requests.pop(request_id, None)
+
+    def poll(self, driver):
+        """読み込みが終わったレスポンスの本文を取得して記録する"""
+        try:
+            drain_performance_log(driver)
+        except Exception as e:
+            logger.debug("パフォーマンスログを読み出せませんでした: %s", e)
+            return
+        while self.finished:
+            request_id = self.finished.pop(0)
+            request = self.requests.pop(request_id, None)
+            if request is None or "status" not in request:
+                continue
+            try:
+                result = driver.execute_cdp_cmd("Network.getResponseBody", {"requestId": request_id})
+            except Exception as e:
+                # 別のタブの通信や、破棄済みの本文は取得できない
+                logger.debug("レスポンスの本文を取得できませんでした: %s: %s", request["url"], e)
+                continue
+            body = base64.b64decode(result["body"]) if result.get("base64Encoded") else result["body"].encode("utf-8")
+            self.record(request["method"], request["url"], request["status"], request["headers"], body,
+                        request["mime_type"], request.get("received", 0.0) - request["started"])
+
+    def on_http_response(self, response, *args, **kwargs):
+        """HTTPセッションのレスポンスを記録する（ストリーミングで保存するPDFは記録しない）"""
+        if not kwargs.get("stream"):
+            try:
+                self.record(response.request.method, response.url, response.status_code, dict(response.headers),
+                            response.content, elapsed=response.elapsed.total_seconds())
+            except Exception as e:
+                logger.debug("HTTPのレスポンスを記録できませんでした: %s: %s", response.url, e)
+        return response
+
+def drain_performance_log(driver):
+    """パフォーマンスログを読み出し、通信の記録中は Network イベントを記録側に渡す（それ以外は後で返すために溜める）"""
+    for log_entry in driver.get_log("performance"):
+        message = json.loads(log_entry["message"]).get("message", {})
+        if traffic_recorder is not None and message.get("method", "").startswith("Network."):
+            traffic_recorder.on_message(message)
+        else:
+            pending_performance_messages.append(message)
+    del pending_performance_messages[:-MAX_PENDING_PERFORMANCE_MESSAGES]
+
+def performance_messages(driver):
+    """パフォーマンスログの未処理のイベントを返す（通信の記録側が先に読み出した分も含む）"""
+    drain_performance_log(driver)
+    messages = pending_performance_messages[:]
+    pending_performance_messages.clear()
+    return messages
+
+class ReplayServer:
+    """記録した通信を返すローカルのHTTPサーバー（応答を latency 秒遅らせて、サイトの応答時間を再現する）"""
+
+    def __init__(self, store, host="127.0.0.1", port=0, latency=0.0):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        
+        self.store = store
+        self.latency = latency
+        self.stats = {"served": 0, "missing": 0}
+        replay = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                logger.debug("再生: " + format, *args)
+
+            def serve(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    self.rfile.read(length)
+                replay.respond(self)
+
+            do_GET = do_POST = do_HEAD = serve
+        
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def respond(self, handler):
+        entry = self.store.find(handler.command, handler.path)
+        if self.latency:
+            time.sleep(self.latency)
+        if entry is None:
+            self.stats["missing"] += 1
+            logger.warning(f"記録にないリクエストです: {handler.command} {handler.path}")
+            handler.send_response(404)
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+            return
+        
+        # 記録したサイトのURLを、再生サーバーのURLに書き換える
+        parts = urlsplit(entry["url"])
+        origin = f"{parts.scheme}://{parts.netloc}"
+        body = self.store.read_body(entry)
+        if TEXT_MIME_PATTERN.search(entry["headers"].get("content-type", "")):
+            body = body.replace(origin.encode("utf-8"), self.base_url.encode("utf-8"))
+        handler.send_response(entry["status"])
+        for name, value in entry["headers"].items():
+            # Server と Date は再生サーバーが付ける
+            if name in ("server", "date"):
+                continue
+            if name == "location":
+                value = value.replace(origin, self.base_url)
+            # ブラウザのログでは同名のヘッダーが改行区切りで1つにまとめられている
+            for line in str(value).split("\n"):
+                handler.send_header(name, line)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        if handler.command != "HEAD":
+            handler.wfile.write(body)
+        self.stats["served"] += 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info(f"記録した通信の再生を開始しました: {self.base_url}（{len(self.store.entries)} 件）")
+        return self
+
+    def summary(self):
+        return f"再生: 応答 {self.stats['served']} 件、記録なし {self.stats['missing']} 件"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+# 合成サイトの一覧ページ1ページあたりの件数
+MOCK_PAGE_SIZE = 50
+MOCK_RECEIPT_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>領収書</title></head><body>
+<div class="alert alert-success">領収書を発行しました</div>
+<h1>領収書</h1>
+<table>
+<tr><th>領収書番号</th><td>R-SOAK-{n:06d}</td></tr>
+<tr><th>発行日</th><td>2024年{month}月15日</td></tr>
+<tr><th>宛名</th><td>株式会社サンプル 様</td></tr>
+<tr><th>金額</th><td>¥{amount:,}</td></tr>
+<tr><th>消費税</th><td>¥{tax:,}</td></tr>
+</table>
+<p>{body}</p>
+<a class="cw-button_action print_button" href="#">印刷する</a>
+</body></html>"""
+
+class MockSite:
+    """合成した支払一覧と発行済みの領収書を返すローカルのHTTPサーバー（長時間の計測用、ログイン済みとして振る舞う）"""
+
+    def __init__(self, receipts, host="127.0.0.1", port=0, latency=0.0):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        
+        self.receipts = receipts
+        self.latency = latency
+        self.stats = {"served": 0, "missing": 0}
+        site = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                logger.debug("合成サイト: " + format, *args)
+
+            def do_GET(self):
+                site.respond(self)
+        
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def list_page(self, page_num):
+        """支払一覧ページ（最終ページより先は空の表を返す）"""
+        first = (page_num - 1) * MOCK_PAGE_SIZE + 1
+        numbers = range(first, min(first + MOCK_PAGE_SIZE, self.receipts + 1))
+        rows = "".join(BENCH_LIST_ROW.format(n=n, month=n % 12 + 1, amount=n * 1100) for n in numbers)
+        next_link = f'<a rel="next" href="/payments?page={page_num + 1}">次へ</a>' if numbers.stop <= self.receipts else ""
+        return f'<html><head><meta charset="utf-8"><title>支払一覧</title></head><body><table>{rows}</table>{next_link}</body></html>'
+
+    def receipt_page(self, n):
+        return MOCK_RECEIPT_PAGE.format(n=n, month=n % 12 + 1, amount=n * 1100, tax=n * 100,
+                                        body=" ".join(f"明細 {n}-{line}" for line in range(20)))
+
+    def respond(self, handler):
+        if self.latency:
+            time.sleep(self.latency)
+        parts = urlsplit(handler.path)
+        page_match = re.search(r'page=(\d+)', parts.query)
+        receipt_match = re.fullmatch(r'/receipt_sheets/(\d+)', parts.path)
+        status, body = 200, None
+        if parts.path == "/login":
+            # ログイン済みとしてマイページに移動させる
+            handler.send_response(302)
+            handler.send_header("Location", "/mypage")
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+            self.stats["served"] += 1
+            return
+        if parts.path == "/mypage":
+            body = '<html><head><meta charset="utf-8"><title>マイページ</title></head><body>マイページ</body></html>'
+        elif parts.path == "/payments":
+            body = self.list_page(int(page_match.group(1)) if page_match else 1)
+        elif receipt_match and 1 <= int(receipt_match.group(1)) <= self.receipts:
+            body = self.receipt_page(int(receipt_match.group(1)))
+        else:
+            status, body = 404, ""
+            self.stats["missing"] += 1
+        data = body.encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", "text/html; charset=utf-8")
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+        self.stats["served"] += 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info(f"合成サイトを起動しました: {self.base_url}（領収書 {self.receipts} 件）")
+        return self
+
+    def summary(self):
+        return f"合成サイト: 応答 {self.stats['served']} 件、該当なし {self.stats['missing']} 件"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+# 直接ダウンロードできるPDFがあれば印刷より優先するか、またその取得方法（browser / http）
+prefer_direct_pdf = False
+direct_pdf_backend = "browser"
+download_manager = None
+
+class CdpDownloadManager:
+    """CDPのダウンロードイベントで、ブラウザのダウンロードをGUIDごとに追跡する"""
+
+    def __init__(self, driver, directory):
+        self.driver = driver
+        self.directory = directory
+        self.pending = []
+        self.downloads = {}
+        os.makedirs(directory, exist_ok=True)
+        # GUIDをファイル名として保存させ、進捗イベントを有効にする
+        driver.execute_cdp_cmd("Browser.setDownloadBehavior", {
+            "behavior": "allowAndName",
+            "downloadPath": directory,
+            "eventsEnabled": True
+        })
+        self.poll()
+
+    def start(self, url, target_name):
+        """ページ遷移せずにダウンロードを開始する（完了は wait で待つ）"""
+        self.pending.append((url, target_name))
+        self.driver.execute_script("""
+            var a = document.createElement('a');
+            a.href = arguments[0];
+            a.download = '';
+            document.body.appendChild(a);
+            a.click();
+            a.remove();
+        """, url)
+
+    def poll(self):
+        """溜まったダウンロードイベントを処理する"""
+        for message in performance_messages(self.driver):
+            method = message.get("method", "")
+            params = message.get("params", {})
+            # Browser.* と Page.* の両方で届くことがあるため、GUIDで重複を除く
+            if method.endswith(".downloadWillBegin") and params.get("guid") not in self.downloads:
+                target_name = None
+                for i, (url, name) in enumerate(self.pending):
+                    if url == params.get("url"):
+                        target_name = self.pending.pop(i)[1]
+                        break
+                if target_name is None and self.pending:
+                    # リダイレクトでURLが変わった場合は開始順に対応付ける
+                    target_name = self.pending.pop(0)[1]
+                self.downloads[params["guid"]] = {
+                    "url": params.get("url"),
+                    "target": target_name or params.get("suggestedFilename") or params["guid"],
+                    "state": "inProgress",
+                    "path": None
+                }
+            elif method.endswith(".downloadProgress") and params.get("guid") in self.downloads:
+                download = self.downloads[params["guid"]]
+                if download["state"] != "inProgress":
+                    continue
+                if params.get("state") == "completed":
+                    path = os.path.join(self.directory, download["target"])
+                    os.replace(os.path.join(self.directory, params["guid"]), path)
+                    download.update(state="completed", path=path)
+                    logger.info(f"ダウンロードが完了しました: {download['target']}")
+                elif params.get("state") == "canceled":
+                    download["state"] = "canceled"
+                    self._remove_partial(params["guid"])
+                    logger.warning(f"ダウンロードがキャンセルされました: {download['url']}")
+
+    def _remove_partial(self, guid):
+        """GUIDの名前で書きかけのファイルを削除する"""
+        try:
+            os.remove(os.path.join(self.directory, guid))
+        except OSError:
+            pass
+
+    def wait(self, target_names, timeout=30):
+        """指定したダウンロードがすべて終わるまで待ち、{ファイル名: パス} を返す（失敗したものはNone）"""
+        target_names = set(target_names)
+        deadline = time.time() + timeout
+        while True:
+            self.poll()
+            finished = {d["target"]: d["path"] for d in self.downloads.values()
+                        if d["target"] in target_names and d["state"] != "inProgress"}
+            if len(finished) == len(target_names) or time.time() > deadline:
+                for name in target_names - set(finished):
+                    logger.warning(f"ダウンロードがタイムアウトしました: {name}")
+                    finished[name] = None
+                # 開始されなかったダウンロードは対応付けの候補から外す
+                self.pending = [(url, name) for url, name in self.pending if name not in target_names]
+                for guid in [g for g, d in self.downloads.items() if d["target"] in target_names]:
+                    if self.downloads[guid]["state"] == "inProgress":
+                        # 終わらなかったダウンロードは中止し、書きかけのファイルを残さない
+                        try:
+                            self.driver.execute_cdp_cmd("Browser.cancelDownload", {"guid": guid})
+                        except Exception as e:
+                            logger.debug("ダウンロードを中止できませんでした: %s: %s", guid, e)
+                        self._remove_partial(guid)
+                    del self.downloads[guid]
+                return finished
+            time.sleep(0.05)
+
+    def download(self, url, target_name, timeout=30):
+        """1件ダウンロードして保存先のパスを返す"""
+        self.start(url, target_name)
+        return self.wait([target_name], timeout)[target_name]
+
+def download_pdf_via_browser(pdf_url, receipt_number=None, source_url=None, record=None):
+    """ブラウザのダウンロードでPDFを取得し、マニフェストに記録して保存する"""
+    target_name = hashlib.sha1(pdf_url.encode("utf-8")).hexdigest()[:16] + ".pdf"
+    path = download_manager.download(pdf_url, target_name)
+    if not path:
+        return None
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        if not data.startswith(b"%PDF"):
+            logger.warning(f"ダウンロードしたファイルがPDFではありません: {pdf_url}")
+            return None
+        return store_receipt_output(data, receipt_number, source_url, record=record)
+    finally:
+        os.remove(path)
+
+# 取得方法ごとの実績（成功率と所要時間）の保存先
+SELECTOR_STATS_PATH = "selector_stats.json"
+selector_registry = None
+
+class SelectorStrategyRegistry:
+    """要素の取得方法（戦略）ごとの成功率と所要時間を記録し、実績の良い方法から順に試す"""
+
+    def __init__(self, path=SELECTOR_STATS_PATH):
+        self.path = path
+        self.stats = {}
+        self.unsaved = 0
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.stats = json.load(f)
+            except ValueError:
+                logger.warning(f"取得方法の実績ファイルを読み込めませんでした: {path}")
+
+    def _score(self, site, name, default_rank):
+        """並び順のキー（成功率が高く、成功時の平均所要時間が短いものを優先）"""
+        stat = self.stats.get(site, {}).get(name)
+        if not stat:
+            # 未使用の方法は既定の順序で、実績のある方法のうち失敗続きのものより先に試す
+            return (-0.5, 0.0, default_rank)
+        attempts = stat['hits'] + stat['misses']
+        hit_rate = (stat['hits'] + 1) / (attempts + 2)
+        mean_latency = stat['hit_time'] / stat['hits'] if stat['hits'] else float('inf')
+        return (-round(hit_rate, 1), mean_latency, default_rank)
+
+    def order(self, site, names):
+        return sorted(names, key=lambda name: self._score(site, name, names.index(name)))
+
+    def record(self, site, name, success, elapsed):
+        stat = self.stats.setdefault(site, {}).setdefault(
+            name, {"hits": 0, "misses": 0, "hit_time": 0.0, "miss_time": 0.0})
+        if success:
+            stat['hits'] += 1
+            stat['hit_time'] += elapsed
+        else:
+            stat['misses'] += 1
+            stat['miss_time'] += elapsed
+        self.unsaved += 1
+        if self.unsaved >= 20:
+            self.save()
+
+    def run(self, site, strategies, reorder=True):
+        """戦略を実績順に試し、最初に結果を返したものの (名前, 結果) を返す
+
+        方法によって返す値が変わる抽出（番号やURLなど）は reorder=False とし、実績は記録するが
+        順序は変えない（速い方法を先にすると、抽出される値そのものが変わってしまうため）。
+        """
+        names = [name for name, _ in strategies]
+        functions = dict(strategies)
+        for name in (self.order(site, names) if reorder else names):
+            start = time.time()
+            try:
+                result = functions[name]()
+            except Exception as e:
+                logger.debug("%s: %s が失敗: %s", site, name, e)
+                result = None
+            self.record(site, name, bool(result), time.time() - start)
+            if result:
+                return name, result
+        return None, None
+
+    def save(self):
+        """実績をファイルに保存する"""
+        if not self.unsaved:
+            return
+        temp_path = self.path + ".part"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.stats, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, self.path)
+        self.unsaved = 0
+
+def get_selector_registry():
+    """取得方法の実績を返す（未作成の場合は既定のパスから読み込む）"""
+    global selector_registry
+    if selector_registry is None:
+        selector_registry = SelectorStrategyRegistry()
+        atexit.register(selector_registry.save)
+    return selector_registry
+
+# 処理の段階ごとの所要時間の実績（--plan の所要時間の見積もりに使う）
+PHASE_TIMINGS_PATH = "phase_timings.json"
+phase_timings = None
+
+# 実績がない場合の見積もり（秒）。処理中の待機時間と、ページの読み込みにかかる一般的な時間から決めた値
+DEFAULT_PHASE_SECONDS = {
+    "list_page_browser": 4.0,
+    "list_page_http": 1.0,
+    "receipt_issued": 8.0,
+    "receipt_unissued": 15.0,
+}
+
+class PhaseTimings:
+    """処理の段階（一覧ページの読み込み、発行済み・未発行の領収書の処理）ごとに直近の所要時間を記録する"""
+    MAX_SAMPLES = 50
+
+    def __init__(self, path=PHASE_TIMINGS_PATH):
+        self.path = path
+        self.samples = {}
+        self.unsaved = 0
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.samples = json.load(f)
+            except ValueError:
+                logger.warning(f"所要時間の実績ファイルを読み込めませんでした: {path}")
+
+    def record(self, phase, seconds):
+        samples = self.samples.setdefault(phase, [])
+        samples.append(round(seconds, 3))
+        del samples[:-self.MAX_SAMPLES]
+        self.unsaved += 1
+        if self.unsaved >= 20:
+            self.save()
+
+    def estimate(self, phase):
+        """段階の所要時間の見積もり（実績の中央値、なければ既定値）と、実績の件数を返す"""
+        samples = sorted(self.samples.get(phase, []))
+        if not samples:
+            return DEFAULT_PHASE_SECONDS[phase], 0
+        return samples[len(samples) // 2], len(samples)
+
+    def save(self):
+        """実績をファイルに保存する"""
+        if not self.unsaved:
+            return
+        temp_path = self.path + ".part"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.samples, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, self.path)
+        self.unsaved = 0
+
+def get_phase_timings():
+    """所要時間の実績を返す（未作成の場合は既定のパスから読み込む）"""
+    global phase_timings
+    if phase_timings is None:
+        phase_timings = PhaseTimings()
+        atexit.register(phase_timings.save)
+    return phase_timings
+
+def wait_for_element(driver, by, selector, timeout=10):
+    """要素が現れるまで待機して返す"""
+    return WebDriverWait(driver, timeout).until(EC.presence_of_element_located((by, selector)))
 
 # 一覧ページに戻る関数を修正
 def go_back_to_list_page(driver, page_num=1):
@@ -85,41 +1874,21 @@ def go_back_to_list_page(driver, page_num=1):
             logger.info(f"支払一覧ページ {page_num} に移動中... ({attempt+1}/{max_attempts})")
             
             # 直接URLで移動（最も確実な方法）
-            if page_num == 1:
-                driver.get('https://crowdworks.jp/payments?ref=login_header')
-            else:
-                driver.get(f'https://crowdworks.jp/payments?page={page_num}&ref=login_header')
+            driver.get(payments_page_url(page_num))
             
-            # ページの読み込みを待機（複数の検索方法を試す）
-            try:
+            # ページの読み込みを待機（実績の良い検索方法から順に試す）
+            method, _ = get_selector_registry().run('list_page_ready', [
                 # 方法1: テキストで検索
-                WebDriverWait(driver, 10).until(
-                    EC.presence_of_element_located((By.XPATH, "//a[contains(text(), '領収書')]"))
-                )
-                logger.info(f"支払一覧ページ {page_num} に移動完了（領収書リンク検出）")
-                return True
-            except:
-                logger.info("テキストでの領収書リンク検索に失敗しました")
-            
-            try:
+                ('テキスト', lambda: wait_for_element(driver, By.XPATH, "//a[contains(text(), '領収書')]")),
                 # 方法2: クラス名で検索
-                WebDriverWait(driver, 10).until(
-                    EC.presence_of_element_located((By.CSS_SELECTOR, "a.text-button.issuable"))
-                )
-                logger.info(f"支払一覧ページ {page_num} に移動完了（クラス名で検出）")
-                return True
-            except:
-                logger.info("クラス名での領収書リンク検索に失敗しました")
-            
-            try:
+                ('クラス名', lambda: wait_for_element(driver, By.CSS_SELECTOR, "a.text-button.issuable")),
                 # 方法3: href属性で検索
-                WebDriverWait(driver, 10).until(
-                    EC.presence_of_element_located((By.XPATH, "//a[contains(@href, '/receipt_sheets/new')]"))
-                )
-                logger.info(f"支払一覧ページ {page_num} に移動完了（href属性で検出）")
+                ('href属性', lambda: wait_for_element(driver, By.XPATH, "//a[contains(@href, '/receipt_sheets/new')]"))
+            ])
+            if method:
+                logger.info(f"支払一覧ページ {page_num} に移動完了（{method}で検出）")
                 return True
-            except:
-                logger.info("href属性での領収書リンク検索に失敗しました")
+            logger.info("領収書リンクの検索に失敗しました")
             
             # ページのタイトルやURLで確認
             if 'payments' in driver.current_url:
@@ -136,33 +1905,325 @@ def go_back_to_list_page(driver, page_num=1):
     logger.error(f"支払一覧ページ {page_num} への移動が最大試行回数を超えました")
     return False
 
-def download_receipts_with_manual_login(download_dir=None, config=None):
-    """手動ログインを組み込んだ領収書ダウンロード処理"""
-    # Chromeの設定と初期化
-    driver = setup_chrome_driver()
-    
+# 実行中のブラウザの監視（ReceiptClient がブラウザの起動時に作成する）
+browser_watchdog = None
+
+class ReceiptDeadlineExceeded(RuntimeError):
+    """1件の領収書の処理が上限時間を超えた"""
+
+def browser_process_ids(driver):
+    """chromedriver配下のブラウザのプロセスIDを返す"""
+    root_pid = driver.service.process.pid
+    try:
+        import psutil
+        return [child.pid for child in psutil.Process(root_pid).children(recursive=True)]
+    except ImportError:
+        pass
+    # psutilがない場合はLinuxの /proc から親子関係をたどる
+    children = {}
+    try:
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            try:
+                with open(f"/proc/{name}/stat", encoding="utf-8") as f:
+                    parent_pid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(parent_pid, []).append(int(name))
+    except OSError:
+        return []
+    pids = []
+    stack = [root_pid]
+    while stack:
+        for child_pid in children.get(stack.pop(), []):
+            pids.append(child_pid)
+            stack.append(child_pid)
+    return pids
+
+def browser_rss_bytes(driver):
+    """ブラウザの全プロセスの使用メモリ（RSS）の合計を返す（取得できない場合は None）"""
+    return process_rss_bytes(browser_process_ids(driver))
+
+def process_rss_bytes(pids):
+    """指定したプロセスの使用メモリ（RSS）の合計を返す（1つも読み取れない場合は None）"""
+    if not pids:
+        return None
+    total = None
+    try:
+        import psutil
+        for pid in pids:
+            try:
+                total = (total or 0) + psutil.Process(pid).memory_info().rss
+            except psutil.Error:
+                pass
+        return total
+    except ImportError:
+        pass
+    page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/statm", encoding="utf-8") as f:
+                total = (total or 0) + int(f.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            pass
+    return total
+
+def kill_browser(driver):
+    """応答しないブラウザとchromedriverを強制終了する"""
+    for pid in browser_process_ids(driver):
+        try:
+            os.kill(pid, getattr(signal, "SIGKILL", signal.SIGTERM))
+        except OSError:
+            pass
+    try:
+        driver.service.process.kill()
+    except Exception:
+        pass
+
+class BrowserWatchdog:
+    """ブラウザのメモリ使用量と処理時間を監視し、閾値を超えたらタブの作り直しやブラウザの再起動を行う"""
+
+    def __init__(self, driver, driver_factory, on_restart=None, receipt_timeout=300,
+                 max_browser_memory_mb=2048, max_js_heap_mb=512, recycle_tab_every=50, slowdown_factor=2.0):
+        self.driver = driver
+        self.driver_factory = driver_factory
+        self.on_restart = on_restart
+        self.receipt_timeout = receipt_timeout
+        self.max_browser_memory = max_browser_memory_mb * 1024 * 1024
+        self.max_js_heap = max_js_heap_mb * 1024 * 1024
+        self.recycle_tab_every = recycle_tab_every
+        self.slowdown_factor = slowdown_factor
+        self.expired = False
+        self.receipts_since_recycle = 0
+        self.baseline_durations = []
+        self.recent_durations = []
+        self.counts = {"tab": 0, "restart": 0, "timeout": 0}
+        self._timer = None
+        self._timer_due = None
+        self._paused_seconds = 0.0
+        self._metrics_handle = None
+
+    def _start_timer(self, seconds):
+        self._timer_due = time.monotonic() + seconds
+        self._timer = threading.Timer(seconds, self._expire)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _cancel_timer(self):
+        """タイマーを止め、残り時間を返す"""
+        if self._timer is None:
+            return None
+        self._timer.cancel()
+        self._timer = None
+        return max(self._timer_due - time.monotonic(), 0.0)
+
+    def _expire(self):
+        # 応答待ちで止まっている処理を終わらせるため、ブラウザごと強制終了する
+        self.expired = True
+        logger.error(f"領収書の処理が {self.receipt_timeout} 秒を超えたため、ブラウザを強制終了します")
+        kill_browser(self.driver)
+
+    @contextmanager
+    def deadline(self, label):
+        """1件の処理に上限時間を設ける（超えた場合はブラウザを再起動して ReceiptDeadlineExceeded を送出）"""
+        self.expired = False
+        self._paused_seconds = 0.0
+        started = time.monotonic()
+        self._start_timer(self.receipt_timeout)
+        try:
+            yield
+        except Exception:
+            if not self.expired:
+                raise
+        finally:
+            self._cancel_timer()
+        if self.expired:
+            self.counts["timeout"] += 1
+            self.restart(f"領収書 {label} の処理時間超過")
+            raise ReceiptDeadlineExceeded(f"領収書 {label} の処理が {self.receipt_timeout} 秒以内に終わりませんでした")
+        self._record_duration(time.monotonic() - started - self._paused_seconds)
+
+    @contextmanager
+    def paused(self):
+        """利用者の操作を待つ間は上限時間の計測を止める"""
+        remaining = self._cancel_timer()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._paused_seconds += time.monotonic() - started
+            if remaining is not None:
+                self._start_timer(remaining)
+
+    def _record_duration(self, seconds):
+        # 保存済みでスキップした領収書は所要時間の比較に含めない
+        if seconds < 1.0:
+            return
+        if len(self.baseline_durations) < 10:
+            self.baseline_durations.append(seconds)
+        else:
+            self.recent_durations = (self.recent_durations + [seconds])[-10:]
+
+    def _slowed_down(self):
+        """直近10件の所要時間の中央値が、最初の10件の中央値の slowdown_factor 倍を超えたか"""
+        if len(self.baseline_durations) < 10 or len(self.recent_durations) < 10:
+            return False
+        baseline = sorted(self.baseline_durations)[5]
+        return sorted(self.recent_durations)[5] > baseline * self.slowdown_factor
+
+    def sample(self):
+        """CDPのPerformance.getMetricsとブラウザのRSSを取得する"""
+        metrics = {}
+        try:
+            handle = self.driver.current_window_handle
+            if handle != self._metrics_handle:
+                self.driver.execute_cdp_cmd("Performance.enable", {})
+                self._metrics_handle = handle
+            result = self.driver.execute_cdp_cmd("Performance.getMetrics", {})
+            metrics = {metric["name"]: metric["value"] for metric in result.get("metrics", [])}
+        except Exception as e:
+            logger.debug("ブラウザの計測値を取得できませんでした: %s", e)
+        metrics["BrowserRSS"] = browser_rss_bytes(self.driver)
+        return metrics
+
+    def after_receipt(self):
+        """1件処理するごとに状態を確認し、必要に応じてタブの作り直しやブラウザの再起動を行う"""
+        self.receipts_since_recycle += 1
+        metrics = self.sample()
+        rss = metrics.get("BrowserRSS")
+        js_heap = metrics.get("JSHeapUsedSize", 0)
+        logger.debug("ブラウザの状態: RSS %.0fMB、JSヒープ %.0fMB、DOMノード %.0f、ドキュメント %.0f",
+                     (rss or 0) / 1024 / 1024, js_heap / 1024 / 1024, metrics.get("Nodes", 0),
+                     metrics.get("Documents", 0))
+        if rss is not None and rss > self.max_browser_memory:
+            self.restart(f"ブラウザの使用メモリが {rss / 1024 / 1024:.0f}MB に達しました")
+        elif self._slowed_down():
+            self.restart("処理速度が開始時より大きく低下しました")
+        elif js_heap > self.max_js_heap:
+            self.recycle_tab(f"JSヒープが {js_heap / 1024 / 1024:.0f}MB に達しました")
+        elif self.recycle_tab_every and self.receipts_since_recycle >= self.recycle_tab_every:
+            self.recycle_tab(f"{self.receipts_since_recycle} 件処理しました")
+
+    def recycle_tab(self, reason):
+        """新しいタブを開いて古いタブを閉じる（ログイン状態はそのまま）"""
+        logger.info(f"タブを作り直します: {reason}")
+        try:
+            old_handle = self.driver.current_window_handle
+            self.driver.switch_to.new_window('tab')
+            new_handle = self.driver.current_window_handle
+            self.driver.switch_to.window(old_handle)
+            self.driver.close()
+            self.driver.switch_to.window(new_handle)
+        except Exception as e:
+            logger.error(f"タブの作り直しに失敗したため、ブラウザを再起動します: {str(e)}")
+            self.restart(reason)
+            return
+        self.counts["tab"] += 1
+        self.receipts_since_recycle = 0
+        self.recent_durations = []
+
+    def restart(self, reason):
+        """ブラウザを再起動する（同じプロファイルを使うためログイン状態は引き継がれる）"""
+        logger.warning(f"ブラウザを再起動します: {reason}")
+        try:
+            self.driver.quit()
+        except Exception:
+            kill_browser(self.driver)
+        self.driver = self.driver_factory()
+        self._metrics_handle = None
+        self.counts["restart"] += 1
+        self.receipts_since_recycle = 0
+        self.recent_durations = []
+        if self.on_restart is not None:
+            self.on_restart(self.driver)
+
+    def summary(self):
+        return (f"ブラウザ監視: タブ作り直し {self.counts['tab']} 回、再起動 {self.counts['restart']} 回"
+                f"（うち処理時間超過 {self.counts['timeout']} 回）")
+
+# 利用者の入力を待つか（ライブラリとして使う場合は False にし、手動操作が必要な領収書は失敗として返す）
+interactive = True
+
+def ask_user(prompt=""):
+    """利用者の入力を待つ（待っている間は処理時間の上限を止める。対話しない場合は空の入力として扱う）"""
+    if not interactive:
+        logger.info(f"対話しない設定のため、入力を省略します: {prompt}")
+        return ""
+    if browser_watchdog is None:
+        return input(prompt)
+    with browser_watchdog.paused():
+        return input(prompt)
+
+def process_receipt_watched(driver, entry, actual_index):
+    """監視付きで1件の領収書を処理し、(処理に使ったドライバー, 成否) を返す"""
+    # 保存済みでスキップする領収書は所要時間の実績に含めない
+    already_saved = is_already_downloaded(entry.href)
+    started = time.time()
+    success = False
+    try:
+        with log_context(receipt_id=entry.row_id, phase="receipt"):
+            if browser_watchdog is None:
+                success = process_receipt(driver, entry, actual_index)
+            else:
+                with browser_watchdog.deadline(entry.row_id):
+                    success = process_receipt(browser_watchdog.driver, entry, actual_index)
+                browser_watchdog.after_receipt()
+                driver = browser_watchdog.driver
+    finally:
+        if progress_tracker is not None:
+            progress_tracker.attempt_done(receipt_outcome(entry, already_saved) if success else None)
+    if success and not already_saved:
+        get_phase_timings().record("receipt_issued" if entry.issued else "receipt_unissued", time.time() - started)
+    return driver, success
+
+def download_receipts_with_manual_login(client, plan_only=False, plan_output=None):
+    """手動ログインを組み込んだ領収書ダウンロード処理（対話形式のCLI、plan_only の場合は計画の表示のみ）"""
     try:
         # ログイン処理
-        if not perform_manual_login(driver):
+        if not client.login():
             print("ログインに失敗しました。処理を終了します。")
             return
+        driver = client.driver
+        
+        # 計画のみの場合は一覧ページを読むだけで終了する
+        if plan_only:
+            plan = client.plan()
+            if client.download_dir is None or manifest is None:
+                print("既存の保存先（--download-dir）がないため、保存済みの領収書は0件として計画します")
+            print_plan(plan)
+            if plan_output:
+                with open(plan_output, 'w', encoding='utf-8') as f:
+                    json.dump(plan.to_dict(), f, ensure_ascii=False, indent=2)
+                print(f"計画を保存しました: {plan_output}")
+            return
         
         # 一覧ページのURLを入力してもらう
         print("\n=== 領収書一覧ページの設定 ===")
-        print("1: デフォルトの一覧ページを使用する (https://crowdworks.jp/payments)")
+        print(f"1: デフォルトの一覧ページを使用する ({BASE_URL}/payments)")
         print("2: カスタムURLを入力する")
-        choice = input("選択してください (1/2): ")
+        choice = ask_user("選択してください (1/2): ")
         
         if choice == "2":
-            list_page_url = input("領収書一覧ページのURLを入力してください: ")
+            list_page_url = ask_user("領収書一覧ページのURLを入力してください: ")
         else:
-            list_page_url = "https://crowdworks.jp/payments?ref=login_header"
+            list_page_url = payments_page_url(1)
         
         # 一覧ページに移動
         logger.info(f"一覧ページ {list_page_url} にアクセスします")
         driver.get(list_page_url)
         wait_for_page_load(driver)
         
+        # 一覧ページをHTTPで取得する場合は、ブラウザでページを巡回しない
+        if list_source == "http":
+            listed_pages = [entries for _, entries in client.iter_pages()]
+            total_receipts = sum(len(entries) for entries in listed_pages)
+            print(f"\n合計 {len(listed_pages)} ページ、{total_receipts} 件の領収書が見つかりました")
+            # 未発行の領収書は、保存の前にHTTPでまとめて発行する
+            client.issue_pending([entry for entries in listed_pages for entry in entries])
+            process_all_pages(driver, len(listed_pages), total_receipts, listed_pages)
+            return
+        
         # 総ページ数と総領収書数を取得
         print("\n領収書の総数を計算中...")
         total_pages, total_receipts = get_total_pages_and_receipts(driver)
@@ -181,17 +2242,19 @@ def download_receipts_with_manual_login(download_dir=None, config=None):
         logger.error(traceback.format_exc())
         print("\n処理中にエラーが発生しました。詳細はログファイルを確認してください。")
     finally:
-        # ブラウザを閉じる
-        driver.quit()
-        logger.info("ブラウザを閉じました")
+        if http_cache is not None:
+            print(f"\n{http_cache.summary()}")
 
-def setup_chrome_driver():
+def setup_chrome_driver(enable_download_events=False, profile_dir=None, record_network=False):
     """ChromeDriverの設定と初期化を行う"""
     global download_dir
+    load_browser_modules()
     
     # Chromeの設定
     options = Options()
     options.add_argument("--window-size=1920,1080")
+    if profile_dir:
+        options.add_argument(f"--user-data-dir={os.path.abspath(profile_dir)}")
     
     # ダウンロード設定
     prefs = {
@@ -202,6 +2265,12 @@ def setup_chrome_driver():
     }
     options.add_experimental_option("prefs", prefs)
     
+    # ダウンロードイベントにはPageドメイン、通信の記録にはNetworkドメインのイベントをパフォーマンスログに記録
+    if enable_download_events or record_network:
+        options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+        options.add_experimental_option("perfLoggingPrefs", {"enableNetwork": record_network,
+                                                             "enablePage": enable_download_events})
+    
     # WebDriverの初期化
     service = Service(ChromeDriverManager().install())
     return webdriver.Chrome(service=service, options=options)
@@ -211,7 +2280,7 @@ def perform_manual_login(driver):
     try:
         # ログインページにアクセス
         logger.info("ログインページにアクセスしています...")
-        driver.get('https://crowdworks.jp/login')
+        driver.get(f'{BASE_URL}/login')
         
         # 手動ログインを待機
         logger.info("手動でログインしてください。マイページが表示されるまで待機します...")
@@ -247,18 +2316,18 @@ def get_total_pages_and_receipts(driver):
         total_pages = max(page_numbers) if page_numbers else 1
         
         # 現在のページの領収書数を取得
-        current_page_receipts = len(get_receipt_links(driver))
+        current_page_receipts = len(get_receipt_entries(driver))
         
         # 全ページの領収書数を推定
         # 最後のページ以外は同じ数の領収書があると仮定
         if total_pages > 1:
             # 最後のページの領収書数を取得するために一時的に移動
-            last_page_url = f"https://crowdworks.jp/payments?page={total_pages}&ref=login_header"
+            last_page_url = payments_page_url(total_pages)
             current_url = driver.current_url
             
             driver.get(last_page_url)
             wait_for_page_load(driver)
-            last_page_receipts = len(get_receipt_links(driver))
+            last_page_receipts = len(get_receipt_entries(driver))
             
             # 元のページに戻る
             driver.get(current_url)
@@ -279,18 +2348,18 @@ def get_total_pages_and_receipts(driver):
         print("\n=== ページ数と領収書数の設定 ===")
         print("自動的にページ数と領収書数を検出できませんでした。")
         try:
-            user_pages = int(input("処理する総ページ数を入力してください (不明な場合は1): ") or "1")
-            user_receipts = int(input("処理する総領収書数を入力してください (不明な場合は推定します): ") or "0")
+            user_pages = int(ask_user("処理する総ページ数を入力してください (不明な場合は1): ") or "1")
+            user_receipts = int(ask_user("処理する総領収書数を入力してください (不明な場合は推定します): ") or "0")
             
             if user_receipts <= 0:
                 # 現在のページの領収書数から推定
-                current_page_receipts = len(get_receipt_links(driver))
+                current_page_receipts = len(get_receipt_entries(driver))
                 user_receipts = current_page_receipts * user_pages
             
             return user_pages, user_receipts
         except:
             # デフォルト値
-            return 1, len(get_receipt_links(driver))
+            return 1, len(get_receipt_entries(driver))
 
 def collect_page_urls(driver):
     """全ページのURLを収集する"""
@@ -326,8 +2395,8 @@ def collect_page_urls(driver):
                 logger.info(f"{page_num}ページ目のURLを保存: {current_url}")
                 
                 # 領収書リンクの存在を確認
-                receipt_links = get_receipt_links(driver)
-                if not receipt_links:
+                entries = get_receipt_entries(driver)
+                if not entries:
                     logger.info(f"ページ {page_num} に領収書が見つかりません。URL収集を終了します。")
                     break
             else:
@@ -341,63 +2410,79 @@ def collect_page_urls(driver):
     logger.info(f"合計 {len(page_urls)} ページのURLを収集しました")
     return page_urls
 
-def process_all_pages(driver, total_pages=0, total_receipts=0):
-    """すべてのページの領収書を処理する"""
-    # まず全ページのURLを収集
-    logger.info("全ページのURLを収集します...")
-    page_urls = collect_page_urls(driver)
-    total_pages = len(page_urls)
+def process_all_pages(driver, total_pages=0, total_receipts=0, listed_pages=None):
+    """すべてのページの領収書を処理する（listed_pages を渡した場合は一覧ページをブラウザで開かない）"""
+    if listed_pages is None:
+        # まず全ページのURLを収集
+        logger.info("全ページのURLを収集します...")
+        page_sources = collect_page_urls(driver)
+    else:
+        page_sources = listed_pages
+    total_pages = len(page_sources)
     logger.info(f"収集したページ数: {total_pages}")
+    # 分割実行時は担当分の件数が事前に分からないため、ページごとに進捗を表示する
+    if shard is not None and listed_pages is None:
+        total_receipts = 0
     
     page_num = 1
     total_downloaded = 0
     current_receipt_index = 0
+    receipts_seen = 0
     max_retries = 3
+    # 一覧をHTTPで取得済みなら総件数は正確、ブラウザの場合はページネーションからの見積もり
+    progress_tracker.set_expected(total_receipts, exact=listed_pages is not None)
     
     # 収集したURLを使って各ページを処理
-    for page_url in page_urls:
+    for page_source in page_sources:
         logger.info(f"ページ {page_num}/{total_pages} の処理を開始します")
         retry_count = 0
         
         while retry_count < max_retries:
+            if browser_watchdog is not None:
+                driver = browser_watchdog.driver
             try:
-                # URLを使って直接ページに移動
-                driver.get(page_url)
-                wait_for_page_load(driver)
-                time.sleep(2)
-                
-                # ページ内の領収書を取得
-                receipt_links = get_receipt_links(driver)
-                if not receipt_links:
+                if listed_pages is None:
+                    # URLを使って直接ページに移動
+                    started = time.time()
+                    driver.get(page_source)
+                    wait_for_page_load(driver)
+                    time.sleep(2)
+                    
+                    # ページ内の領収書を取得（以降はURLで直接開くため一覧ページには戻らない）
+                    entries = get_receipt_entries(driver, page_num)
+                    get_phase_timings().record("list_page_browser", time.time() - started)
+                else:
+                    entries = page_source
+                if not entries:
                     logger.error(f"ページ {page_num} で領収書リンクが見つかりません（試行 {retry_count + 1}/{max_retries}）")
                     retry_count += 1
                     time.sleep(3)
                     continue
                 
-                page_receipts = len(receipt_links)
+                if shard is not None:
+                    entries = [entry for entry in entries if entry_in_shard(entry, shard)]
+                    logger.info(f"ページ {page_num} のうち {len(entries)} 件が担当分です（分割 {shard[0]}/{shard[1]}）")
+                page_receipts = len(entries)
                 logger.info(f"ページ {page_num} で {page_receipts} 件の領収書を検出しました")
+                receipts_seen += page_receipts
+                progress_tracker.update_estimate(page_num, total_pages, receipts_seen)
+                if render_backend == "pool":
+                    get_render_pool(driver).prefetch(entries)
                 
                 # ページ内の領収書を処理
-                for i in range(1, page_receipts + 1):
+                for i, entry in enumerate(entries, 1):
                     current_receipt_index += 1
                     
                     # 進捗表示
-                    if total_receipts > 0:
-                        display_progress(current_receipt_index, total_receipts, "領収書ダウンロード")
-                    else:
-                        display_progress(i, page_receipts, f"ページ {page_num}/{total_pages} の領収書ダウンロード")
+                    progress_tracker.display()
                     
                     # 領収書の処理
+                    progress_tracker.begin()
+                    success = False
                     receipt_retry_count = 0
                     while receipt_retry_count < max_retries:
                         try:
-                            if i > 1:
-                                # 一覧ページに戻る
-                                driver.get(page_url)
-                                wait_for_page_load(driver)
-                                time.sleep(2)
-                            
-                            success = process_receipt_by_index(driver, i, page_receipts, current_receipt_index)
+                            driver, success = process_receipt_watched(driver, entry, current_receipt_index)
                             if success:
                                 total_downloaded += 1
                                 break
@@ -406,12 +2491,16 @@ def process_all_pages(driver, total_pages=0, total_receipts=0):
                                 time.sleep(3)
                                 
                         except Exception as e:
-                            logger.error(f"領収書 {i} の処理中にエラー: {str(e)}")
+                            logger.error(f"領収書 {entry.row_id} の処理中にエラー: {str(e)}")
+                            if browser_watchdog is not None:
+                                driver = browser_watchdog.driver
                             receipt_retry_count += 1
                             if receipt_retry_count >= max_retries:
-                                if not handle_receipt_error(driver, e, i, page_num):
+                                if not handle_receipt_error(driver, e, entry.row_id, page_num):
+                                    progress_tracker.finish("failed")
                                     return total_downloaded
                             time.sleep(3)
+                    progress_tracker.finish(None if success else "failed")
                 
                 # ページの処理が成功したらループを抜ける
                 break
@@ -424,7 +2513,7 @@ def process_all_pages(driver, total_pages=0, total_receipts=0):
                     print("1: 再試行する")
                     print("2: このページをスキップして次に進む")
                     print("3: 処理を中止する")
-                    choice = input("選択してください (1/2/3): ")
+                    choice = ask_user("選択してください (1/2/3): ")
                     
                     if choice == "1":
                         retry_count = 0
@@ -438,6 +2527,12 @@ def process_all_pages(driver, total_pages=0, total_receipts=0):
         page_num += 1
     
     # 最終結果を表示
+    print()
+    print("結果: " + "、".join(f"{OUTCOME_LABELS[outcome]} {count} 件" for outcome, count in progress_tracker.counts.items())
+          + f"（再試行 {format_duration(progress_tracker.retry_seconds)}）")
+    if progress_tracker.saved_files:
+        print(f"保存容量: {progress_tracker.saved_bytes / 1024 / 1024:.1f} MB"
+              f"（1件あたり {progress_tracker.bytes_per_receipt() / 1024:.0f} KB、出力プロファイル {pdf_profile}）")
     if total_receipts > 0:
         success_rate = (total_downloaded / total_receipts) * 100
         print(f"\n処理完了: 合計 {total_downloaded}/{total_receipts} 件の領収書をダウンロードしました ({success_rate:.1f}%)")
@@ -450,7 +2545,7 @@ def process_all_pages(driver, total_pages=0, total_receipts=0):
 def go_to_page(driver, page_num):
     """指定したページ番号に直接移動する"""
     try:
-        url = f"https://crowdworks.jp/payments?page={page_num}&ref=login_header"
+        url = payments_page_url(page_num)
         logger.info(f"ページ {page_num} に直接移動します: {url}")
         
         driver.get(url)
@@ -458,9 +2553,9 @@ def go_to_page(driver, page_num):
         
         # 領収書リンクがあるか確認
         try:
-            receipt_links = get_receipt_links(driver)
-            if receipt_links:
-                logger.info(f"ページ {page_num} に {len(receipt_links)} 件の領収書が見つかりました")
+            entries = get_receipt_entries(driver)
+            if entries:
+                logger.info(f"ページ {page_num} に {len(entries)} 件の領収書が見つかりました")
                 return True
             else:
                 logger.info(f"ページ {page_num} に領収書が見つかりませんでした")
@@ -491,9 +2586,9 @@ def process_page_receipts(driver, page_num):
     """ページ内の領収書を処理する"""
     try:
         # 領収書リンクの数を取得
-        receipt_links = get_receipt_links(driver)
+        entries = get_receipt_entries(driver)
         
-        if not receipt_links:
+        if not entries:
             # デバッグ用にページのHTMLを保存
             with open(os.path.join(download_dir, f"page_source_page_{page_num}.html"), "w", encoding="utf-8") as f:
                 f.write(driver.page_source)
@@ -501,7 +2596,7 @@ def process_page_receipts(driver, page_num):
             logger.info("このページには領収書がありません。処理を終了します。")
             return 0
         
-        total_receipts = len(receipt_links)
+        total_receipts = len(entries)
         logger.info(f"ページ {page_num} で {total_receipts}件の領収書が見つかりました")
         
         # 既存のダウンロードファイル名を取得
@@ -535,244 +2630,223 @@ def process_page_receipts(driver, page_num):
     except Exception as e:
         logger.error(f"ページ {page_num} の処理中にエラーが発生: {str(e)}")
         print(f"ページ {page_num} の処理中にエラーが発生しました。続行しますか？ (y/n)")
-        if input().lower() != 'y':
+        if ask_user().lower() != 'y':
             logger.info("ユーザーにより処理が中止されました")
             return -1
         return 0
 
 def process_receipt_by_index(driver, index, total, global_index=None):
-    """インデックスを指定して領収書を処理する"""
+    """インデックスを指定して領収書を処理する（一覧ページ上の位置から領収書を特定する）"""
     # 通し番号を使用（指定されていない場合はページ内のインデックスを使用）
     actual_index = global_index if global_index is not None else index
     
-    logger.info(f"領収書 {index}/{total} (通し番号: {actual_index}) の処理を開始します")
+    entries = get_receipt_entries(driver)
+    if index > len(entries):
+        logger.error(f"インデックス {index} が領収書リンクの数 {len(entries)} を超えています")
+        return False
+    return process_receipt(driver, entries[index - 1], actual_index)
+
+def process_receipt(driver, entry, actual_index):
+    """一覧ページから取得した領収書を処理する（一覧ページに戻らず、URLで直接開く）"""
+    label = entry.row_id
+    logger.info(f"領収書 {label} (通し番号: {actual_index}) の処理を開始します")
+    # PDF保存で抽出した領収書番号と領収書データ（スクリーンショットでの代替保存に引き継ぐ）
+    extracted = {}
     
     try:
-        # 領収書リンクを新しく取得
-        current_links = WebDriverWait(driver, 10).until(
-            EC.presence_of_all_elements_located((By.XPATH, "//a[contains(text(), '領収書')]"))
-        )
+        if is_already_downloaded(entry.href):
+            # マニフェストに記録済みの領収書は開かずにスキップ
+            logger.info(f"領収書 {label} (通し番号: {actual_index}) は保存済みのためスキップします: {entry.href}")
+            return True
         
-        if index <= len(current_links):
-            # index番目の領収書リンクを取得
-            link = current_links[index-1]
+        # HTTPで発行する設定なら、ブラウザで開く前にフォームを送信して発行後のページを開く
+        page_url = entry.href
+        if issue_backend == "http" and not entry.issued:
+            if entry.href not in issued_pages:
+                with log_context(phase="issue"):
+                    issued_url = issue_receipt_http(get_http_session(driver), entry.href)
+                if issued_url:
+                    issued_pages[entry.href] = issued_url
+            page_url = issued_pages.get(entry.href, entry.href)
+        
+        # 発行済みの領収書は、HTTPで取得したHTMLを待機中のタブに流し込んで印刷する
+        if render_backend == "pool" and (entry.issued or entry.href in issued_pages):
+            with log_context(phase="render"):
+                pdf_file_name = get_render_pool(driver).render(driver, entry)
+            if pdf_file_name:
+                logger.info(f"領収書 {label} (通し番号: {actual_index}) を保存しました: {pdf_file_name}")
+                return True
+            logger.info(f"領収書 {label} (通し番号: {actual_index}) はページを開いて保存します")
+        
+        try:
+            logger.info(f"領収書 {label} (通し番号: {actual_index}) のURLに直接アクセスします: {page_url}")
+            driver.get(page_url)
+            wait_for_page_load(driver)
+            time.sleep(2)
             
-            # リンクが表示されるまでスクロール
-            driver.execute_script("arguments[0].scrollIntoView(true);", link)
+            # ヘッダーを非表示にするJavaScriptを実行
+            driver.execute_script("""
+                // ヘッダーメッセージを非表示にする
+                var headers = document.querySelectorAll('.alert, .alert-success, .notice, .message, .flash-message');
+                headers.forEach(function(header) {
+                    header.style.display = 'none';
+                });
+                
+                // 印刷用のスタイルを追加
+                var style = document.createElement('style');
+                style.innerHTML = `
+                    @media print {
+                        .alert, .alert-success, .notice, .message, .flash-message { display: none !important; }
+                        body { margin: 0; padding: 0; }
+                        * { -webkit-print-color-adjust: exact !important; }
+                    }
+                `;
+                document.head.appendChild(style);
+            """)
             time.sleep(1)
-            
-            # リンクのURLを取得して直接アクセス（より安定した方法）
-            try:
-                href = link.get_attribute("href")
-                if href:
-                    logger.info(f"領収書 {index} (通し番号: {actual_index}) のURLに直接アクセスします: {href}")
-                    driver.get(href)
-                    wait_for_page_load(driver)
-                    time.sleep(2)
-                    
-                    # ヘッダーを非表示にするJavaScriptを実行
-                    driver.execute_script("""
-                        // ヘッダーメッセージを非表示にする
-                        var headers = document.querySelectorAll('.alert, .alert-success, .notice, .message, .flash-message');
-                        headers.forEach(function(header) {
-                            header.style.display = 'none';
-                        });
-                        
-                        // 印刷用のスタイルを追加
-                        var style = document.createElement('style');
-                        style.innerHTML = `
-                            @media print {
-                                .alert, .alert-success, .notice, .message, .flash-message { display: none !important; }
-                                body { margin: 0; padding: 0; }
-                                * { -webkit-print-color-adjust: exact !important; }
-                            }
-                        `;
-                        document.head.appendChild(style);
-                    """)
-                    time.sleep(1)
-                    
-                else:
-                    # URLが取得できない場合はクリック
-                    logger.info(f"領収書 {index} (通し番号: {actual_index}) のリンクをクリックします")
-                    if not safe_click(driver, link):
-                        logger.error(f"領収書リンク {index} (通し番号: {actual_index}) のクリックに失敗しました")
-                        return False
-                    wait_for_page_load(driver)
-                    time.sleep(2)
-                    
-                    # ヘッダーを非表示にするJavaScriptを実行
-                    driver.execute_script("""
-                        // ヘッダーメッセージを非表示にする
-                        var headers = document.querySelectorAll('.alert, .alert-success, .notice, .message, .flash-message');
-                        headers.forEach(function(header) {
-                            header.style.display = 'none';
-                        });
-                        
-                        // 印刷用のスタイルを追加
-                        var style = document.createElement('style');
-                        style.innerHTML = `
-                            @media print {
-                                .alert, .alert-success, .notice, .message, .flash-message { display: none !important; }
-                                body { margin: 0; padding: 0; }
-                                * { -webkit-print-color-adjust: exact !important; }
-                            }
-                        `;
-                        document.head.appendChild(style);
-                    """)
-                    time.sleep(1)
-                    
-            except Exception as e:
-                logger.error(f"領収書 {index} (通し番号: {actual_index}) のURL取得に失敗: {str(e)}")
-                return False
+        except Exception as e:
+            logger.error(f"領収書 {label} (通し番号: {actual_index}) のページを開けませんでした: {str(e)}")
+            return False
 
-            # 既に発行済みかどうかを確認（印刷ボタンが存在するか）
-            print_button = None
-            try:
-                print_button = WebDriverWait(driver, 5).until(
-                    EC.element_to_be_clickable((By.CSS_SELECTOR, ".print_button, .cw-button_action.print_button"))
-                )
-                logger.info("印刷ボタンを見つけました。既に発行済みの領収書です。")
-            except:
-                logger.info("印刷ボタンが見つかりませんでした。未発行の領収書です。")
-            
-            # 既に発行済みの場合はPDF保存処理へ、そうでなければ発行処理へ
-            if print_button:
-                # PDFとして保存（印刷ボタンを使わない）
-                pdf_file_name = save_as_pdf(driver, actual_index)
+        # 既に発行済みかどうかを確認（印刷ボタンが存在するか）
+        print_button = None
+        try:
+            print_button = WebDriverWait(driver, 5).until(
+                EC.element_to_be_clickable((By.CSS_SELECTOR, ".print_button, .cw-button_action.print_button"))
+            )
+            logger.info("印刷ボタンを見つけました。既に発行済みの領収書です。")
+        except:
+            logger.info("印刷ボタンが見つかりませんでした。未発行の領収書です。")
+        
+        # 既に発行済みの場合はPDF保存処理へ、そうでなければ発行処理へ
+        if print_button:
+            # PDFとして保存（印刷ボタンを使わない）
+            pdf_file_name = save_as_pdf(driver, actual_index, entry.href, extracted)
+            if pdf_file_name:
+                logger.info(f"領収書 {label} (通し番号: {actual_index}) を保存しました: {pdf_file_name}")
+                return True
+            else:
+                # PDF保存に失敗した場合は代替方法を試す
+                logger.info("PDFとして保存に失敗しました。代替方法を試みます...")
+                
+                # 代替方法1: 再度PDFとして保存を試みる
+                time.sleep(2)  # 少し待機してから再試行
+                pdf_file_name = save_as_pdf(driver, actual_index, entry.href, extracted)
                 if pdf_file_name:
-                    logger.info(f"領収書 {index} (通し番号: {actual_index}) を保存しました: {pdf_file_name}")
-                    return True
-                else:
-                    # PDF保存に失敗した場合は代替方法を試す
-                    logger.info("PDFとして保存に失敗しました。代替方法を試みます...")
-                    
-                    # 代替方法1: 再度PDFとして保存を試みる
-                    time.sleep(2)  # 少し待機してから再試行
-                    pdf_file_name = save_as_pdf(driver, actual_index)
-                    if pdf_file_name:
-                        logger.info(f"再試行で領収書 {index} (通し番号: {actual_index}) を保存しました: {pdf_file_name}")
-                        return True
-                    
-                    # 代替方法2: スクリーンショットとして保存
-                    logger.info("スクリーンショットとして保存を試みます...")
-                    screenshot_path = os.path.join(download_dir, f"領収書_{actual_index:02d}.png")
-                    driver.save_screenshot(screenshot_path)
-                    logger.info(f"領収書 {index} (通し番号: {actual_index}) をスクリーンショットとして保存しました: {screenshot_path}")
+                    logger.info(f"再試行で領収書 {label} (通し番号: {actual_index}) を保存しました: {pdf_file_name}")
                     return True
-            else:
-                # 未発行の領収書の場合、発行ボタンを探して処理
-                try:
-                    # まず「プレビューで内容を確認する」ボタンを探す
-                    preview_button = None
-                    try:
-                        preview_button = WebDriverWait(driver, 5).until(
-                            EC.element_to_be_clickable((By.XPATH, "//input[@value='プレビューで内容を確認する'] | //button[contains(text(), 'プレビューで内容を確認する')]"))
-                        )
-                        logger.info("「プレビューで内容を確認する」ボタンを見つけました。クリックします。")
-                        
-                        if safe_click(driver, preview_button):
-                            wait_for_page_load(driver)
-                            time.sleep(2)
-                            # プレビュー画面でヘッダーを非表示に
-                            hide_header_elements(driver)
-                            logger.info("プレビュー画面に移動しました。")
-                    except Exception as e:
-                        logger.info(f"「プレビューで内容を確認する」ボタンが見つからないか、クリックに失敗しました: {str(e)}")
-                        logger.info("プレビュー画面をスキップして発行処理を続行します。")
-                    
-                    # 次に「この内容で発行する」ボタンを探す
-                    issue_button = WebDriverWait(driver, 5).until(
-                        EC.element_to_be_clickable((By.XPATH, "//input[@value='この内容で発行する'] | //button[contains(text(), 'この内容で発行する')]"))
+                
+                # 代替方法2: スクリーンショットとして保存
+                save_screenshot_fallback(driver, label, entry.href, **extracted)
+                return True
+        else:
+            # 未発行の領収書の場合、発行ボタンを探して処理
+            try:
+                # まず「プレビューで内容を確認する」ボタンを探す
+                preview_button = None
+                try:
+                    preview_button = WebDriverWait(driver, 5).until(
+                        EC.element_to_be_clickable((By.XPATH, "//input[@value='プレビューで内容を確認する'] | //button[contains(text(), 'プレビューで内容を確認する')]"))
                     )
-                    logger.info("「この内容で発行する」ボタンを見つけました。クリックします。")
+                    logger.info("「プレビューで内容を確認する」ボタンを見つけました。クリックします。")
                     
-                    if safe_click(driver, issue_button):
+                    if safe_click(driver, preview_button):
                         wait_for_page_load(driver)
                         time.sleep(2)
-                        # 発行直後にヘッダーを非表示に
+                        # プレビュー画面でヘッダーを非表示に
                         hide_header_elements(driver)
+                        logger.info("プレビュー画面に移動しました。")
+                except Exception as e:
+                    logger.info(f"「プレビューで内容を確認する」ボタンが見つからないか、クリックに失敗しました: {str(e)}")
+                    logger.info("プレビュー画面をスキップして発行処理を続行します。")
+                
+                # 次に「この内容で発行する」ボタンを探す
+                issue_button = WebDriverWait(driver, 5).until(
+                    EC.element_to_be_clickable((By.XPATH, "//input[@value='この内容で発行する'] | //button[contains(text(), 'この内容で発行する')]"))
+                )
+                logger.info("「この内容で発行する」ボタンを見つけました。クリックします。")
+                
+                if safe_click(driver, issue_button):
+                    wait_for_page_load(driver)
+                    time.sleep(2)
+                    # 発行直後にヘッダーを非表示に
+                    hide_header_elements(driver)
+                    
+                    # 確認ダイアログの「はい」ボタンを探して処理
+                    try:
+                        yes_button = WebDriverWait(driver, 5).until(
+                            EC.element_to_be_clickable((By.XPATH, "//button[contains(text(), 'はい')] | //input[@value='はい'] | //a[contains(text(), 'はい')] | //div[contains(@class, 'dialog')]//button[1]"))
+                        )
+                        logger.info("確認ダイアログの「はい」ボタンを見つけました。クリックします。")
                         
-                        # 確認ダイアログの「はい」ボタンを探して処理
-                        try:
-                            yes_button = WebDriverWait(driver, 5).until(
-                                EC.element_to_be_clickable((By.XPATH, "//button[contains(text(), 'はい')] | //input[@value='はい'] | //a[contains(text(), 'はい')] | //div[contains(@class, 'dialog')]//button[1]"))
-                            )
-                            logger.info("確認ダイアログの「はい」ボタンを見つけました。クリックします。")
+                        if safe_click(driver, yes_button):
+                            wait_for_page_load(driver)
+                            time.sleep(3)
+                            # 発行完了後にもヘッダーを非表示に
+                            hide_header_elements(driver)
                             
-                            if safe_click(driver, yes_button):
-                                wait_for_page_load(driver)
-                                time.sleep(3)
-                                # 発行完了後にもヘッダーを非表示に
-                                hide_header_elements(driver)
-                                
-                                # 発行後のページをPDFとして保存
-                                pdf_file_name = save_as_pdf(driver, actual_index)
-                                if pdf_file_name:
-                                    logger.info(f"領収書 {index} を保存しました: {pdf_file_name}")
-                                    return True
-                                else:
-                                    # PDF保存に失敗した場合はスクリーンショットを取る
-                                    logger.info("PDFとして保存に失敗しました。スクリーンショットを取ります...")
-                                    screenshot_path = os.path.join(download_dir, f"領収書_{actual_index:02d}.png")
-                                    driver.save_screenshot(screenshot_path)
-                                    logger.info(f"領収書 {index} をスクリーンショットとして保存しました: {screenshot_path}")
-                                    return True
-                        except Exception as e:
-                            logger.error(f"確認ダイアログの「はい」ボタン処理中にエラー: {str(e)}")
-                            # JavaScriptでの処理を試みる
-                            try:
-                                driver.execute_script("""
-                                    // 確認ダイアログの「はい」ボタンを探して自動的にクリック
-                                    var yesButtons = document.querySelectorAll('button, input[type="button"], input[type="submit"], a.button');
-                                    for (var i = 0; i < yesButtons.length; i++) {
-                                        var btn = yesButtons[i];
-                                        if (btn.textContent.includes('はい') || btn.value === 'はい') {
-                                            btn.click();
-                                            return true;
-                                        }
-                                    }
-                                    // 最初のボタンをクリック（多くの場合「はい」が最初）
-                                    var firstButton = document.querySelector('.dialog button, .modal button, .confirm button');
-                                    if (firstButton) {
-                                        firstButton.click();
+                            # 発行後のページをPDFとして保存
+                            pdf_file_name = save_as_pdf(driver, actual_index, entry.href, extracted)
+                            if pdf_file_name:
+                                logger.info(f"領収書 {label} を保存しました: {pdf_file_name}")
+                                return True
+                            else:
+                                # PDF保存に失敗した場合はスクリーンショットを取る
+                                save_screenshot_fallback(driver, label, entry.href, **extracted)
+                                return True
+                    except Exception as e:
+                        logger.error(f"確認ダイアログの「はい」ボタン処理中にエラー: {str(e)}")
+                        # JavaScriptでの処理を試みる
+                        try:
+                            driver.execute_script("""
+                                // 確認ダイアログの「はい」ボタンを探して自動的にクリック
+                                var yesButtons = document.querySelectorAll('button, input[type="button"], input[type="submit"], a.button');
+                                for (var i = 0; i < yesButtons.length; i++) {
+                                    var btn = yesButtons[i];
+                                    if (btn.textContent.includes('はい') || btn.value === 'はい') {
+                                        btn.click();
                                         return true;
                                     }
-                                    return false;
-                                """)
-                                time.sleep(3)
-                                # JavaScript実行後にもヘッダーを非表示に
-                                hide_header_elements(driver)
-                            except Exception as js_error:
-                                logger.error(f"JavaScriptによる確認ダイアログ処理に失敗: {str(js_error)}")
+                                }
+                                // 最初のボタンをクリック（多くの場合「はい」が最初）
+                                var firstButton = document.querySelector('.dialog button, .modal button, .confirm button');
+                                if (firstButton) {
+                                    firstButton.click();
+                                    return true;
+                                }
+                                return false;
+                            """)
+                            time.sleep(3)
+                            # JavaScript実行後にもヘッダーを非表示に
+                            hide_header_elements(driver)
+                        except Exception as js_error:
+                            logger.error(f"JavaScriptによる確認ダイアログ処理に失敗: {str(js_error)}")
 
-                        # 発行完了後の最終確認としてヘッダーを非表示に
-                        hide_header_elements(driver)
-                        
-                        # 発行後のページをPDFとして保存
-                        pdf_file_name = save_as_pdf(driver, actual_index)
-                        if pdf_file_name:
-                            logger.info(f"領収書 {index} を保存しました: {pdf_file_name}")
-                            return True
-                        else:
-                            # PDF保存に失敗した場合はスクリーンショットを取る
-                            logger.info("PDFとして保存に失敗しました。スクリーンショットを取ります...")
-                            screenshot_path = os.path.join(download_dir, f"領収書_{actual_index:02d}.png")
-                            driver.save_screenshot(screenshot_path)
-                            logger.info(f"領収書 {index} をスクリーンショットとして保存しました: {screenshot_path}")
-                            return True
-                except Exception as e:
-                    logger.error(f"発行ボタンの処理中にエラー: {str(e)}")
-            
-            # 手動操作を求める
-            print("\n=== 自動処理に失敗しました ===")
-            print("手動で領収書を発行・保存してください。")
-            input("操作が完了したら、Enterキーを押して続行してください...")
-            return True
-        else:
-            logger.error(f"インデックス {index} が領収書リンクの数 {len(current_links)} を超えています")
+                    # 発行完了後の最終確認としてヘッダーを非表示に
+                    hide_header_elements(driver)
+                    
+                    # 発行後のページをPDFとして保存
+                    pdf_file_name = save_as_pdf(driver, actual_index, entry.href, extracted)
+                    if pdf_file_name:
+                        logger.info(f"領収書 {label} を保存しました: {pdf_file_name}")
+                        return True
+                    else:
+                        # PDF保存に失敗した場合はスクリーンショットを取る
+                        save_screenshot_fallback(driver, label, entry.href, **extracted)
+                        return True
+            except Exception as e:
+                logger.error(f"発行ボタンの処理中にエラー: {str(e)}")
+        
+        # 手動操作を求める（対話しない場合は失敗として返す）
+        if not interactive:
+            logger.error(f"領収書 {label} (通し番号: {actual_index}) を自動で保存できませんでした")
             return False
+        print("\n=== 自動処理に失敗しました ===")
+        print("手動で領収書を発行・保存してください。")
+        ask_user("操作が完了したら、Enterキーを押して続行してください...")
+        return True
     except Exception as e:
-        logger.error(f"領収書 {index} (通し番号: {actual_index}) の処理中にエラー: {str(e)}")
+        logger.error(f"領収書 {label} (通し番号: {actual_index}) の処理中にエラー: {str(e)}")
         raise
     
     return False
@@ -783,7 +2857,7 @@ def handle_navigation_error(driver, index, page_num):
     print("1: 再試行する")
     print("2: この領収書をスキップして次に進む")
     print("3: 処理を中止する")
-    choice = input("選択してください (1/2/3): ")
+    choice = ask_user("選択してください (1/2/3): ")
     
     if choice == "1":
         # 再試行
@@ -797,315 +2871,1473 @@ def handle_navigation_error(driver, index, page_num):
         logger.info("ユーザーがスキップを選択しました")
         return True
 
-def get_receipt_links(driver):
-    """ページ内の領収書リンクを取得する（請求書を除外）"""
-    try:
-        # 領収書リンクを探す（テキストが完全に「領収書」のみのリンク）
-        receipt_links = WebDriverWait(driver, 10).until(
-            EC.presence_of_all_elements_located((By.XPATH, "//a[text()='領収書']"))
-        )
-        
-        # 念のため、「請求書」を含まないことを確認
-        filtered_links = []
-        for link in receipt_links:
-            text = link.text.strip()
-            if text == '領収書' and '請求書' not in text:
-                filtered_links.append(link)
-        
-        logger.info(f"テキストで {len(filtered_links)} 件の領収書リンクを見つかりました（請求書を除外）")
-        return filtered_links
-    except Exception as e:
-        # 代替方法：より緩いXPathで検索し、テキストで絞り込む
-        try:
-            all_links = driver.find_elements(By.XPATH, "//a[contains(text(), '領収書')]")
-            filtered_links = []
-            
-            for link in all_links:
-                text = link.text.strip()
-                if text == '領収書' and '請求書' not in text:
-                    filtered_links.append(link)
-            
-            logger.info(f"代替方法で {len(filtered_links)} 件の領収書リンクを見つかりました（請求書を除外）")
-            return filtered_links
-        except Exception as e2:
-            logger.error(f"領収書リンクの取得に失敗: {str(e)} / {str(e2)}")
-            return []
+@dataclass
+class ReceiptListEntry:
+    """支払一覧ページの領収書1件（WebElementを持たず、ページ遷移後も使える）"""
+    href: str
+    row_id: str
+    date: str = None
+    amount: int = None
+    issued: bool = False
+    page: int = None
+
+def build_list_entry(href, row_id=None, row_text="", page=None):
+    """一覧ページの行の情報から領収書エントリを作成する"""
+    # URLのIDを優先し、なければ行のID、それもなければURLと行の内容から作る
+    stable_id = receipt_key_from_url(href) or row_id or hashlib.sha1(
+        (href + row_text).encode("utf-8")).hexdigest()[:12]
+    amount_match = re.search(r'[¥￥]\s*[\d,]+|[\d,]+\s*円', row_text)
+    return ReceiptListEntry(
+        href=href,
+        row_id=str(stable_id),
+        date=normalize_date(row_text),
+        amount=parse_amount(amount_match.group()) if amount_match else None,
+        # 未発行の領収書は発行フォーム（/receipt_sheets/new）へのリンクになっている
+        issued='/receipt_sheets/new' not in href,
+        page=page
+    )
+
+# 分割実行の担当（K, N）。指定時はN分割したうちK番目の領収書だけを処理する
+shard = None
+
+def parse_shard(text):
+    """「K/N」形式の分割指定を (K, N) に変換する（Kは1から数える）"""
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', text or '')
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError(f"分割の指定は 1/3 のように「K/N」（1 <= K <= N）で指定してください: {text}")
+    return int(match.group(1)), int(match.group(2))
+
+def shard_directory_name(shard_spec):
+    return f"shard-{shard_spec[0]}-of-{shard_spec[1]}"
+
+def entry_in_shard(entry, shard_spec):
+    """領収書エントリが担当分か判定する（実行環境によらず同じ結果になるよう、IDのハッシュで振り分ける）"""
+    if shard_spec is None:
+        return True
+    index, count = shard_spec
+    digest = hashlib.sha1(entry.row_id.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count == index - 1
+
+# 一覧ページの領収書リンクと、その行の情報を1回のスクリプト実行でまとめて取得する
+RECEIPT_LIST_SCRIPT = """
+    var rows = [];
+    document.querySelectorAll('a').forEach(function(a) {
+        if ((a.textContent || '').trim() !== '領収書' || !a.href) { return; }
+        var row = a.closest('tr, li, [class*="row"], [class*="item"], [class*="payment"]') || a.parentElement;
+        rows.push({
+            href: a.href,
+            row_id: row.id || row.getAttribute('data-id') || '',
+            row_text: row.innerText || ''
+        });
+    });
+    return rows;
+"""
+
+# 行とみなす要素（この中の領収書リンクに行の日付と金額を対応付ける）
+LIST_ROW_TAGS = ("tr", "li")
+LIST_ROW_CLASS_WORDS = ("row", "item", "payment")
+VOID_TAGS = ("br", "img", "input", "meta", "link", "hr", "wbr", "source", "area", "base", "col", "embed")
+
+class PaymentListParser(HTMLParser):
+    """支払一覧ページのHTMLから領収書リンクと行の情報を取り出す"""
+
+    def __init__(self, base_url):
+        super().__init__(convert_charrefs=True)
+        self.base_url = base_url
+        self.stack = []
+        self.rows = []
+
+    def _is_row(self, tag, attrs):
+        class_name = attrs.get("class") or ""
+        return tag in LIST_ROW_TAGS or any(word in class_name for word in LIST_ROW_CLASS_WORDS)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_TAGS:
+            return
+        attrs = dict(attrs)
+        self.stack.append({"tag": tag, "attrs": attrs, "text": [], "links": [],
+                           "row": self._is_row(tag, attrs)})
+
+    def handle_data(self, data):
+        if self.stack:
+            self.stack[-1]["text"].append(data)
+
+    def handle_endtag(self, tag):
+        # 閉じタグが省略された要素も含めて、対応する要素まで閉じる
+        if not any(frame["tag"] == tag for frame in self.stack):
+            return
+        while self.stack:
+            frame = self.stack.pop()
+            self._close(frame)
+            if frame["tag"] == tag:
+                break
+
+    def _close(self, frame):
+        text = "".join(frame["text"])
+        links = frame["links"]
+        if frame["tag"] == "a" and text.strip() == "領収書" and frame["attrs"].get("href"):
+            links = links + [urljoin(self.base_url, frame["attrs"]["href"])]
+        parent = self.stack[-1] if self.stack else None
+        if links and (frame["row"] or parent is None):
+            row_id = frame["attrs"].get("id") or frame["attrs"].get("data-id") or ""
+            for href in links:
+                self.rows.append({"href": href, "row_id": row_id, "row_text": text})
+            links = []
+        if parent is not None:
+            parent["text"].append(" " + text + " ")
+            parent["links"].extend(links)
+
+    def close(self):
+        super().close()
+        while self.stack:
+            self._close(self.stack.pop())
+
+def parse_payment_list_html(html, base_url=BASE_URL, page=None):
+    """支払一覧ページのHTMLから領収書エントリの一覧を作成する"""
+    parser = PaymentListParser(base_url)
+    parser.feed(html)
+    parser.close()
+    return [build_list_entry(row["href"], row["row_id"], row["row_text"], page) for row in parser.rows]
+
+def get_receipt_entries(driver, page=None):
+    """現在の一覧ページから領収書エントリの一覧を取得する"""
+    # 一覧の表示が遅い場合に0件と判断しないよう、領収書リンクが現れるまで待つ（最終ページより先は現れない）
+    try:
+        WebDriverWait(driver, 10).until(
+            EC.presence_of_all_elements_located((By.XPATH, "//a[normalize-space(text())='領収書']")))
+    except Exception:
+        logger.debug("領収書リンクが表示されませんでした: %s", driver.current_url)
+    
+    def from_script():
+        rows = driver.execute_script(RECEIPT_LIST_SCRIPT)
+        return [build_list_entry(row["href"], row["row_id"], row["row_text"], page) for row in rows or []]
+    
+    method, entries = get_selector_registry().run('receipt_entries', [
+        ('スクリプト', from_script),
+        ('HTML解析', lambda: parse_payment_list_html(driver.page_source, driver.current_url, page))
+    ])
+    entries = entries or []
+    logger.info(f"{method or '全方法'}で {len(entries)} 件の領収書を見つけました")
+    return entries
+
+# 印刷時に通知やメッセージを隠し、余白を詰めるスタイル
+RECEIPT_PRINT_CSS = """
+    @media print {
+        .alert, .alert-success, .alert-info, .alert-warning, .alert-danger,
+        .notice, .message, .flash-message, .header-message, .notification,
+        .status-message, div[role="alert"], .toast, .banner,
+        .info-message, .success-message, .warning-message, .error-message,
+        .flash, .flash-notice, .flash-success, .flash-error,
+        .message-container, .message-box, .notification-container,
+        .close-button, .close-icon, button.close,
+        div[class*="alert"], div[class*="notice"], div[class*="message"],
+        div[class*="notification"], div[class*="toast"],
+        div[class*="info"], div[class*="success"], div[class*="warning"], div[class*="error"],
+        i[class*="info"], i[class*="close"],
+        svg[class*="info"], svg[class*="close"],
+        span[class*="info"], span[class*="close"],
+        button[class*="close"], a[class*="close"] {
+            display: none !important;
+            visibility: hidden !important;
+            opacity: 0 !important;
+            height: 0 !important;
+            width: 0 !important;
+            overflow: hidden !important;
+            position: absolute !important;
+            top: -9999px !important;
+            left: -9999px !important;
+        }
+        
+        body { 
+            margin: 0 !important; 
+            padding: 0 !important;
+            -webkit-print-color-adjust: exact !important;
+            color-adjust: exact !important;
+        }
+        
+        /* 余分な余白を削除 */
+        * { 
+            margin-top: 0 !important;
+            padding-top: 0 !important;
+        }
+        
+        /* 最初のコンテンツ要素の上部余白を削除 */
+        body > *:first-child {
+            margin-top: 0 !important;
+            padding-top: 0 !important;
+        }
+    }
+"""
+
+# 通知やメッセージの要素を非表示にするスクリプト（引数に印刷用スタイルを渡すと追加する）
+HIDE_HEADER_SCRIPT = """
+    // すべての通知、アラート、メッセージ要素を非表示にする
+    var elementsToHide = document.querySelectorAll(
+        '.alert, .alert-success, .alert-info, .alert-warning, .alert-danger, ' +
+        '.notice, .message, .flash-message, .header-message, .notification, ' +
+        '.status-message, div[role="alert"], .toast, .banner, ' +
+        '.info-message, .success-message, .warning-message, .error-message, ' +
+        '.flash, .flash-notice, .flash-success, .flash-error, ' +
+        '.message-container, .message-box, .notification-container, ' +
+        '.close-button, .close-icon, button.close, ' +
+        'div[class*="alert"], div[class*="notice"], div[class*="message"], ' +
+        'div[class*="notification"], div[class*="toast"], ' +
+        'div[class*="info"], div[class*="success"], div[class*="warning"], div[class*="error"]'
+    );
+    
+    // すべての要素を非表示に
+    elementsToHide.forEach(function(element) {
+        element.style.display = 'none';
+        element.style.visibility = 'hidden';
+        element.style.opacity = '0';
+        element.style.height = '0';
+        element.style.overflow = 'hidden';
+        element.setAttribute('aria-hidden', 'true');
+    });
+    
+    // インフォメーションアイコンと閉じるボタンを探して非表示に
+    var icons = document.querySelectorAll(
+        'i[class*="info"], i[class*="close"], ' +
+        'svg[class*="info"], svg[class*="close"], ' +
+        'span[class*="info"], span[class*="close"], ' +
+        'button[class*="close"], a[class*="close"]'
+    );
+    
+    icons.forEach(function(icon) {
+        icon.style.display = 'none';
+        icon.style.visibility = 'hidden';
+    });
+    
+    // 印刷用のスタイルを追加（より強力なバージョン）
+    // 同じページで何度呼んでも要素が増えないよう、追加済みのスタイルがあれば書き換える
+    if (arguments[0]) {
+        var style = document.getElementById('receipt-print-style');
+        if (!style) {
+            style = document.createElement('style');
+            style.id = 'receipt-print-style';
+            document.head.appendChild(style);
+        }
+        style.innerHTML = arguments[0];
+    }
+    
+    // 余分な余白を削除
+    document.body.style.margin = '0';
+    document.body.style.padding = '0';
+    
+    // 特定のサイト向けのカスタム処理
+    // CrowdWorks特有の要素を探して非表示に
+    var cwSpecificElements = document.querySelectorAll(
+        '.cw-alert, .cw-notice, .cw-message, .cw-flash, ' +
+        '.cw-header-message, .cw-notification, ' +
+        '.receipt-header, .receipt-notice, ' +
+        'div[class*="cw-alert"], div[class*="cw-notice"], div[class*="cw-message"]'
+    );
+    
+    cwSpecificElements.forEach(function(element) {
+        element.style.display = 'none';
+        element.style.visibility = 'hidden';
+    });
+    
+    // 最上部の要素を探して、それが通知系の場合は非表示に
+    var topElements = Array.from(document.body.children).slice(0, 3);
+    topElements.forEach(function(element) {
+        var text = element.textContent.toLowerCase();
+        if (text.includes('発行しました') || 
+            text.includes('完了') || 
+            text.includes('成功') || 
+            text.includes('通知') ||
+            text.includes('メッセージ')) {
+            element.style.display = 'none';
+            element.style.visibility = 'hidden';
+        }
+    });
+    
+    return true;
+"""
+
+def hide_header_elements(driver):
+    """ヘッダー要素を非表示にする共通処理（強化版）"""
+    try:
+        # より広範囲のヘッダー要素を非表示にするJavaScriptを実行
+        driver.execute_script(HIDE_HEADER_SCRIPT, RECEIPT_PRINT_CSS)
+        
+        # DOMの更新を待つ
+        time.sleep(1)
+        logger.info("ヘッダー要素を非表示にしました（強化版）")
+        return True
+    except Exception as e:
+        logger.error(f"ヘッダー要素の非表示化に失敗: {str(e)}")
+        return False
+
+# ページの内容を1回のスクリプト実行でまとめて取得する
+PAGE_SNAPSHOT_SCRIPT = """
+    var text = function(el) { return el ? (el.innerText || el.textContent || '').trim() : ''; };
+    var pairs = [];
+    // ラベルと値の組（th/td、dt/dd、ラベル要素と次の要素）
+    document.querySelectorAll('th, dt, td, label, div, span').forEach(function(el) {
+        if (el.children.length > 2) { return; }
+        var label = text(el);
+        if (!label || label.length > 30) { return; }
+        var next = el.nextElementSibling;
+        if (!next && el.parentElement) { next = el.parentElement.nextElementSibling; }
+        var value = text(next);
+        if (value && value.length <= 200) { pairs.push([label, value]); }
+    });
+    var headers = Array.from(document.querySelectorAll('th')).map(text);
+    var rows = Array.from(document.querySelectorAll('tr')).map(function(tr) {
+        return Array.from(tr.querySelectorAll('td')).map(text);
+    }).filter(function(cells) { return cells.length > 0; });
+    return {
+        url: location.href,
+        title: document.title,
+        text: document.body ? document.body.innerText : '',
+        pairs: pairs,
+        headers: headers,
+        rows: rows
+    };
+"""
+
+def capture_page_snapshot(driver):
+    """現在のページのテキストと表構造を1回で取得する（以降の抽出はこのスナップショットのみを使う）"""
+    try:
+        snapshot = driver.execute_script(PAGE_SNAPSHOT_SCRIPT)
+    except Exception as e:
+        logger.warning(f"ページのスナップショット取得に失敗: {str(e)}")
+        snapshot = None
+    if not snapshot:
+        snapshot = {"url": driver.current_url, "title": "", "text": "", "pairs": [], "headers": [], "rows": []}
+    return snapshot
+
+def find_labeled_value(snapshot, labels):
+    """スナップショットからラベルに対応する値を探す"""
+    for label, value in snapshot.get("pairs", []):
+        if any(name in label for name in labels):
+            return value
+    # 「ラベル：値」形式の行から探す
+    for name in labels:
+        match = re.search(re.escape(name) + r'[^\S\n]*[：:]?[^\S\n]*([^\n]+)', snapshot.get("text", ""))
+        if match:
+            return match.group(1).strip()
+    return None
+
+def normalize_date(text):
+    """日付文字列を YYYY-MM-DD 形式に変換する"""
+    if not text:
+        return None
+    match = re.search(r'(\d{4})\s*[年/.-]\s*(\d{1,2})\s*[月/.-]\s*(\d{1,2})', text)
+    if not match:
+        return None
+    return "{}-{:02d}-{:02d}".format(*(int(x) for x in match.groups()))
+
+def parse_amount(text):
+    """金額文字列を整数に変換する"""
+    if not text:
+        return None
+    match = re.search(r'[¥￥]\s*([\d,]+)|([\d,]+)\s*円', text) or re.search(r'(\d[\d,]*)', text)
+    if not match:
+        return None
+    digits = next(group for group in match.groups() if group).replace(",", "")
+    return int(digits) if digits else None
+
+@dataclass
+class ReceiptRecord:
+    """領収書から抽出した構造化データ"""
+    receipt_number: str = None
+    issue_date: str = None
+    payment_date: str = None
+    amount: int = None
+    tax: int = None
+    counterparty: str = None
+    source_url: str = None
+    file: str = None
+    # 検索索引用のページ本文（CSV/JSON Linesには出力しない）
+    page_text: str = field(default=None, repr=False, metadata={"export": False})
+
+def extract_receipt_record(snapshot, receipt_number=None):
+    """スナップショットから領収書の構造化データを抽出する"""
+    text = snapshot.get("text", "")
+    record = ReceiptRecord(receipt_number=receipt_number, source_url=snapshot.get("url"), page_text=text)
+    
+    record.issue_date = normalize_date(find_labeled_value(snapshot, ["発行日", "領収日"]))
+    record.payment_date = normalize_date(find_labeled_value(snapshot, ["お支払日", "支払日", "入金日", "決済日", "支払い日"]))
+    if not record.issue_date and not record.payment_date:
+        # ラベルがない場合は本文中の最初の日付を使う
+        record.issue_date = normalize_date(text)
+    
+    record.amount = parse_amount(find_labeled_value(snapshot, ["領収金額", "合計金額", "お支払金額", "支払金額", "金額", "合計"]))
+    if record.amount is None:
+        match = re.search(r'[¥￥]\s*[\d,]+', text)
+        if match:
+            record.amount = parse_amount(match.group())
+    record.tax = parse_amount(find_labeled_value(snapshot, ["うち消費税", "消費税", "税額"]))
+    
+    counterparty = find_labeled_value(snapshot, ["宛名", "宛先", "取引先", "クライアント", "発注者"])
+    if not counterparty:
+        match = re.search(r'^\s*(.+?)\s*(様|御中)\s*$', text, re.MULTILINE)
+        if match:
+            counterparty = match.group(1)
+    record.counterparty = counterparty.strip()[:100] if counterparty else None
+    return record
+
+def number_from_labels(snapshot):
+    """方法1: 「領収書番号」または「請求書番号」というラベルを探す"""
+    for label, value in snapshot.get("pairs", []):
+        if '領収書番号' in label or '請求書番号' in label:
+            match = re.search(r'[0-9A-Z-]+', value) or re.search(r'[：:]\s*([0-9A-Z-]+)', label)
+            if match:
+                return match.group(match.lastindex or 0)
+    return None
+
+def number_from_table_headers(snapshot):
+    """方法2: 「番号」「No」の列見出しに対応するセルを探す"""
+    for header_index, header in enumerate(snapshot.get("headers", [])):
+        if '番号' in header or 'No' in header:
+            for cells in snapshot.get("rows", []):
+                if len(cells) > header_index and re.search(r'[A-Z0-9-]+', cells[header_index]):
+                    return re.search(r'[A-Z0-9-]+', cells[header_index]).group()
+    return None
+
+def number_from_table_cells(snapshot):
+    """方法3: 一般的なテーブルセルから番号らしい値を探す"""
+    for cells in snapshot.get("rows", []):
+        for cell_text in cells:
+            # 数字とハイフンのパターンを探す (例: R-12345678, CW-123456)
+            if re.search(r'[A-Z]-\d+', cell_text) or re.search(r'\d{5,}', cell_text) or re.search(r'CW-\d+', cell_text):
+                return cell_text
+    return None
+
+def number_from_text_patterns(snapshot):
+    """方法4: ページ全体から領収書/請求書番号のパターンを探す"""
+    page_text = snapshot.get("text", "")
+    patterns = [
+        r'領収書番号[：:]\s*([A-Z0-9-]+)',
+        r'請求書番号[：:]\s*([A-Z0-9-]+)',
+        r'領収書[：:]\s*([A-Z0-9-]+)',
+        r'請求書[：:]\s*([A-Z0-9-]+)',
+        r'受領書番号[：:]\s*([A-Z0-9-]+)',
+        r'No[.：:]\s*([A-Z0-9-]+)',
+        r'番号[：:]\s*([A-Z0-9-]+)',
+        r'CW-(\d+)',
+        r'[A-Z]-(\d{5,})'
+    ]
+    for pattern in patterns:
+        match = re.search(pattern, page_text)
+        if match:
+            return match.group(1)
+    return None
+
+def number_from_url(snapshot):
+    """方法5: URLから数字の部分を抽出する"""
+    current_url = snapshot.get("url") or ""
+    url_match = re.search(r'receipt[s]?/(\d+)', current_url) or re.search(r'invoice[s]?/(\d+)', current_url)
+    return url_match.group(1) if url_match else None
+
+def extract_receipt_number(driver, snapshot=None):
+    """ページから領収書番号または請求書番号を抽出する"""
+    try:
+        if snapshot is None:
+            snapshot = capture_page_snapshot(driver)
+        
+        # 確実な抽出方法から順に試す（番号はファイル名と重複判定に使うため、順序は固定）
+        method, receipt_number = get_selector_registry().run('receipt_number', [
+            ('ラベル方式', lambda: number_from_labels(snapshot)),
+            ('テーブルヘッダー方式', lambda: number_from_table_headers(snapshot)),
+            ('テーブルセル方式', lambda: number_from_table_cells(snapshot)),
+            ('パターン方式', lambda: number_from_text_patterns(snapshot)),
+            ('URL方式', lambda: number_from_url(snapshot))
+        ], reorder=False)
+        
+        # 無効な文字を削除
+        if receipt_number:
+            logger.info(f"番号を見つけました（{method}）: {receipt_number}")
+            receipt_number = re.sub(r'[\\/:*?"<>|]', '', receipt_number)
+            # 長すぎる場合は短くする
+            if len(receipt_number) > 20:
+                receipt_number = receipt_number[:20]
+        
+        return receipt_number
+    except Exception as e:
+        logger.error(f"番号の抽出中にエラー: {str(e)}")
+        return None
+
+METADATA_FIELDS = [f.name for f in fields(ReceiptRecord) if f.metadata.get("export", True)]
+
+class MetadataExporter:
+    """領収書の構造化データをCSV/JSON Linesに逐次書き出す"""
+
+    def __init__(self, directory, formats=("csv", "jsonl")):
+        self.csv_file = None
+        self.jsonl_file = None
+        if "csv" in formats:
+            csv_path = os.path.join(directory, "receipts.csv")
+            is_new = not os.path.exists(csv_path)
+            # Excelで開けるようにBOM付きUTF-8で書き出す
+            self.csv_file = open(csv_path, "a", encoding="utf-8-sig" if is_new else "utf-8", newline="")
+            self.csv_writer = csv.DictWriter(self.csv_file, fieldnames=METADATA_FIELDS)
+            if is_new:
+                self.csv_writer.writeheader()
+        if "jsonl" in formats:
+            self.jsonl_file = open(os.path.join(directory, "receipts.jsonl"), "a", encoding="utf-8")
+
+    def on_receipt_saved(self, entry, data, record):
+        if record is None:
+            return
+        row = {name: getattr(record, name) for name in METADATA_FIELDS}
+        if self.csv_file:
+            self.csv_writer.writerow(row)
+            self.csv_file.flush()
+        if self.jsonl_file:
+            self.jsonl_file.write(json.dumps(row, ensure_ascii=False) + "\n")
+            self.jsonl_file.flush()
+
+    def close(self):
+        for f in (self.csv_file, self.jsonl_file):
+            if f:
+                f.close()
+
+# 検索索引の既定の保存先（receipts_* フォルダと同じ場所に置き、複数回の実行分をまとめて検索する）
+DEFAULT_INDEX_PATH = "receipt_index.sqlite"
+
+class ReceiptSearchIndex:
+    """領収書の本文とメタデータの全文検索索引（SQLite FTS5）"""
+
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        self.path = os.path.abspath(path)
+        # スクリーンショットの代替保存は別スレッドで索引に追加する（書き込みは store_lock で直列化される）
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS receipts (
+                id INTEGER PRIMARY KEY,
+                sha256 TEXT UNIQUE,
+                receipt_key TEXT,
+                receipt_number TEXT,
+                issue_date TEXT,
+                payment_date TEXT,
+                amount INTEGER,
+                tax INTEGER,
+                counterparty TEXT,
+                file TEXT,
+                directory TEXT,
+                source_url TEXT,
+                indexed_at TEXT
+            );
+            CREATE INDEX IF NOT EXISTS receipts_payment_date ON receipts(payment_date);
+            -- 日本語は単語区切りがないため、部分一致できるtrigramで分割する
+            CREATE VIRTUAL TABLE IF NOT EXISTS receipts_fts USING fts5(
+                receipt_number, counterparty, text, tokenize='trigram'
+            );
+        """)
+
+    def on_receipt_saved(self, entry, data, record):
+        if record is None:
+            return
+        self.add(entry, record, download_dir)
+
+    def add(self, entry, record, directory):
+        """領収書を索引に追加する（同じ内容のものは上書き）"""
+        with self.connection:
+            self.connection.execute("""
+                INSERT INTO receipts (sha256, receipt_key, receipt_number, issue_date, payment_date,
+                                      amount, tax, counterparty, file, directory, source_url, indexed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(sha256) DO UPDATE SET
+                    receipt_key = excluded.receipt_key, receipt_number = excluded.receipt_number,
+                    issue_date = excluded.issue_date, payment_date = excluded.payment_date,
+                    amount = excluded.amount, tax = excluded.tax, counterparty = excluded.counterparty,
+                    file = excluded.file, directory = excluded.directory,
+                    source_url = excluded.source_url, indexed_at = excluded.indexed_at
+            """, (entry['sha256'], entry['receipt_key'], record.receipt_number, record.issue_date,
+                  record.payment_date, record.amount, record.tax, record.counterparty, entry['file'],
+                  os.path.abspath(directory), record.source_url, datetime.now().isoformat(timespec='seconds')))
+            row_id = self.connection.execute(
+                "SELECT id FROM receipts WHERE sha256 = ?", (entry['sha256'],)).fetchone()[0]
+            self.connection.execute("DELETE FROM receipts_fts WHERE rowid = ?", (row_id,))
+            self.connection.execute(
+                "INSERT INTO receipts_fts (rowid, receipt_number, counterparty, text) VALUES (?, ?, ?, ?)",
+                (row_id, record.receipt_number or "", record.counterparty or "", record.page_text or ""))
+
+    def search(self, query, month=None, limit=50):
+        """キーワード（空白区切りでAND）と支払月で領収書を検索する"""
+        conditions = []
+        params = []
+        terms = query.split() if query else []
+        long_terms = [term for term in terms if len(term) >= 3]
+        if long_terms:
+            # trigramは3文字以上の語のみ索引で検索できる
+            conditions.append("receipts_fts MATCH ?")
+            params.append(" AND ".join('"' + term.replace('"', '""') + '"' for term in long_terms))
+        for term in terms:
+            if len(term) < 3:
+                conditions.append("(f.receipt_number LIKE ? OR f.counterparty LIKE ? OR f.text LIKE ?)")
+                params.extend([f"%{term}%"] * 3)
+        if month:
+            conditions.append("COALESCE(r.payment_date, r.issue_date) LIKE ?")
+            params.append(f"{month}%")
+        sql = "SELECT r.* FROM receipts r JOIN receipts_fts f ON f.rowid = r.id"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY COALESCE(r.payment_date, r.issue_date) DESC LIMIT ?"
+        params.append(limit)
+        return [dict(row) for row in self.connection.execute(sql, params)]
+
+    def close(self):
+        self.connection.close()
+
+def run_search(args):
+    """search サブコマンド：索引から領収書を検索して一覧表示する"""
+    if not os.path.exists(args.index_path):
+        print(f"検索索引が見つかりません: {args.index_path}")
+        return 1
+    index = ReceiptSearchIndex(args.index_path)
+    try:
+        results = index.search(" ".join(args.query), month=args.month, limit=args.limit)
+    finally:
+        index.close()
+    for row in results:
+        date = row['payment_date'] or row['issue_date'] or '----------'
+        amount = f"¥{row['amount']:,}" if row['amount'] is not None else '-'
+        print(f"{date}  {amount:>12}  {row['counterparty'] or '-'}  {row['receipt_number'] or '-'}  "
+              f"{os.path.join(row['directory'], row['file'])}")
+    print(f"{len(results)} 件見つかりました")
+    return 0
+
+def find_merge_sources(paths):
+    """マージ元のディレクトリを列挙する（shard-* を含むディレクトリはその中を対象にする）"""
+    sources = []
+    for path in paths:
+        shard_dirs = sorted(os.path.join(path, name) for name in os.listdir(path)
+                            if name.startswith("shard-") and os.path.isdir(os.path.join(path, name)))
+        sources.extend(shard_dirs or [path])
+    return sources
+
+def read_metadata_rows(directory):
+    """ディレクトリの領収書データ（receipts.jsonl、なければreceipts.csv）を読み込む"""
+    jsonl_path = os.path.join(directory, "receipts.jsonl")
+    csv_path = os.path.join(directory, "receipts.csv")
+    if os.path.exists(jsonl_path):
+        with open(jsonl_path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    if os.path.exists(csv_path):
+        with open(csv_path, encoding="utf-8-sig", newline="") as f:
+            return list(csv.DictReader(f))
+    return []
+
+def run_merge(args):
+    """merge サブコマンド：分割実行の結果を1つのディレクトリに重複なくまとめる"""
+    sources = find_merge_sources(args.sources)
+    output_dir = create_download_dir(args.output)
+    merged = load_manifest(output_dir)
+    
+    # 引数の順序によらず同じ結果になるよう、保存日時順に並べてから内容ハッシュで重複を除く
+    candidates = []
+    for source in sources:
+        for entry in ReceiptManifest(os.path.join(source, MANIFEST_FILE_NAME)).entries.values():
+            candidates.append((entry.get("saved_at") or "", entry["sha256"], source, entry))
+    candidates.sort(key=lambda item: item[:2])
+    
+    # 取り込んだ (実行結果, ファイル名) ごとの領収書の件数（月別PDFは複数の領収書を含む）
+    added_files = {}
+    # 月別PDFの追記先と、追記済みの (実行結果, 月別PDF)
+    appenders = {}
+    appended = set()
+    duplicates = missing = 0
+    for _, content_hash, source, entry in candidates:
+        if merged.find_by_hash(content_hash):
+            duplicates += 1
+            continue
+        source_path = os.path.join(source, entry["file"])
+        if not os.path.exists(source_path):
+            # アーカイブ出力の結果は個別のファイルがないため取り込めない
+            logger.warning(f"ファイルが見つからないためマージしません: {source_path}")
+            missing += 1
+            continue
+        if entry["file"] == entry.get("merged_file"):
+            # 月別PDFのみの結果は、上書きせずマージ先の同じ月の月別PDFに追記する（月別PDFごとに1回）
+            if (source, entry["file"]) not in appended:
+                if entry["file"] not in appenders:
+                    appenders[entry["file"]] = IncrementalPdfAppender(os.path.join(output_dir, entry["file"]))
+                with open(source_path, "rb") as f:
+                    pages = appenders[entry["file"]].append(f.read())
+                logger.info(f"月別PDF {entry['file']} に {source_path} の {pages} ページを追記しました")
+                appended.add((source, entry["file"]))
+        else:
+            target_path = os.path.join(output_dir, entry["file"])
+            shutil.copy2(source_path, target_path + ".part")
+            os.replace(target_path + ".part", target_path)
+            entry = {key: value for key, value in entry.items() if key != "merged_file"}
+        merged.record(entry)
+        added_files[(source, entry["file"])] = added_files.get((source, entry["file"]), 0) + 1
+    
+    # 取り込んだファイルの領収書データだけを書き出す
+    exporter = MetadataExporter(output_dir)
+    try:
+        for source in sources:
+            for row in read_metadata_rows(source):
+                if added_files.get((source, row.get("file"))):
+                    exporter.on_receipt_saved(None, None, ReceiptRecord(**{name: row.get(name) for name in METADATA_FIELDS}))
+                    added_files[(source, row["file"])] -= 1
+    finally:
+        exporter.close()
+    
+    print(f"{len(sources)} 件の実行結果をマージしました: {output_dir}")
+    print(f"追加 {len(candidates) - duplicates - missing} 件、重複 {duplicates} 件、ファイルなし {missing} 件")
+    return 0
+
+def resolve_ledger_directory(args):
+    """status / list-ledger / verify の対象ディレクトリを返す"""
+    directory = args.directory or args.download_dir
+    if not directory or not os.path.isdir(directory):
+        print(f"ダウンロード先のディレクトリを指定してください: {directory or '(未指定)'}", file=sys.stderr)
+        return None
+    return directory
+
+def iter_ledger_entries(directory):
+    """ディレクトリ（分割実行の場合は shard-* を含む）のマニフェストの記録を (ディレクトリ, 記録) で返す"""
+    for source in find_merge_sources([directory]):
+        for entry in ReceiptManifest(os.path.join(source, MANIFEST_FILE_NAME)).entries.values():
+            yield source, entry
+
+def ledger_entry_path(source, entry):
+    """記録に対応するファイルのパス（個別のファイルがなければ月別PDF）を返す"""
+    path = os.path.join(source, entry["file"])
+    if not os.path.exists(path) and entry.get("merged_file"):
+        return os.path.join(source, entry["merged_file"])
+    return path
+
+def run_status(args):
+    """status サブコマンド：保存済みの件数・容量・最終保存日時を表示する（ファイルが欠けていれば終了コード1）"""
+    directory = resolve_ledger_directory(args)
+    if directory is None:
+        return 2
+    summary = {"directory": os.path.abspath(directory), "receipts": 0, "bytes": 0, "missing": 0,
+               "last_saved_at": None, "months": {}, "shards": {}}
+    for source, entry in iter_ledger_entries(directory):
+        summary["receipts"] += 1
+        summary["bytes"] += entry.get("size") or 0
+        if not os.path.exists(ledger_entry_path(source, entry)):
+            summary["missing"] += 1
+        summary["last_saved_at"] = max(summary["last_saved_at"] or "", entry.get("saved_at") or "") or None
+        month = (entry.get("date") or "")[:7] or "不明"
+        summary["months"][month] = summary["months"].get(month, 0) + 1
+        if source != directory:
+            shard_name = os.path.basename(source)
+            summary["shards"][shard_name] = summary["shards"].get(shard_name, 0) + 1
+    summary["bytes_per_receipt"] = round(summary["bytes"] / summary["receipts"]) if summary["receipts"] else 0
+    
+    if args.json:
+        print(json.dumps(summary, ensure_ascii=False))
+    else:
+        print(f"ダウンロード先: {summary['directory']}")
+        print(f"保存済み: {summary['receipts']} 件（{summary['bytes'] / 1024 / 1024:.1f} MB、"
+              f"1件あたり {summary['bytes_per_receipt'] / 1024:.0f} KB）")
+        print(f"最終保存: {summary['last_saved_at'] or '-'}")
+        print(f"ファイルなし: {summary['missing']} 件")
+        for month, count in sorted(summary["months"].items()):
+            print(f"  {month}: {count} 件")
+        for shard_name, count in sorted(summary["shards"].items()):
+            print(f"  {shard_name}: {count} 件")
+    return 1 if summary["missing"] else 0
+
+LEDGER_COLUMNS = ["saved_at", "date", "amount", "receipt_number", "file", "source_url"]
+
+def run_list_ledger(args):
+    """list-ledger サブコマンド：マニフェストの記録を1行ずつ出力する"""
+    directory = resolve_ledger_directory(args)
+    if directory is None:
+        return 2
+    for source, entry in iter_ledger_entries(directory):
+        if args.month and not (entry.get("date") or "").startswith(args.month):
+            continue
+        if args.format == "jsonl":
+            print(json.dumps(dict(entry, directory=source), ensure_ascii=False))
+        else:
+            print("\t".join("" if entry.get(name) is None else str(entry.get(name)) for name in LEDGER_COLUMNS))
+    return 0
+
+def run_verify(args):
+    """verify サブコマンド：記録されたファイルの有無・内容ハッシュ・PDFの構造と本文を確認する（問題があれば終了コード1）"""
+    directory = resolve_ledger_directory(args)
+    if directory is None:
+        return 2
+    checks = []
+    merged_checks = {}
+    for source, entry in iter_ledger_entries(directory):
+        path = ledger_entry_path(source, entry)
+        if not entry.get("merged_file") or path != os.path.join(source, entry["merged_file"]):
+            checks.append((source, [entry], path, entry.get("receipt_number"), entry["sha256"],
+                           entry.get("capture") != "screenshot", False))
+        elif path in merged_checks:
+            merged_checks[path][1].append(entry)
+        else:
+            # 月別PDFには複数の領収書が含まれるため、ファイルごとに1回だけ、番号と内容ハッシュ・ページ数は確認せずに検査する
+            merged_checks[path] = (source, [entry], path, None, None, True, True)
+            checks.append(merged_checks[path])
+    
+    problem_count = 0
+    with create_verification_pool(args.workers) as executor:
+        results = executor.map(verify_receipt_file, *zip(*[check[2:] for check in checks]), chunksize=8) if checks else []
+        for (source, entries, path, *_), result in zip(checks, results):
+            if not result["problems"]:
+                continue
+            problem_count += 1
+            print(f"{path}\t{'、'.join(result['problems'])}")
+            if args.requeue:
+                # 月別PDFが壊れている場合は、含まれる領収書をすべて取得し直す
+                for entry in entries:
+                    append_requeue(source, entry, result["problems"])
+    print(f"{len(checks)} 件を確認しました（問題 {problem_count} 件）", file=sys.stderr)
+    if problem_count and args.requeue:
+        print("問題のある領収書は、次回の実行で取得し直します", file=sys.stderr)
+    return 1 if problem_count else 0
+
+BENCH_LIST_ROW = ('<tr id="payment-{n}"><td>2024/{month:02d}/15</td><td>¥{amount:,}</td>'
+                  '<td><a href="/receipt_sheets/{n}">領収書</a></td></tr>')
+
+def bench_samples(directory):
+    """ベンチマークで使う入力を作成する（ネットワークとブラウザは使わない）"""
+    list_html = "<table>" + "".join(
+        BENCH_LIST_ROW.format(n=n, month=n % 12 + 1, amount=n * 1100) for n in range(1, 51)) + "</table>"
+    pdf_data = b"%PDF-1.4\n/CreationDate (D:20240101000000+09'00')\n" + os.urandom(1024 * 1024) + b"\n%%EOF\n"
+    snapshot = {
+        "url": f"{BASE_URL}/receipt_sheets/1234",
+        "title": "領収書",
+        "text": "領収書\n領収書番号 R-2024-0001\n発行日 2024年1月15日\n株式会社サンプル 様\n金額 ¥11,000\n消費税 ¥1,000",
+        "pairs": [["領収書番号", "R-2024-0001"], ["発行日", "2024年1月15日"], ["金額", "¥11,000"], ["消費税", "¥1,000"]],
+        "headers": [],
+        "rows": []
+    }
+    manifest_path = os.path.join(directory, MANIFEST_FILE_NAME)
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        for n in range(1000):
+            f.write(json.dumps({"receipt_key": str(n), "file": f"領収書_{n}.pdf", "sha256": f"{n:064x}",
+                                "source_url": f"{BASE_URL}/receipt_sheets/{n}"}) + "\n")
+    return list_html, pdf_data, snapshot, manifest_path
+
+def bench_receipt_pdf():
+    """出力プロファイルの計測に使う、圧縮していない本文と末尾の空白ページを持つPDFを作成する"""
+    lines = [f"Receipt R-2024-{n:04d}  2024/01/15  JPY {n * 1100:,}" for n in range(1, 61)]
+    content = ("BT /F1 10 Tf 50 800 Td 14 TL "
+               + " ".join(f"({line}) '" for line in lines) + " ET").encode("ascii")
+    blank = b""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R 4 0 R] /Count 2 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 5 0 R >> >> /Contents 6 0 R >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << >> /Contents 7 0 R >>",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        f"<< /Length {len(content)} >>\nstream\n".encode("ascii") + content + b"\nendstream",
+        f"<< /Length {len(blank)} >>\nstream\n".encode("ascii") + blank + b"\nendstream",
+    ]
+    return build_pdf(objects)
+
+def run_bench(args):
+    """bench サブコマンド：ブラウザを使わない処理の所要時間を計測する"""
+    with tempfile.TemporaryDirectory() as directory:
+        list_html, pdf_data, snapshot, manifest_path = bench_samples(directory)
+        benchmarks = [
+            ("一覧ページの解析（50行）", lambda: parse_payment_list_html(list_html, BASE_URL, 1)),
+            ("内容ハッシュ（1MB）", lambda: content_fingerprint(pdf_data)),
+            ("領収書データの抽出", lambda: extract_receipt_record(snapshot)),
+            ("マニフェストの読み込み（1000件）", lambda: ReceiptManifest(manifest_path)),
+        ]
+        # 出力プロファイルの後処理（処理後の容量も記録する）
+        receipt_pdf = bench_receipt_pdf()
+        benchmarks.append(("PDFの後処理（compact）", lambda: postprocess_pdf(receipt_pdf, PDF_PROFILES["compact"])))
+        if args.fixtures:
+            # 記録した実際の一覧ページで解析処理を計測する
+            pages = [(entry["url"], body.decode("utf-8", "replace"))
+                     for entry, body in FixtureStore(args.fixtures).bodies("/payments")]
+            if pages:
+                benchmarks.append((f"記録した一覧ページの解析（{len(pages)}ページ）",
+                                   lambda: [parse_payment_list_html(html, url) for url, html in pages]))
+        results = []
+        for name, function in benchmarks:
+            timings = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                output = function()
+                timings.append(time.perf_counter() - started)
+            timings.sort()
+            result = {"name": name, "median_ms": timings[len(timings) // 2] * 1000,
+                      "min_ms": timings[0] * 1000, "repeat": args.repeat}
+            # 出力を作る処理は、速度と合わせて出力の容量を記録する
+            if isinstance(output, bytes):
+                result["bytes"] = len(output)
+            results.append(result)
+    
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False))
+    else:
+        for result in results:
+            size = f"  出力 {result['bytes']:,} バイト" if "bytes" in result else ""
+            print(f"{result['name']:<24} 中央値 {result['median_ms']:8.3f} ms  最小 {result['min_ms']:8.3f} ms{size}")
+    return 0
+
+def run_replay(args):
+    """replay サブコマンド：記録した通信を返すサーバーを起動し、Ctrl+Cまで待つ"""
+    store = FixtureStore(args.directory)
+    if not store.entries:
+        print(f"記録された通信がありません: {args.directory}")
+        return 1
+    server = ReplayServer(store, args.host, args.port, args.latency).start()
+    print(f"記録した通信を再生しています（{len(store.entries)} 件）: {server.base_url}")
+    print(f"別の端末で --base-url {server.base_url} を指定して実行してください。Ctrl+Cで終了します")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(server.summary())
+        server.close()
+    return 0
+
+# 長時間実行で傾きを計算する値と、その表示名・単位
+SOAK_METRICS = {
+    "python_traced_mb": ("Pythonの確保メモリ（tracemalloc）", "MB"),
+    "python_rss_mb": ("PythonのRSS", "MB"),
+    "chrome_rss_mb": ("ChromeのRSS", "MB"),
+    "latency_ms": ("1件あたりの処理時間", "ms"),
+}
+
+def linear_slope(points):
+    """(x, y) の組から最小二乗法で傾きを求める（2点未満や x が同じ値だけの場合は None）"""
+    points = [(x, y) for x, y in points if y is not None]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    denominator = sum((x - mean_x) ** 2 for x, _ in points)
+    if not denominator:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / denominator
+
+def soak_sample(receipts, driver, latencies):
+    """長時間実行の計測値を1回分取得する（latencies は直近の区間の処理時間）"""
+    import tracemalloc
+    latencies = sorted(latencies)
+    chrome_rss = browser_rss_bytes(driver) if driver is not None else None
+    python_rss = process_rss_bytes([os.getpid()])
+    return {
+        "receipts": receipts,
+        "at": datetime.now().isoformat(timespec='seconds'),
+        "python_traced_mb": round(tracemalloc.get_traced_memory()[0] / 1024 / 1024, 2),
+        "python_rss_mb": None if python_rss is None else round(python_rss / 1024 / 1024, 1),
+        "chrome_rss_mb": None if chrome_rss is None else round(chrome_rss / 1024 / 1024, 1),
+        "latency_ms": round(latencies[len(latencies) // 2], 1) if latencies else None,
+    }
+
+def run_soak(args):
+    """soak サブコマンド：合成サイトで多数の領収書を処理し、メモリと処理時間の増え方（1000件あたりの傾き）を計測する"""
+    import tracemalloc
+    site = MockSite(args.receipts, latency=args.latency).start()
+    work_dir = tempfile.mkdtemp(prefix="receipt_soak_")
+    # 保存先・プロファイル・キャッシュなどは作業用ディレクトリに置き、普段の実行の記録と混ぜない
+    args.download_dir = os.path.join(work_dir, "receipts")
+    args.profile_dir = os.path.join(work_dir, "profile")
+    args.cache_dir = os.path.join(work_dir, DEFAULT_CACHE_DIR)
+    args.index_path = os.path.join(work_dir, DEFAULT_INDEX_PATH)
+    args.selector_stats = os.path.join(work_dir, SELECTOR_STATS_PATH)
+    args.timings_file = os.path.join(work_dir, PHASE_TIMINGS_PATH)
+    args.base_url = site.base_url
+    args.record = args.replay = None
+    args.non_interactive = True
+    
+    samples = []
+    latencies = []
+    baseline_snapshot = final_snapshot = None
+    tracemalloc.start()
+    print(f"合成サイトで {args.receipts} 件を処理します（{args.sample_every} 件ごとに計測、最初の {args.warmup} 件は傾きに含めない）")
+    try:
+        with ReceiptClient.from_args(args) as client:
+            if not client.login():
+                print("合成サイトにログインできませんでした")
+                return 2
+            for processed, entry in enumerate(client.iter_receipts(), 1):
+                started = time.perf_counter()
+                client.download(entry)
+                latencies.append((time.perf_counter() - started) * 1000)
+                if processed % args.sample_every and processed != args.receipts:
+                    continue
+                driver = browser_watchdog.driver if browser_watchdog is not None else client.driver
+                sample = soak_sample(processed, driver, latencies)
+                latencies.clear()
+                samples.append(sample)
+                print(f"  {processed} 件: " + "、".join(
+                    f"{label} {sample[key]}{unit}" for key, (label, unit) in SOAK_METRICS.items()
+                    if sample[key] is not None))
+                if baseline_snapshot is None and processed >= args.warmup:
+                    baseline_snapshot = tracemalloc.take_snapshot()
+            final_snapshot = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+        logger.info(site.summary())
+        site.close()
+        if args.keep_work_dir:
+            print(f"作業用ディレクトリ: {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    
+    # 準備運転の区間を除いた計測値から、1000件あたりの増え方を求める
+    measured = [sample for sample in samples if sample["receipts"] >= args.warmup]
+    thresholds = {"python_traced_mb": args.max_python_growth_mb, "python_rss_mb": args.max_rss_growth_mb,
+                  "chrome_rss_mb": args.max_chrome_growth_mb, "latency_ms": args.max_latency_growth_ms}
+    slopes = {}
+    drifted = []
+    for key in SOAK_METRICS:
+        slope = linear_slope([(sample["receipts"], sample[key]) for sample in measured])
+        slopes[key] = None if slope is None else round(slope * 1000, 2)
+        if slopes[key] is not None and thresholds[key] is not None and slopes[key] > thresholds[key]:
+            drifted.append(key)
+    
+    # 準備運転の後に増えたPythonのメモリを、確保した行ごとに多い順に示す
+    growth = []
+    if baseline_snapshot is not None and final_snapshot is not None:
+        ignore = (tracemalloc.Filter(False, tracemalloc.__file__),)
+        stats = final_snapshot.filter_traces(ignore).compare_to(baseline_snapshot.filter_traces(ignore), "lineno")
+        growth = [{"location": str(stat.traceback), "size_diff_kb": round(stat.size_diff / 1024, 1),
+                   "count_diff": stat.count_diff} for stat in stats[:args.top] if stat.size_diff > 0]
+    
+    report = {"receipts": args.receipts, "warmup": args.warmup, "samples": samples,
+              "slopes_per_1000": slopes, "thresholds_per_1000": thresholds, "drifted": drifted,
+              "python_growth": growth}
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    print("1000件あたりの増加:")
+    for key, (label, unit) in SOAK_METRICS.items():
+        slope = slopes[key]
+        limit = f"（上限 {thresholds[key]:g}{unit}）" if thresholds[key] is not None else ""
+        mark = " ← 上限超過" if key in drifted else ""
+        print(f"  {label}: {'-' if slope is None else f'{slope:+.2f}{unit}'}{limit}{mark}")
+    if growth:
+        print("Pythonのメモリが増えた箇所:")
+        for item in growth:
+            print(f"  {item['location']}: +{item['size_diff_kb']:.1f}KB（{item['count_diff']:+d} 個）")
+    if len(measured) < 2:
+        print("計測値が足りないため、傾きを計算できませんでした（--receipts を増やすか --sample-every を減らしてください）")
+    return 1 if drifted else 0
+
+# 複数アカウントの実行で、アカウントごとのプロファイル・保存先・ログを置くディレクトリ
+ACCOUNTS_BASE_DIR = "accounts"
+ACCOUNT_NAME_PATTERN = re.compile(r'^[\w.-]+$')
 
-def hide_header_elements(driver):
-    """ヘッダー要素を非表示にする共通処理（強化版）"""
+def load_accounts_config(path):
+    """複数アカウントの設定ファイルを読み込み、(設定全体, アカウントの一覧) を返す（省略した保存先は補完する）"""
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    base_dir = config.get("base_dir", ACCOUNTS_BASE_DIR)
+    accounts = []
+    for account in config.get("accounts", []):
+        name = account.get("name")
+        if not name or not ACCOUNT_NAME_PATTERN.match(name):
+            raise ValueError(f"アカウント名には英数字と . _ - だけを使えます: {name!r}")
+        if any(existing["name"] == name for existing in accounts):
+            raise ValueError(f"アカウント名が重複しています: {name}")
+        account_dir = os.path.join(base_dir, name)
+        accounts.append({
+            "name": name,
+            "dir": account_dir,
+            "download_dir": account.get("download_dir", os.path.join(account_dir, "receipts")),
+            "profile_dir": account.get("profile_dir", os.path.join(account_dir, "profile")),
+            "rate_limit": account.get("rate_limit"),
+            "args": [str(arg) for arg in account.get("args", [])],
+        })
+    return config, accounts
+
+def account_command(account, rate_limit, verify_workers):
+    """1つのアカウントを実行するコマンドを返す（ログ・キャッシュ・索引・実績もアカウントごとに分ける）"""
+    account_dir = account["dir"]
+    return [sys.executable, os.path.abspath(__file__),
+            "--log-file", os.path.join(account_dir, "receipt_download.log"),
+            "run", "--non-interactive",
+            "--download-dir", account["download_dir"],
+            "--profile-dir", account["profile_dir"],
+            "--rate-limit", f"{rate_limit:g}",
+            "--cache-dir", os.path.join(account_dir, DEFAULT_CACHE_DIR),
+            "--index-path", os.path.join(account_dir, DEFAULT_INDEX_PATH),
+            "--selector-stats", os.path.join(account_dir, SELECTOR_STATS_PATH),
+            "--timings-file", os.path.join(account_dir, PHASE_TIMINGS_PATH),
+            "--status-file", os.path.join(account_dir, "status.json"),
+            "--verify-workers", str(verify_workers)] + account["args"]
+
+def account_status_line(account, state):
+    """アカウントの状態を1行で返す（実行中は子プロセスの --status-file を読む）"""
+    name = account["name"]
+    if state is None:
+        return f"{name}: 待機中"
+    if state != "running":
+        returncode, elapsed = state
+        result = "完了" if returncode == 0 else f"失敗（終了コード {returncode}）"
+        return f"{name}: {result}（{format_duration(elapsed)}）"
     try:
-        # より広範囲のヘッダー要素を非表示にするJavaScriptを実行
-        driver.execute_script("""
-            // すべての通知、アラート、メッセージ要素を非表示にする
-            var elementsToHide = document.querySelectorAll(
-                '.alert, .alert-success, .alert-info, .alert-warning, .alert-danger, ' +
-                '.notice, .message, .flash-message, .header-message, .notification, ' +
-                '.status-message, div[role="alert"], .toast, .banner, ' +
-                '.info-message, .success-message, .warning-message, .error-message, ' +
-                '.flash, .flash-notice, .flash-success, .flash-error, ' +
-                '.message-container, .message-box, .notification-container, ' +
-                '.close-button, .close-icon, button.close, ' +
-                'div[class*="alert"], div[class*="notice"], div[class*="message"], ' +
-                'div[class*="notification"], div[class*="toast"], ' +
-                'div[class*="info"], div[class*="success"], div[class*="warning"], div[class*="error"]'
-            );
-            
-            // すべての要素を非表示に
-            elementsToHide.forEach(function(element) {
-                element.style.display = 'none';
-                element.style.visibility = 'hidden';
-                element.style.opacity = '0';
-                element.style.height = '0';
-                element.style.overflow = 'hidden';
-                element.setAttribute('aria-hidden', 'true');
-            });
-            
-            // インフォメーションアイコンと閉じるボタンを探して非表示に
-            var icons = document.querySelectorAll(
-                'i[class*="info"], i[class*="close"], ' +
-                'svg[class*="info"], svg[class*="close"], ' +
-                'span[class*="info"], span[class*="close"], ' +
-                'button[class*="close"], a[class*="close"]'
-            );
-            
-            icons.forEach(function(icon) {
-                icon.style.display = 'none';
-                icon.style.visibility = 'hidden';
-            });
-            
-            // 印刷用のスタイルを追加（より強力なバージョン）
-            var style = document.createElement('style');
-            style.innerHTML = `
-                @media print {
-                    .alert, .alert-success, .alert-info, .alert-warning, .alert-danger,
-                    .notice, .message, .flash-message, .header-message, .notification,
-                    .status-message, div[role="alert"], .toast, .banner,
-                    .info-message, .success-message, .warning-message, .error-message,
-                    .flash, .flash-notice, .flash-success, .flash-error,
-                    .message-container, .message-box, .notification-container,
-                    .close-button, .close-icon, button.close,
-                    div[class*="alert"], div[class*="notice"], div[class*="message"],
-                    div[class*="notification"], div[class*="toast"],
-                    div[class*="info"], div[class*="success"], div[class*="warning"], div[class*="error"],
-                    i[class*="info"], i[class*="close"],
-                    svg[class*="info"], svg[class*="close"],
-                    span[class*="info"], span[class*="close"],
-                    button[class*="close"], a[class*="close"] {
-                        display: none !important;
-                        visibility: hidden !important;
-                        opacity: 0 !important;
-                        height: 0 !important;
-                        width: 0 !important;
-                        overflow: hidden !important;
-                        position: absolute !important;
-                        top: -9999px !important;
-                        left: -9999px !important;
-                    }
-                    
-                    body { 
-                        margin: 0 !important; 
-                        padding: 0 !important;
-                        -webkit-print-color-adjust: exact !important;
-                        color-adjust: exact !important;
-                    }
-                    
-                    /* 余分な余白を削除 */
-                    * { 
-                        margin-top: 0 !important;
-                        padding-top: 0 !important;
-                    }
-                    
-                    /* 最初のコンテンツ要素の上部余白を削除 */
-                    body > *:first-child {
-                        margin-top: 0 !important;
-                        padding-top: 0 !important;
-                    }
-                }
-            `;
-            document.head.appendChild(style);
-            
-            // 余分な余白を削除
-            document.body.style.margin = '0';
-            document.body.style.padding = '0';
-            
-            // 特定のサイト向けのカスタム処理
-            // CrowdWorks特有の要素を探して非表示に
-            var cwSpecificElements = document.querySelectorAll(
-                '.cw-alert, .cw-notice, .cw-message, .cw-flash, ' +
-                '.cw-header-message, .cw-notification, ' +
-                '.receipt-header, .receipt-notice, ' +
-                'div[class*="cw-alert"], div[class*="cw-notice"], div[class*="cw-message"]'
-            );
-            
-            cwSpecificElements.forEach(function(element) {
-                element.style.display = 'none';
-                element.style.visibility = 'hidden';
-            });
-            
-            // 最上部の要素を探して、それが通知系の場合は非表示に
-            var topElements = Array.from(document.body.children).slice(0, 3);
-            topElements.forEach(function(element) {
-                var text = element.textContent.toLowerCase();
-                if (text.includes('発行しました') || 
-                    text.includes('完了') || 
-                    text.includes('成功') || 
-                    text.includes('通知') ||
-                    text.includes('メッセージ')) {
-                    element.style.display = 'none';
-                    element.style.visibility = 'hidden';
-                }
-            });
-            
-            return true;
-        """)
-        
-        # DOMの更新を待つ
-        time.sleep(1)
-        logger.info("ヘッダー要素を非表示にしました（強化版）")
-        return True
-    except Exception as e:
-        logger.error(f"ヘッダー要素の非表示化に失敗: {str(e)}")
-        return False
+        with open(os.path.join(account["dir"], "status.json"), encoding="utf-8") as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        return f"{name}: 起動中"
+    eta = status.get("eta_seconds")
+    return (f"{name}: {status['done']}/{status['expected'] or '?'} 件、{status['rate_per_minute']:.1f} 件/分、"
+            f"残り {'不明' if eta is None else format_duration(eta)}")
 
-def extract_receipt_number(driver):
-    """ページから領収書番号または請求書番号を抽出する"""
+def run_accounts(args):
+    """accounts サブコマンド：複数のアカウントを、アカウントごとに別のプロセスとブラウザで並行して実行する
+
+    ブラウザの同時起動数・全体のリクエスト数・CPUは全アカウントで分け合う。
+    """
     try:
-        # 領収書/請求書番号を含む可能性のある要素を探す
-        receipt_number = None
-        
-        # 方法1: 「領収書番号」または「請求書番号」というラベルを探す
+        config, accounts = load_accounts_config(args.config_file)
+    except (OSError, ValueError) as e:
+        print(f"設定ファイルを読み込めません: {str(e)}")
+        return 2
+    if args.only:
+        accounts = [account for account in accounts if account["name"] in args.only]
+    if not accounts:
+        print("実行するアカウントがありません")
+        return 2
+    
+    max_browsers = max(1, args.max_browsers or config.get("max_browsers") or 2)
+    concurrency = min(max_browsers, len(accounts))
+    global_rate = args.rate_limit or config.get("rate_limit")
+    max_cpu = args.max_cpu or config.get("max_cpu") or os.cpu_count() or 2
+    # 検証のプロセスは同時に動くアカウントで等分する（ブラウザ用に1つ残す）
+    verify_workers = max(1, max_cpu // concurrency - 1)
+    states = {account["name"]: None for account in accounts}
+    
+    def run_account(account):
+        with log_context(worker_id=account["name"]):
+            rate = account["rate_limit"] or DEFAULT_RATE_LIMIT
+            if global_rate:
+                # 同時に動くアカウントの合計が全体の上限を超えないようにする
+                rate = min(rate, global_rate / concurrency)
+            os.makedirs(account["dir"], exist_ok=True)
+            status_path = os.path.join(account["dir"], "status.json")
+            if os.path.exists(status_path):
+                os.remove(status_path)
+            command = account_command(account, rate, verify_workers)
+            logger.info(f"アカウント {account['name']} を開始します: {' '.join(command)}")
+            states[account["name"]] = "running"
+            started = time.time()
+            with open(os.path.join(account["dir"], "console.log"), "w", encoding="utf-8") as console:
+                returncode = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=console,
+                                            stderr=subprocess.STDOUT).returncode
+            states[account["name"]] = (returncode, time.time() - started)
+            logger.info(f"アカウント {account['name']} が終了しました（終了コード {returncode}）")
+            return returncode
+    
+    print(f"{len(accounts)} アカウントを、ブラウザ {concurrency} 個まで同時に実行します"
+          f"（全体のリクエスト上限: {f'毎秒 {global_rate:g} 回' if global_rate else 'なし'}、検証プロセス: 各 {verify_workers}）")
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="account") as executor:
+        futures = [executor.submit(contextvars.copy_context().run, run_account, account) for account in accounts]
+        while True:
+            done, _ = wait_futures(futures, timeout=args.interval)
+            if len(done) == len(futures):
+                break
+            print(f"\n--- {datetime.now().strftime('%H:%M:%S')} ---")
+            for account in accounts:
+                print(account_status_line(account, states[account["name"]]))
+    
+    print(f"\n=== 結果（全体 {format_duration(time.time() - started)}） ===")
+    failed = 0
+    for account, future in zip(accounts, futures):
         try:
-            label_elements = driver.find_elements(By.XPATH, 
-                "//th[contains(text(), '領収書番号') or contains(text(), '請求書番号')] | " + 
-                "//td[contains(text(), '領収書番号') or contains(text(), '請求書番号')] | " + 
-                "//label[contains(text(), '領収書番号') or contains(text(), '請求書番号')] | " +
-                "//div[contains(text(), '領収書番号') or contains(text(), '請求書番号')] | " +
-                "//span[contains(text(), '領収書番号') or contains(text(), '請求書番号')]")
-            
-            for element in label_elements:
-                # 親要素または次の兄弟要素を取得
-                try:
-                    parent = element.find_element(By.XPATH, "./parent::*")
-                    next_element = parent.find_element(By.XPATH, "./following-sibling::*[1]")
-                    text = next_element.text.strip()
-                    
-                    # 数字とハイフンを含む文字列を探す
-                    if re.search(r'[0-9A-Z-]+', text):
-                        receipt_number = re.search(r'[0-9A-Z-]+', text).group()
-                        logger.info(f"番号を見つけました（ラベル方式）: {receipt_number}")
-                        break
-                except:
-                    # 次の兄弟要素が見つからない場合は、親要素のテキストから抽出を試みる
-                    text = parent.text.strip()
-                    match = re.search(r'[：:]\s*([0-9A-Z-]+)', text)
-                    if match:
-                        receipt_number = match.group(1)
-                        logger.info(f"番号を見つけました（親要素テキスト方式）: {receipt_number}")
-                        break
+            failed += future.result() != 0
         except Exception as e:
-            logger.info(f"ラベルから番号の抽出に失敗: {str(e)}")
+            failed += 1
+            states[account["name"]] = (f"起動エラー: {str(e)}", 0.0)
+        print(account_status_line(account, states[account["name"]]))
+    return 1 if failed else 0
+
+class IncrementalPdfAppender:
+    """PDFの末尾に増分更新としてページを追記する（既存部分は読み込まず、追記ごとに有効なPDFを保つ）"""
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            self._load_state()
+        else:
+            self._create()
+
+    def _create(self):
+        """カタログとページツリーだけを持つ空のPDFを作成する"""
+        with open(self.path, "wb") as f:
+            f.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+            offsets = {}
+            offsets[1] = f.tell()
+            f.write(b"1 0 obj\n<< /Type /Catalog /Pages 2 0 R >>\nendobj\n")
+            offsets[2] = f.tell()
+            f.write(b"2 0 obj\n<< /Type /Pages /Kids [] /Count 0 >>\nendobj\n")
+            self.root_num = 1
+            self.pages_num = 2
+            self.kids = []
+            self.size = 3
+            self.prev_xref = None
+            self._write_xref(f, offsets)
+
+    def _load_state(self):
+        """既存のPDFからページツリーと相互参照表の位置だけを読み取る"""
+        from pypdf import PdfReader
         
-        # 方法2: テーブルから探す
-        if not receipt_number:
-            try:
-                # まずテーブルヘッダーを探す
-                headers = driver.find_elements(By.TAG_NAME, "th")
-                for header in headers:
-                    if '番号' in header.text or 'No' in header.text:
-                        # 対応するセルを探す
-                        try:
-                            header_index = 0
-                            all_headers = header.find_elements(By.XPATH, "./parent::*/th")
-                            for i, h in enumerate(all_headers):
-                                if h == header:
-                                    header_index = i
-                                    break
-                            
-                            # 同じ列のセルを取得
-                            rows = driver.find_elements(By.TAG_NAME, "tr")
-                            for row in rows:
-                                cells = row.find_elements(By.TAG_NAME, "td")
-                                if len(cells) > header_index:
-                                    cell_text = cells[header_index].text.strip()
-                                    if re.search(r'[A-Z0-9-]+', cell_text):
-                                        receipt_number = re.search(r'[A-Z0-9-]+', cell_text).group()
-                                        logger.info(f"番号を見つけました（テーブルヘッダー方式）: {receipt_number}")
-                                        break
-                        except:
-                            pass
-                
-                # 一般的なテーブルセルから探す
-                if not receipt_number:
-                    table_cells = driver.find_elements(By.TAG_NAME, "td")
-                    for cell in table_cells:
-                        text = cell.text.strip()
-                        # 数字とハイフンのパターンを探す (例: R-12345678, CW-123456)
-                        if re.search(r'[A-Z]-\d+', text) or re.search(r'\d{5,}', text) or re.search(r'CW-\d+', text):
-                            receipt_number = text
-                            logger.info(f"番号を見つけました（テーブルセル方式）: {receipt_number}")
-                            break
-            except Exception as e:
-                logger.info(f"テーブルから番号の抽出に失敗: {str(e)}")
+        reader = PdfReader(self.path)
+        root = reader.trailer.raw_get("/Root")
+        pages = reader.trailer["/Root"].raw_get("/Pages")
+        self.root_num = root.idnum
+        self.pages_num = pages.idnum
+        self.kids = [kid.idnum for kid in pages.get_object().raw_get("/Kids")]
+        self.size = int(reader.trailer["/Size"])
+        with open(self.path, "rb") as f:
+            f.seek(max(0, os.path.getsize(self.path) - 1024))
+            self.prev_xref = int(re.findall(rb"startxref\s+(\d+)", f.read())[-1])
+
+    def _write_xref(self, f, offsets):
+        """相互参照表とトレーラーを書き込む（増分更新時は前の表を /Prev で参照する）"""
+        xref_offset = f.tell()
+        f.write(b"xref\n")
+        # 増分更新でも0番の空きエントリを先頭に置く（0番から始まらない表を誤って補正するリーダーがあるため）
+        numbers = [0] + sorted(offsets)
+        # 連続した番号ごとにサブセクションを書き出す
+        start = 0
+        while start < len(numbers):
+            end = start
+            while end + 1 < len(numbers) and numbers[end + 1] == numbers[end] + 1:
+                end += 1
+            f.write(f"{numbers[start]} {end - start + 1}\n".encode())
+            for num in numbers[start:end + 1]:
+                if num == 0:
+                    f.write(b"0000000000 65535 f \n")
+                else:
+                    f.write(f"{offsets[num]:010d} 00000 n \n".encode())
+            start = end + 1
+        trailer = f"trailer\n<< /Size {self.size} /Root {self.root_num} 0 R"
+        if self.prev_xref is not None:
+            trailer += f" /Prev {self.prev_xref}"
+        f.write(f"{trailer} >>\nstartxref\n{xref_offset}\n%%EOF\n".encode())
+        self.prev_xref = xref_offset
+
+    def append(self, data):
+        """PDFデータの全ページを末尾に追記する"""
+        from pypdf import PdfReader
+        from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject
         
-        # 方法3: ページ全体から特定のパターンを探す
-        if not receipt_number:
-            try:
-                page_text = driver.find_element(By.TAG_NAME, "body").text
-                # 領収書/請求書番号のパターンを探す
-                patterns = [
-                    r'領収書番号[：:]\s*([A-Z0-9-]+)',
-                    r'請求書番号[：:]\s*([A-Z0-9-]+)',
-                    r'領収書[：:]\s*([A-Z0-9-]+)',
-                    r'請求書[：:]\s*([A-Z0-9-]+)',
-                    r'受領書番号[：:]\s*([A-Z0-9-]+)',
-                    r'No[.：:]\s*([A-Z0-9-]+)',
-                    r'番号[：:]\s*([A-Z0-9-]+)',
-                    r'CW-(\d+)',
-                    r'[A-Z]-(\d{5,})'
-                ]
-                
-                for pattern in patterns:
-                    match = re.search(pattern, page_text)
-                    if match:
-                        receipt_number = match.group(1)
-                        logger.info(f"番号を見つけました（パターン方式）: {receipt_number}")
-                        break
-            except Exception as e:
-                logger.info(f"ページテキストから番号の抽出に失敗: {str(e)}")
+        reader = PdfReader(io.BytesIO(data))
+        mapping = {}
+        queue = []
         
-        # 方法4: URLから抽出を試みる
-        if not receipt_number:
-            try:
-                current_url = driver.current_url
-                # URLから数字の部分を抽出
-                url_match = re.search(r'receipt[s]?/(\d+)', current_url) or re.search(r'invoice[s]?/(\d+)', current_url)
-                if url_match:
-                    receipt_number = url_match.group(1)
-                    logger.info(f"番号を見つけました（URL方式）: {receipt_number}")
-            except Exception as e:
-                logger.info(f"URLから番号の抽出に失敗: {str(e)}")
+        def new_ref(ref):
+            key = (ref.idnum, ref.generation)
+            if key not in mapping:
+                mapping[key] = self.size
+                self.size += 1
+                queue.append(ref)
+            return IndirectObject(mapping[key], 0, None)
         
-        # 無効な文字を削除
-        if receipt_number:
-            receipt_number = re.sub(r'[\\/:*?"<>|]', '', receipt_number)
-            # 長すぎる場合は短くする
-            if len(receipt_number) > 20:
-                receipt_number = receipt_number[:20]
+        def remap(obj):
+            # 参照先の番号をこのファイル内の番号に付け替える
+            if isinstance(obj, IndirectObject):
+                return new_ref(obj)
+            if isinstance(obj, DictionaryObject):
+                for key, value in list(dict.items(obj)):
+                    dict.__setitem__(obj, key, remap(value))
+            elif isinstance(obj, ArrayObject):
+                for i, value in enumerate(list.__iter__(obj)):
+                    list.__setitem__(obj, i, remap(value))
+            return obj
         
-        return receipt_number
+        # 継承属性はpypdfがページに展開済みのため、展開後のページを書き出す
+        pages = {}
+        page_refs = []
+        for page in reader.pages:
+            ref = page.indirect_reference
+            pages[(ref.idnum, ref.generation)] = page
+            page_refs.append(new_ref(ref).idnum)
+        
+        offsets = {}
+        with open(self.path, "r+b") as f:
+            f.seek(0, os.SEEK_END)
+            while queue:
+                ref = queue.pop(0)
+                page = pages.get((ref.idnum, ref.generation))
+                if page is not None:
+                    # 元のページツリーは書き出さず、親をこのファイルのページツリーに差し替える
+                    obj = page
+                    dict.pop(obj, NameObject("/Parent"), None)
+                    remap(obj)
+                    dict.__setitem__(obj, NameObject("/Parent"), IndirectObject(self.pages_num, 0, None))
+                else:
+                    obj = remap(ref.get_object())
+                num = mapping[(ref.idnum, ref.generation)]
+                offsets[num] = f.tell()
+                f.write(f"{num} 0 obj\n".encode())
+                obj.write_to_stream(f)
+                f.write(b"\nendobj\n")
+            
+            # ページツリーを更新版として書き直す
+            self.kids.extend(page_refs)
+            offsets[self.pages_num] = f.tell()
+            kids = " ".join(f"{num} 0 R" for num in self.kids)
+            f.write(f"{self.pages_num} 0 obj\n<< /Type /Pages /Kids [{kids}] /Count {len(self.kids)} >>\nendobj\n".encode())
+            self._write_xref(f, offsets)
+        return len(page_refs)
+
+class MonthlyPdfMerger:
+    """領収書を支払月ごとの1つのPDFに到着順で追記する"""
+    # on_receipt_saved でファイルの内容を使う
+    needs_data = True
+
+    def __init__(self, directory, keep_individual_files=True):
+        self.directory = directory
+        self.keep_individual_files = keep_individual_files
+        self.appenders = {}
+
+    def month_of(self, record):
+        date = (record.payment_date or record.issue_date) if record else None
+        return date[:7] if date else "unknown"
+
+    def on_receipt_saved(self, entry, data, record):
+        if not data.startswith(b"%PDF"):
+            logger.info(f"PDF以外のファイルは月別PDFに追記しません: {entry['file']}")
+            return
+        month = self.month_of(record)
+        merged_name = f"領収書_{month}.pdf"
+        if month not in self.appenders:
+            self.appenders[month] = IncrementalPdfAppender(os.path.join(self.directory, merged_name))
+        pages = self.appenders[month].append(data)
+        logger.info(f"月別PDF {merged_name} に {pages} ページを追記しました")
+        entry["merged_file"] = merged_name
+        if not self.keep_individual_files:
+            entry["file"] = merged_name
+            if record:
+                record.file = merged_name
+
+    def close(self):
+        self.appenders.clear()
+
+# 領収書ページを印刷するときのPDFの設定
+PRINT_TO_PDF_OPTIONS = {
+    "printBackground": True,
+    "preferCSSPageSize": True,
+    "marginTop": 0,
+    "marginBottom": 0,
+    "marginLeft": 0,
+    "marginRight": 0,
+    "scale": 0.9,
+    "paperWidth": 8.27,  # A4サイズ
+    "paperHeight": 11.69,
+    "displayHeaderFooter": False
+}
+
+# PDFの出力プロファイル
+#   print: Page.printToPDF の設定
+#   trim_pages: 末尾の空白ページを削除する
+#   compress: ページの内容を圧縮し、同一のオブジェクト（フォントなど）をまとめる
+#   image_max_px / image_quality: 画像の長辺をこの画素数まで縮小し、このJPEG品質で保存する（Pillowが必要）
+PDF_PROFILES = {
+    # 従来と同じ設定
+    "standard": {"print": PRINT_TO_PDF_OPTIONS},
+    # 長期保存向け：等倍で印刷し、タグ付きPDFと見出しのしおりを含める
+    "archival": {"print": dict(PRINT_TO_PDF_OPTIONS, scale=1.0, generateTaggedPDF=True,
+                               generateDocumentOutline=True)},
+    # 経理への提出向け：背景を印刷せず、末尾の空白ページを削って圧縮する（本文のページは削らない）
+    "compact": {"print": dict(PRINT_TO_PDF_OPTIONS, printBackground=False, generateTaggedPDF=False),
+                "trim_pages": True, "compress": True, "image_max_px": 1200, "image_quality": 60},
+}
+pdf_profile = "standard"
+
+def print_page_pdf(driver):
+    """現在のページを出力プロファイルの設定で印刷し、PDFのバイト列を返す"""
+    pdf = driver.execute_cdp_cmd("Page.printToPDF", PDF_PROFILES[pdf_profile]["print"])
+    return base64.b64decode(pdf["data"])
+
+def is_blank_page(page):
+    """本文と画像のないページか"""
+    try:
+        return not (page.extract_text() or "").strip() and not page.images
+    except Exception:
+        return False
+
+def downsample_images(writer, max_px, quality):
+    """PDF内の画像の長辺を max_px まで縮小する（Pillowがない場合は何もしない）"""
+    if importlib.util.find_spec("PIL") is None:
+        return
+    for page in writer.pages:
+        for image in page.images:
+            try:
+                picture = image.image
+                if max(picture.size) <= max_px:
+                    continue
+                picture.thumbnail((max_px, max_px))
+                if picture.mode not in ("RGB", "L"):
+                    picture = picture.convert("RGB")
+                image.replace(picture, quality=quality)
+            except Exception as e:
+                logger.debug("画像を縮小できませんでした: %s", e)
+
+def postprocess_pdf(data, profile=None):
+    """出力プロファイルに応じてPDFを後処理する（小さくならない場合や pypdf がない場合は元のまま返す）"""
+    profile = profile or PDF_PROFILES[pdf_profile]
+    if not (profile.get("trim_pages") or profile.get("compress") or profile.get("image_max_px")):
+        return data
+    try:
+        from pypdf import PdfReader, PdfWriter
+    except ImportError:
+        return data
+    try:
+        pages = list(PdfReader(io.BytesIO(data)).pages)
+        if profile.get("trim_pages"):
+            while len(pages) > 1 and is_blank_page(pages[-1]):
+                pages.pop()
+        writer = PdfWriter()
+        for page in pages:
+            writer.add_page(page)
+        if profile.get("image_max_px"):
+            downsample_images(writer, profile["image_max_px"], profile.get("image_quality", 60))
+        if profile.get("compress"):
+            for page in writer.pages:
+                page.compress_content_streams()
+            # 古いpypdfにはないため、ある場合だけ使う
+            if hasattr(writer, "compress_identical_objects"):
+                writer.compress_identical_objects()
+        output = io.BytesIO()
+        writer.write(output)
+        result = output.getvalue()
     except Exception as e:
-        logger.error(f"番号の抽出中にエラー: {str(e)}")
-        return None
+        logger.warning(f"PDFの後処理に失敗したため、そのまま保存します: {str(e)}")
+        return data
+    if len(result) < len(data):
+        logger.debug("PDFの後処理: %d → %d バイト", len(data), len(result))
+        return result
+    return data
 
-def save_as_pdf(driver, index):
-    """現在のページをPDFとして保存する（ヘッダー除去強化版）"""
+def save_as_pdf(driver, index, source_url=None, extracted=None):
+    """現在のページをPDFとして保存する（ヘッダー除去強化版）
+
+    extracted に辞書を渡すと、抽出した領収書番号と領収書データを入れて返す（代替保存で使う）。
+    """
     try:
         # 領収書番号を抽出
-        receipt_number = extract_receipt_number(driver)
+        # ページの内容を1回だけ取得し、番号と構造化データを抽出する
+        snapshot = capture_page_snapshot(driver)
+        receipt_number = extract_receipt_number(driver, snapshot)
+        source_url = source_url or driver.current_url
+        record = extract_receipt_record(snapshot, receipt_number)
+        record.source_url = source_url
+        if extracted is not None:
+            extracted.update(receipt_number=receipt_number, record=record)
         
-        # ファイル名を生成
-        pdf_file_name = generate_pdf_filename(index, receipt_number)
-        pdf_path = os.path.join(download_dir, pdf_file_name)
+        # 直接ダウンロードできるPDFがあればそれを保存する
+        if prefer_direct_pdf:
+            pdf_url = find_pdf_url(driver)
+            if pdf_url:
+                if direct_pdf_backend == "http":
+                    pdf_file_name = download_pdf_from_url(driver, pdf_url, index, receipt_number, record)
+                else:
+                    pdf_file_name = download_pdf_via_browser(urljoin(source_url, pdf_url), receipt_number, source_url, record)
+                if pdf_file_name:
+                    logger.info(f"PDFを直接ダウンロードしました: {pdf_file_name}")
+                    return pdf_file_name
+                logger.info("PDFの直接ダウンロードに失敗しました。ページを印刷して保存します")
         
         # ヘッダー要素を非表示にする（2回実行して確実に）
         hide_header_elements(driver)
@@ -1113,24 +4345,10 @@ def save_as_pdf(driver, index):
         hide_header_elements(driver)
         
         try:
-            # PDFの設定を調整
-            pdf = driver.execute_cdp_cmd("Page.printToPDF", {
-                "printBackground": True,
-                "preferCSSPageSize": True,
-                "marginTop": 0,
-                "marginBottom": 0,
-                "marginLeft": 0,
-                "marginRight": 0,
-                "scale": 0.9,
-                "paperWidth": 8.27,  # A4サイズ
-                "paperHeight": 11.69,
-                "displayHeaderFooter": False,
-                "printBackground": True
-            })
+            pdf = postprocess_pdf(print_page_pdf(driver))
             
-            # PDFを保存
-            with open(pdf_path, "wb") as f:
-                f.write(base64.b64decode(pdf["data"]))
+            # PDFを保存（同一内容が保存済みの場合は書き込まない）
+            pdf_file_name = store_receipt_output(pdf, receipt_number, source_url, record=record)
             
             logger.info(f"ページをPDFとして保存しました: {pdf_file_name}")
             return pdf_file_name
@@ -1148,25 +4366,27 @@ def save_as_pdf(driver, index):
                 
                 print("\n=== PDF保存ダイアログが開いた場合 ===")
                 print("PDFとして保存してください")
+                pdf_file_name = generate_pdf_filename(receipt_number or receipt_key_from_url(source_url), "manual")
+                pdf_path = os.path.join(download_dir, pdf_file_name)
                 print(f"保存先: {download_dir}")
                 print(f"ファイル名: {pdf_file_name}")
                 
-                user_input = input("保存が完了したら「y」を、失敗した場合は「n」を入力してください: ")
+                user_input = ask_user("保存が完了したら「y」を、失敗した場合は「n」を入力してください: ")
                 if user_input.lower() == 'y':
                     if os.path.exists(pdf_path):
                         logger.info(f"ユーザーによるPDF保存を確認: {pdf_file_name}")
-                        return pdf_file_name
+                        return adopt_saved_file(pdf_path, receipt_number, source_url)
                     else:
                         print(f"ファイル {pdf_file_name} が見つかりません。")
                         print("別の名前で保存した場合は、そのファイル名を入力してください（拡張子含む）:")
                         print("保存していない場合は、Enterキーを押してください。")
-                        custom_filename = input().strip()
+                        custom_filename = ask_user().strip()
                         
                         if custom_filename:
                             custom_path = os.path.join(download_dir, custom_filename)
                             if os.path.exists(custom_path):
                                 logger.info(f"ユーザーが指定したファイルを確認: {custom_filename}")
-                                return custom_filename
+                                return adopt_saved_file(custom_path, receipt_number, source_url)
                 
                 return None
                 
@@ -1178,53 +4398,864 @@ def save_as_pdf(driver, index):
         logger.error(f"PDFとして保存できませんでした: {str(e)}")
         return None
 
-def download_pdf_from_url(driver, pdf_url, index):
-    """PDFのURLから直接ダウンロードする"""
+def download_pdf_from_url(driver, pdf_url, index, receipt_number=None, record=None):
+    """PDFのURLから直接ダウンロードする（共有セッションでストリーミング保存）"""
     try:
-        import requests
-        from urllib.parse import urljoin
-        
         # 相対URLの場合は絶対URLに変換
-        if not pdf_url.startswith('http'):
-            pdf_url = urljoin(driver.current_url, pdf_url)
-        
-        # Cookieを取得
-        cookies = driver.get_cookies()
-        cookies_dict = {cookie['name']: cookie['value'] for cookie in cookies}
+        pdf_url = urljoin(driver.current_url, pdf_url)
         
-        # PDFをダウンロード
-        response = requests.get(pdf_url, cookies=cookies_dict)
-        
-        if response.status_code == 200:
-            # ファイル名を生成（タイムスタンプなし）
-            pdf_file_name = generate_pdf_filename(index)
-            pdf_path = os.path.join(download_dir, pdf_file_name)
-            
-            # PDFを保存
-            with open(pdf_path, "wb") as f:
-                f.write(response.content)
-            
+        pdf_file_name = get_http_downloader(driver).download(pdf_url, receipt_number, driver.current_url, record)
+        if pdf_file_name:
             logger.info(f"PDFを直接ダウンロードしました: {pdf_file_name}")
-            return pdf_file_name
-        else:
-            logger.error(f"PDFのダウンロードに失敗しました。ステータスコード: {response.status_code}")
-            return None
+        return pdf_file_name
     except Exception as e:
         logger.error(f"PDFの直接ダウンロードに失敗: {str(e)}")
         return None
 
-def parse_arguments():
+# 発行済みの領収書の印刷方法（navigate: ページを開く、pool: HTTPで取得したHTMLを待機中のタブに流し込む）
+render_backend = "navigate"
+render_pool = None
+# 印刷用のタブの数と、領収書ページを先読みするスレッド数
+render_tabs = 2
+fetch_workers = 4
+
+# タブに流し込んだページの読み込み（スタイルシート・画像・フォント）が終わったか
+RENDER_READY_SCRIPT = """
+    return document.readyState === 'complete' &&
+        Array.from(document.images).every(function(img) { return img.complete; }) &&
+        (!document.fonts || document.fonts.status === 'loaded');
+"""
+
+def prepare_render_html(html, page_url):
+    """流し込むHTMLに元のURLの <base> と印刷用スタイルを加える（相対URLのCSSや画像を元のページと同じく読み込む）"""
+    head = f'<base href="{escape(page_url, quote=True)}"><style>{RECEIPT_PRINT_CSS}</style>'
+    match = re.search(r'<head[^>]*>', html, re.IGNORECASE)
+    if match:
+        return html[:match.end()] + head + html[match.end():]
+    return head + html
+
+class RenderPool:
+    """発行済みの領収書ページをHTTPで先読みし、待機中のタブに流し込んで印刷する
+
+    取得はスレッドで並行して先に進め、印刷は待機中のタブを順番に使う。印刷している間に
+    次の領収書を別のタブに流し込んでおくため、サイトの応答やページの読み込みを待たずに済む。
+    """
+
+    def __init__(self, driver, session, tabs=2, fetch_workers=4, ready_timeout=15):
+        self.driver = driver
+        self.session = session
+        self.tab_count = max(1, tabs)
+        self.ready_timeout = ready_timeout
+        self.executor = ThreadPoolExecutor(max_workers=max(1, fetch_workers))
+        self.fetches = {}
+        self.queue = []
+        self.tabs = []
+        self.loaded = {}
+        # 先読みしたが、未発行やログイン切れで印刷できないページ
+        self.unprintable = set()
+        self.next_tab = 0
+        self.counts = {"rendered": 0, "fallback": 0}
+
+    def _open_tabs(self):
+        """同じサイトのページを開いたタブを用意する（Cookieとオリジンを元のページと揃える）"""
+        original = self.driver.current_window_handle
+        self.tabs = []
+        self.loaded = {}
+        for _ in range(self.tab_count):
+            self.driver.switch_to.new_window('tab')
+            self.driver.get(f'{BASE_URL}/mypage')
+            frame_id = self.driver.execute_cdp_cmd("Page.getFrameTree", {})["frameTree"]["frame"]["id"]
+            self.tabs.append((self.driver.current_window_handle, frame_id))
+        self.driver.switch_to.window(original)
+        logger.info(f"印刷用のタブを {len(self.tabs)} 個用意しました")
+
+    def _ensure_tabs(self, driver):
+        """ブラウザの再起動やタブの作り直しで失われたタブを作り直す"""
+        if driver is not self.driver:
+            self.driver = driver
+            self.tabs = []
+        if not self.tabs or not all(handle in driver.window_handles for handle, _ in self.tabs):
+            self._open_tabs()
+
+    def page_url(self, entry):
+        return issued_pages.get(entry.href, entry.href)
+
+    def prefetch(self, entries):
+        """発行済みで未保存の領収書ページを、印刷する順に先読みする"""
+        for entry in entries:
+            if entry.href in self.fetches or is_already_downloaded(entry.href):
+                continue
+            if not (entry.issued or entry.href in issued_pages):
+                continue
+            with log_context(receipt_id=entry.row_id, phase="prefetch"):
+                context = contextvars.copy_context()
+            self.fetches[entry.href] = self.executor.submit(context.run, fetch_html, self.session, self.page_url(entry))
+            self.queue.append(entry)
+
+    def _html(self, entry):
+        future = self.fetches.pop(entry.href, None)
+        if future is None:
+            return fetch_html(self.session, self.page_url(entry))
+        return future.result(timeout=120)
+
+    def _load(self, entry):
+        """次のタブに領収書のHTMLを流し込む（読み込みの完了は待たない。印刷できないページなら None を返す）"""
+        html = self._html(entry)
+        # 未発行やログイン切れのページは流し込まず、ページを開く処理に任せる
+        if "print_button" not in html:
+            self.unprintable.add(entry.href)
+            return None
+        handle, frame_id = self.tabs[self.next_tab]
+        self.next_tab = (self.next_tab + 1) % len(self.tabs)
+        self.driver.switch_to.window(handle)
+        self.driver.execute_cdp_cmd("Page.setDocumentContent", {
+            "frameId": frame_id, "html": prepare_render_html(html, self.page_url(entry))})
+        self.loaded[handle] = entry.href
+        return handle
+
+    def _preload_next(self):
+        """先読みが終わっている次の領収書を、空いているタブに流し込んでおく"""
+        while self.queue and (self.queue[0].href not in self.fetches or is_already_downloaded(self.queue[0].href)):
+            self.queue.pop(0)
+        if len(self.tabs) < 2 or not self.queue:
+            return
+        entry = self.queue[0]
+        if not self.fetches[entry.href].done():
+            return
+        try:
+            self._load(entry)
+        except Exception as e:
+            logger.debug("次の領収書の流し込みに失敗しました: %s: %s", entry.href, e)
+
+    def _wait_ready(self):
+        deadline = time.time() + self.ready_timeout
+        while time.time() < deadline:
+            if self.driver.execute_script(RENDER_READY_SCRIPT):
+                return True
+            time.sleep(0.1)
+        return False
+
+    def render(self, driver, entry):
+        """領収書を印刷して保存し、ファイル名を返す（保存できなければ None を返し、呼び出し側でページを開く）"""
+        original = driver.current_window_handle
+        try:
+            self._ensure_tabs(driver)
+            original = driver.current_window_handle
+            if entry in self.queue:
+                self.queue.remove(entry)
+            handle = next((handle for handle, href in self.loaded.items() if href == entry.href), None)
+            if handle is None:
+                handle = None if entry.href in self.unprintable else self._load(entry)
+                if handle is None:
+                    self.unprintable.discard(entry.href)
+                    self.counts["fallback"] += 1
+                    return None
+            else:
+                driver.switch_to.window(handle)
+            del self.loaded[handle]
+            if not self._wait_ready():
+                logger.warning(f"流し込んだページの読み込みが終わりません。そのまま印刷します: {entry.href}")
+            
+            snapshot = capture_page_snapshot(driver)
+            receipt_number = extract_receipt_number(driver, snapshot)
+            record = extract_receipt_record(snapshot, receipt_number)
+            record.source_url = entry.href
+            driver.execute_script(HIDE_HEADER_SCRIPT, None)
+            pdf = print_page_pdf(driver)
+            # 印刷が終わったタブには、次の領収書を流し込んでおく（後処理はその読み込み中に行う）
+            self._preload_next()
+            pdf_file_name = store_receipt_output(postprocess_pdf(pdf), receipt_number, entry.href, record=record)
+            self.counts["rendered"] += 1
+            return pdf_file_name
+        except Exception as e:
+            logger.warning(f"タブへの流し込みで印刷できませんでした: {entry.href}: {str(e)}")
+            self.counts["fallback"] += 1
+            return None
+        finally:
+            try:
+                driver.switch_to.window(original)
+            except Exception:
+                pass
+
+    def summary(self):
+        return f"印刷用タブ: 流し込みで保存 {self.counts['rendered']} 件、ページを開いて保存 {self.counts['fallback']} 件"
+
+    def close(self):
+        for future in self.fetches.values():
+            future.cancel()
+        self.executor.shutdown(wait=False)
+        self.fetches.clear()
+        self.queue.clear()
+        self.unprintable.clear()
+
+def get_render_pool(driver):
+    """共有の印刷用タブを返す（初回はブラウザのCookieを引き継いだセッションで作成）"""
+    global render_pool
+    if render_pool is None:
+        render_pool = RenderPool(driver, get_http_session(driver), render_tabs, fetch_workers)
+    return render_pool
+
+@dataclass
+class DownloadResult:
+    """1件の領収書の処理結果"""
+    entry: ReceiptListEntry
+    # saved: 保存した / skipped: 保存済み / failed: 保存できなかった
+    status: str
+    file: str = None
+    manifest_entry: dict = None
+    error: str = None
+
+# 計画での分類（in_ledger: 保存済み、print: 発行済みで保存のみ、issue: 未発行のため発行してから保存）
+PLAN_ACTIONS = ("in_ledger", "print", "issue")
+
+@dataclass
+class PlannedReceipt:
+    """実行計画の1件"""
+    entry: ReceiptListEntry
+    action: str
+
+@dataclass
+class RunPlan:
+    """実行計画（--plan）"""
+    items: list
+    pages: int
+    counts: dict
+    estimated_seconds: float
+    # 段階ごとの (見積もりに使った秒数, 実績の件数)
+    phase_estimates: dict
+
+    def to_dict(self):
+        return {
+            "pages": self.pages,
+            "counts": self.counts,
+            "estimated_seconds": round(self.estimated_seconds, 1),
+            "phase_estimates": {phase: {"seconds": seconds, "samples": samples}
+                                for phase, (seconds, samples) in self.phase_estimates.items()},
+            "receipts": [{"action": item.action, "row_id": item.entry.row_id, "date": item.entry.date,
+                          "amount": item.entry.amount, "href": item.entry.href} for item in self.items]
+        }
+
+def format_duration(seconds):
+    """秒数を「1時間23分」のような表記にする"""
+    minutes = int(seconds // 60)
+    if minutes >= 60:
+        return f"{minutes // 60}時間{minutes % 60}分"
+    if minutes:
+        return f"{minutes}分{int(seconds % 60)}秒"
+    return f"{int(seconds)}秒"
+
+def print_plan(plan):
+    """実行計画を表示する"""
+    print("\n=== 実行計画（詳細ページは開かず、発行も行いません） ===")
+    print(f"一覧ページ: {plan.pages} ページ")
+    print(f"保存済み（スキップ）: {plan.counts['in_ledger']} 件")
+    print(f"発行済み（保存のみ）: {plan.counts['print']} 件")
+    print(f"未発行（発行してから保存、取り消しできません）: {plan.counts['issue']} 件")
+    for item in plan.items:
+        if item.action == "issue":
+            amount = f"¥{item.entry.amount:,}" if item.entry.amount is not None else "-"
+            print(f"  発行予定: {item.entry.date or '----------'}  {amount:>12}  {item.entry.href}")
+    print(f"見積もり所要時間: 約{format_duration(plan.estimated_seconds)}")
+    for phase, (seconds, samples) in plan.phase_estimates.items():
+        basis = f"直近 {samples} 件の中央値" if samples else "実績なし・既定値"
+        print(f"  {phase}: {seconds:.1f} 秒/件（{basis}）")
+
+class ReceiptClient:
+    """領収書の一覧取得とダウンロードを行うクライアント（CLIもこのクラスを使う）
+
+    使い方:
+        with ReceiptClient(download_dir="receipts") as client:
+            client.login()
+            for entry in client.iter_receipts():
+                result = client.download(entry)
+
+    処理の各関数はモジュールの設定を参照するため、同時に開けるクライアントは1プロセスにつき1つ
+    （複数のアカウントを並行して処理する場合は accounts サブコマンドでアカウントごとにプロセスを分ける）。
+    """
+
+    def __init__(self, download_dir=None, output_format="dir", archive_path=None, metadata_format="both",
+                 merge_monthly=False, keep_individual_files=True, index_path=DEFAULT_INDEX_PATH,
+                 prefer_direct_pdf=False, direct_pdf_backend="browser", rate_limit=DEFAULT_RATE_LIMIT,
+                 list_source="browser", cache_dir=DEFAULT_CACHE_DIR, cache_size_mb=200, profile_dir=None,
+                 watchdog=None, shard=None, selector_stats=SELECTOR_STATS_PATH, timings_file=PHASE_TIMINGS_PATH,
+                 status_file=None, metrics_file=None, metrics_interval=10.0, verify_workers=2,
+                 issue_backend="browser", render_backend="navigate", render_tabs=2, fetch_workers=4,
+                 pdf_profile="standard", base_url=None, record_dir=None, scrub=(), replay_dir=None, replay_latency=0.0,
+                 interactive=False, read_only=False, config=None):
+        self.download_dir = download_dir
+        self.output_format = output_format
+        self.archive_path = archive_path
+        self.metadata_format = metadata_format
+        self.merge_monthly = merge_monthly
+        self.keep_individual_files = keep_individual_files
+        self.index_path = index_path
+        self.prefer_direct_pdf = prefer_direct_pdf
+        self.direct_pdf_backend = direct_pdf_backend
+        self.rate_limit = rate_limit
+        self.list_source = list_source
+        self.cache_dir = cache_dir
+        self.cache_size_mb = cache_size_mb
+        self.profile_dir = profile_dir
+        # ブラウザ監視の設定（BrowserWatchdog の引数、None で監視しない）
+        self.watchdog = watchdog
+        self.shard = shard
+        self.selector_stats = selector_stats
+        self.timings_file = timings_file
+        self.status_file = status_file
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        # 保存後の検証に使うプロセス数（0で検証しない）
+        self.verify_workers = verify_workers
+        self.issue_backend = issue_backend
+        self.render_backend = render_backend
+        self.render_tabs = render_tabs
+        self.fetch_workers = fetch_workers
+        self.pdf_profile = pdf_profile
+        # 通信の記録先と、記録した通信を再生する場合の記録元（再生時はローカルのサーバーをサイトとして使う）
+        self.base_url = base_url
+        self.record_dir = record_dir
+        self.scrub = scrub
+        self.replay_dir = replay_dir
+        self.replay_latency = replay_latency
+        self.interactive = interactive
+        # 計画（--plan）だけを作る場合は、既存の保存先を読むだけでディレクトリや出力ファイルを作らない
+        self.read_only = read_only
+        self.config = config or {}
+        self.driver = None
+        self.processed = 0
+        self._temporary_profile = None
+        self._replay_server = None
+        self._previous_log_context = None
+        self.run_id = None
+        self._opened = False
+
+    @classmethod
+    def from_args(cls, args):
+        """コマンドライン引数からクライアントを作成する"""
+        watchdog = None
+        if not args.no_watchdog:
+            watchdog = {
+                "receipt_timeout": args.receipt_timeout,
+                "max_browser_memory_mb": args.max_browser_memory_mb,
+                "max_js_heap_mb": args.max_js_heap_mb,
+                "recycle_tab_every": args.recycle_tab_every,
+            }
+        if args.no_individual_files and not args.merge_monthly:
+            logger.warning("--no-individual-files は --merge-monthly と併用してください。領収書ごとのPDFを出力します")
+        return cls(
+            download_dir=args.download_dir,
+            output_format=args.output_format,
+            archive_path=args.archive_path,
+            metadata_format=args.metadata_format,
+            merge_monthly=args.merge_monthly,
+            keep_individual_files=not args.no_individual_files,
+            index_path=None if args.no_index else args.index_path,
+            prefer_direct_pdf=args.prefer_direct_pdf,
+            direct_pdf_backend=args.direct_pdf_backend,
+            rate_limit=args.rate_limit,
+            list_source=args.list_source,
+            cache_dir=None if args.no_cache else args.cache_dir,
+            cache_size_mb=args.cache_size_mb,
+            profile_dir=args.profile_dir,
+            watchdog=watchdog,
+            shard=args.shard,
+            selector_stats=args.selector_stats,
+            timings_file=args.timings_file,
+            status_file=args.status_file,
+            metrics_file=args.metrics_file,
+            metrics_interval=args.metrics_interval,
+            verify_workers=0 if args.no_verify else args.verify_workers,
+            issue_backend=args.issue_backend,
+            render_backend=args.render_backend,
+            render_tabs=args.render_tabs,
+            fetch_workers=args.fetch_workers,
+            pdf_profile=args.pdf_profile,
+            base_url=args.base_url,
+            record_dir=args.record,
+            scrub=args.scrub,
+            replay_dir=args.replay,
+            replay_latency=args.replay_latency,
+            interactive=not args.non_interactive,
+            read_only=args.plan,
+            config=load_config(args.config)
+        )
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """保存先・マニフェスト・出力先などを準備する（ブラウザは login で起動する）"""
+        global download_dir, manifest, output_backend, write_individual_files, selector_registry
+        global prefer_direct_pdf, direct_pdf_backend, rate_limiter, list_source, http_cache
+        global shard, interactive, phase_timings, progress_tracker, issue_backend
+        global render_backend, render_tabs, fetch_workers, pdf_profile, BASE_URL, traffic_recorder
+        if self._opened:
+            return
+        # この実行で出力するログに共通の実行IDを付ける
+        self.run_id = uuid.uuid4().hex[:12]
+        self._previous_log_context = log_context_var.get()
+        log_context_var.set({**self._previous_log_context, "run_id": self.run_id})
+        logger.info(f"実行を開始します（実行ID: {self.run_id}）")
+        # 記録した通信を再生する場合は、ローカルのサーバーをサイトの代わりに使う
+        if self.replay_dir:
+            self._replay_server = ReplayServer(FixtureStore(self.replay_dir), latency=self.replay_latency).start()
+            BASE_URL = self._replay_server.base_url
+        elif self.base_url:
+            BASE_URL = self.base_url.rstrip("/")
+        if self.record_dir:
+            traffic_recorder = TrafficRecorder(FixtureStore(self.record_dir), Scrubber(self.scrub))
+        if self.read_only:
+            progress_tracker = ProgressTracker()
+        else:
+            progress_tracker = ProgressTracker(self.status_file, self.metrics_file, self.metrics_interval)
+            progress_tracker.write(force=True)
+        
+        # 要素の取得方法の実績を読み込む（前回までに成功した方法から試す）
+        selector_registry = SelectorStrategyRegistry(self.selector_stats)
+        phase_timings = PhaseTimings(self.timings_file)
+        prefer_direct_pdf = self.prefer_direct_pdf
+        direct_pdf_backend = self.direct_pdf_backend
+        rate_limiter = RateLimiter(self.rate_limit)
+        list_source = self.list_source
+        issue_backend = self.issue_backend
+        issued_pages.clear()
+        render_backend = self.render_backend
+        render_tabs = self.render_tabs
+        fetch_workers = self.fetch_workers
+        pdf_profile = self.pdf_profile
+        # HTTPでページを取得する場合だけキャッシュを開く（計画の表示ではキャッシュを作らない）
+        uses_http = self.list_source == "http" or self.render_backend == "pool"
+        http_cache = (HttpCache(self.cache_dir, self.cache_size_mb * 1024 * 1024)
+                      if self.cache_dir and uses_http and not self.read_only else None)
+        interactive = self.interactive
+        receipt_sinks.clear()
+        requeued_urls.clear()
+        shard = self.shard
+        
+        if self.read_only:
+            self._open_read_only()
+            self._opened = True
+            return
+        
+        # ダウンロードディレクトリを作成（既存のディレクトリを指定すると保存済みの領収書は再取得しない）
+        download_dir = create_download_dir(self.download_dir)
+        # 分割実行では担当ごとのフォルダにマニフェストと領収書を保存し、後で merge でまとめる
+        if shard is not None:
+            download_dir = create_download_dir(os.path.join(download_dir, shard_directory_name(shard)))
+        self.download_dir = download_dir
+        manifest = load_manifest(download_dir)
+        output_backend = create_output_backend(self.output_format, download_dir, self.archive_path)
+        
+        # 月別PDFへの追記を設定（メタデータ出力より先に実行してファイル名を確定させる）
+        write_individual_files = True
+        if self.merge_monthly:
+            write_individual_files = self.keep_individual_files
+            receipt_sinks.append(MonthlyPdfMerger(download_dir, write_individual_files))
+        
+        # 領収書データの出力先を設定
+        if self.metadata_format != 'none':
+            formats = ("csv", "jsonl") if self.metadata_format == 'both' else (self.metadata_format,)
+            receipt_sinks.append(MetadataExporter(download_dir, formats))
+        
+        # 全文検索索引を保存のたびに更新する
+        if self.index_path:
+            receipt_sinks.append(ReceiptSearchIndex(self.index_path))
+        
+        # 保存した領収書を別プロセスで検証し、失敗したものは次回の実行で取得し直す
+        requeued_urls.update(load_requeue(download_dir, manifest))
+        if self.verify_workers:
+            receipt_sinks.append(ReceiptVerifier(download_dir, self.verify_workers))
+        self._opened = True
+
+    def _open_read_only(self):
+        """既存の保存先のマニフェストと再取得の記録を読むだけで、ディレクトリや出力を作らない"""
+        global download_dir, manifest, output_backend, write_individual_files
+        download_dir = os.path.abspath(self.download_dir) if self.download_dir else None
+        if download_dir and shard is not None:
+            download_dir = os.path.join(download_dir, shard_directory_name(shard))
+        self.download_dir = download_dir
+        write_individual_files = True
+        if not download_dir or not os.path.isdir(download_dir):
+            # 保存先がなければ、すべて未保存として計画する
+            logger.info(f"既存の保存先がないため、保存済みの領収書はないものとして計画します: {download_dir or '-'}")
+            manifest = None
+            output_backend = None
+            return
+        manifest = load_manifest(download_dir)
+        output_backend = DirectoryOutput(download_dir)
+        requeued_urls.update(load_requeue(download_dir, manifest))
+
+    def start_browser(self):
+        """ブラウザを起動する（監視で再起動してもログイン状態が残るよう、プロファイルを固定する）"""
+        global download_manager, browser_watchdog
+        self.open()
+        if self.driver is not None:
+            return self.driver
+        browser_downloads = self.prefer_direct_pdf and self.direct_pdf_backend == "browser" and not self.read_only
+        profile_dir = self.profile_dir
+        if profile_dir is None and self.watchdog is not None:
+            profile_dir = self._temporary_profile = tempfile.mkdtemp(prefix="receipt_chrome_profile_")
+        record_network = traffic_recorder is not None
+        self.driver = setup_chrome_driver(enable_download_events=browser_downloads, profile_dir=profile_dir,
+                                          record_network=record_network)
+        
+        def on_browser_restart(new_driver):
+            global download_manager
+            self.driver = new_driver
+            if browser_downloads:
+                download_manager = CdpDownloadManager(new_driver, os.path.join(download_dir, ".downloads"))
+            # プロファイルのCookieでログイン状態を確認し、切れていれば再ログインしてもらう
+            new_driver.get(f'{BASE_URL}/mypage')
+            wait_for_page_load(new_driver)
+            if '/login' in new_driver.current_url:
+                with browser_watchdog.paused():
+                    perform_manual_login(new_driver)
+        
+        if self.watchdog is not None:
+            browser_watchdog = BrowserWatchdog(
+                self.driver, lambda: setup_chrome_driver(enable_download_events=browser_downloads, profile_dir=profile_dir,
+                                                         record_network=record_network),
+                on_browser_restart, **self.watchdog)
+        if browser_downloads:
+            download_manager = CdpDownloadManager(self.driver, os.path.join(download_dir, ".downloads"))
+        return self.driver
+
+    def login(self):
+        """ブラウザを起動して手動ログインを待つ（成功すれば True）"""
+        return perform_manual_login(self.start_browser())
+
+    def iter_pages(self, start_page=1):
+        """支払一覧ページを順に読み込み、(ページ番号, 担当分の領収書エントリ一覧) を返す"""
+        if self.list_source == "http":
+            # ログイン済みのブラウザからCookieを引き継いだセッションを使う
+            pages = iter_receipt_pages_http(http_session or get_http_session(self.start_browser()))
+        else:
+            pages = self._iter_pages_browser(start_page)
+        for page_num, entries in pages:
+            if page_num < start_page:
+                continue
+            yield page_num, [entry for entry in entries if entry_in_shard(entry, shard)]
+
+    def _iter_pages_browser(self, start_page):
+        seen = set()
+        page_num = start_page
+        while True:
+            driver = self.start_browser() if browser_watchdog is None else browser_watchdog.driver
+            started = time.time()
+            driver.get(payments_page_url(page_num))
+            wait_for_page_load(driver)
+            entries = [entry for entry in get_receipt_entries(driver, page_num) if entry.href not in seen]
+            get_phase_timings().record("list_page_browser", time.time() - started)
+            # 最終ページより先は空か、同じ内容が表示される
+            if not entries:
+                return
+            seen.update(entry.href for entry in entries)
+            yield page_num, entries
+            page_num += 1
+
+    def iter_receipts(self, start_page=1):
+        """領収書エントリを1件ずつ返す（一覧ページは必要になった時点で1ページずつ読み込む）"""
+        for _, entries in self.iter_pages(start_page):
+            yield from entries
+
+    def plan(self):
+        """詳細ページを開かず、一覧ページだけから実行計画（RunPlan）を作成する"""
+        pages = 0
+        items = []
+        for _, entries in self.iter_pages():
+            pages += 1
+            for entry in entries:
+                if is_already_downloaded(entry.href):
+                    action = "in_ledger"
+                else:
+                    action = "print" if entry.issued else "issue"
+                items.append(PlannedReceipt(entry, action))
+        
+        timings = phase_timings or get_phase_timings()
+        list_seconds, list_samples = timings.estimate(f"list_page_{self.list_source}")
+        issued_seconds, issued_samples = timings.estimate("receipt_issued")
+        unissued_seconds, unissued_samples = timings.estimate("receipt_unissued")
+        counts = {action: sum(1 for item in items if item.action == action) for action in PLAN_ACTIONS}
+        estimate = pages * list_seconds + counts["print"] * issued_seconds + counts["issue"] * unissued_seconds
+        return RunPlan(items, pages, counts, estimate,
+                       {"list_page": (list_seconds, list_samples), "receipt_issued": (issued_seconds, issued_samples),
+                        "receipt_unissued": (unissued_seconds, unissued_samples)})
+
+    def issue_pending(self, entries):
+        """未発行の領収書をHTTPでまとめて発行する（issue_backend が http の場合のみ）、発行を試みた件数を返す"""
+        if self.issue_backend != "http":
+            return 0
+        return issue_pending_http(http_session or get_http_session(self.start_browser()), entries)
+
+    def download(self, entry):
+        """1件の領収書を保存し、DownloadResult を返す"""
+        saved = manifest.find_by_url(entry.href)
+        if is_already_downloaded(entry.href):
+            progress_tracker.begin()
+            progress_tracker.finish("skipped")
+            return DownloadResult(entry, "skipped", saved.get("file"), saved)
+        self.processed += 1
+        progress_tracker.begin()
+        try:
+            process_receipt_watched(self.start_browser(), entry, self.processed)
+            # スクリーンショットで代替した場合は、PDF化して保存されるまで待つ
+            wait_for_captures(entry.href)
+        except Exception as e:
+            logger.error(f"領収書 {entry.row_id} の処理中にエラー: {str(e)}")
+            progress_tracker.finish("failed")
+            return DownloadResult(entry, "failed", error=str(e))
+        saved = manifest.find_by_url(entry.href)
+        if saved is None:
+            progress_tracker.finish("failed")
+            return DownloadResult(entry, "failed", error="ファイルを保存できませんでした")
+        progress_tracker.finish()
+        return DownloadResult(entry, "saved", saved.get("file"), saved)
+
+    def close(self):
+        """ブラウザを閉じ、出力先と保存先を閉じる"""
+        global browser_watchdog, download_manager, http_downloader, http_session, http_cache, render_pool
+        global traffic_recorder, capture_executor
+        if render_pool is not None:
+            logger.info(render_pool.summary())
+            render_pool.close()
+            render_pool = None
+        if http_downloader is not None:
+            http_downloader.close()
+            http_downloader = None
+        http_session = None
+        if http_cache is not None:
+            logger.info(http_cache.summary())
+            http_cache.close()
+            http_cache = None
+        if browser_watchdog is not None:
+            logger.info(browser_watchdog.summary())
+            self.driver = browser_watchdog.driver
+            browser_watchdog = None
+        download_manager = None
+        if traffic_recorder is not None:
+            if self.driver is not None:
+                traffic_recorder.poll(self.driver)
+            logger.info(f"通信を {traffic_recorder.count} 件記録しました: {self.record_dir}")
+            traffic_recorder = None
+        if self.driver is not None:
+            # ブラウザを閉じる
+            try:
+                self.driver.quit()
+            except Exception as e:
+                logger.error(f"ブラウザの終了中にエラー: {str(e)}")
+            self.driver = None
+            logger.info("ブラウザを閉じました")
+        if self._temporary_profile:
+            shutil.rmtree(self._temporary_profile, ignore_errors=True)
+            self._temporary_profile = None
+        if capture_executor is not None:
+            # 代替保存のPDF化が残っていれば、出力先を閉じる前に終わらせる
+            capture_executor.shutdown(wait=True)
+            capture_executor = None
+        if self._replay_server is not None:
+            logger.info(self._replay_server.summary())
+            self._replay_server.close()
+            self._replay_server = None
+        if self._opened:
+            if output_backend is not None:
+                output_backend.close()
+            for sink in receipt_sinks:
+                sink.close()
+            receipt_sinks.clear()
+            selector_registry.save()
+            phase_timings.save()
+            progress_tracker.close()
+            log_context_var.set(self._previous_log_context)
+            self._opened = False
+
+def add_run_arguments(parser, suppress_defaults=False):
+    """ダウンロード処理（run）の引数を追加する（サブコマンド側では指定された値だけを上書きする）"""
+    def default(value):
+        return argparse.SUPPRESS if suppress_defaults else value
+    
+    parser.add_argument('--non-interactive', action='store_true', default=default(False),
+                        help='確認の入力を待たない（既定の選択肢で続行し、手動操作が必要な領収書は失敗として扱う）')
+    parser.add_argument('--download-dir', default=default(None),
+                        help='領収書のダウンロード先ディレクトリ')
+    parser.add_argument('--headless', action='store_true', default=default(False),
+                        help='ヘッドレスモードで実行（手動ログイン時は無効）')
+    parser.add_argument('--output-format', choices=['dir', 'zip', 'tar'], default=default('dir'),
+                        help='出力形式（dir: ファイル、zip/tar: 1つのアーカイブにまとめる）')
+    parser.add_argument('--archive-path', default=default(None),
+                        help='アーカイブの出力先（省略時はダウンロードディレクトリ内に作成）')
+    parser.add_argument('--merge-monthly', action='store_true', default=default(False),
+                        help='支払月ごとに1つのPDF（領収書_YYYY-MM.pdf）へ追記する')
+    parser.add_argument('--no-individual-files', action='store_true', default=default(False),
+                        help='領収書ごとのPDFを出力しない（--merge-monthly と併用）')
+    parser.add_argument('--metadata-format', choices=['csv', 'jsonl', 'both', 'none'], default=default('both'),
+                        help='領収書データ（番号、日付、金額、税額、宛名）の出力形式')
+    parser.add_argument('--prefer-direct-pdf', action='store_true', default=default(False),
+                        help='ページにPDFへのリンクがあれば、印刷せずにブラウザでダウンロードする')
+    parser.add_argument('--direct-pdf-backend', choices=['browser', 'http'], default=default('browser'),
+                        help='直接ダウンロードの方法（browser: ブラウザ、http: 共有セッションでストリーミング保存）')
+    parser.add_argument('--rate-limit', type=float, default=default(DEFAULT_RATE_LIMIT),
+                        help='サーバーへのHTTPリクエストの上限（毎秒の回数、全体で共有）')
+    parser.add_argument('--issue-backend', choices=['browser', 'http'], default=default('browser'),
+                        help='領収書の発行方法（http: 発行フォームを直接送信し、想定外の場合はブラウザで発行）')
+    parser.add_argument('--render-backend', choices=['navigate', 'pool'], default=default('navigate'),
+                        help='発行済みの領収書の印刷方法（pool: HTTPで先読みしたHTMLを待機中のタブに流し込んで印刷）')
+    parser.add_argument('--render-tabs', type=int, default=default(2),
+                        help='--render-backend pool で使う印刷用のタブの数（既定: 2）')
+    parser.add_argument('--fetch-workers', type=int, default=default(4),
+                        help='--render-backend pool で領収書ページを先読みするスレッド数（既定: 4）')
+    parser.add_argument('--pdf-profile', choices=list(PDF_PROFILES), default=default('standard'),
+                        help='PDFの出力プロファイル（archival: 長期保存向け、compact: 背景なし・圧縮して容量を抑える）')
+    parser.add_argument('--base-url', default=default(None),
+                        help='サイトのURL（既定: https://crowdworks.jp、replay で起動した再生サーバーなどを指定）')
+    parser.add_argument('--record', default=default(None), metavar='DIR',
+                        help='実行中の通信を指定したディレクトリに記録する（Cookieは記録せず、個人情報は伏せる）')
+    parser.add_argument('--scrub', action='append', default=default([]), metavar='TEXT',
+                        help='記録時に伏せる文字列（氏名など、複数指定可）')
+    parser.add_argument('--replay', default=default(None), metavar='DIR',
+                        help='--record で記録した通信を再生するサーバーを起動し、サイトの代わりに使う')
+    parser.add_argument('--replay-latency', type=float, default=default(0.0),
+                        help='再生時に各応答を遅らせる秒数')
+    parser.add_argument('--list-source', choices=['browser', 'http'], default=default('browser'),
+                        help='支払一覧ページの取得方法（http: ブラウザのCookieを使ってHTTPで取得し、キャッシュを利用）')
+    parser.add_argument('--cache-dir', default=default(DEFAULT_CACHE_DIR),
+                        help='HTTPキャッシュの保存先')
+    parser.add_argument('--cache-size-mb', type=int, default=default(200),
+                        help='HTTPキャッシュの上限サイズ（MB、超えた分は古いものから削除）')
+    parser.add_argument('--no-cache', action='store_true', default=default(False),
+                        help='HTTPキャッシュを使わない')
+    parser.add_argument('--profile-dir', default=default(None),
+                        help='Chromeのプロファイルの保存先（ログイン状態を保持し、ブラウザの再起動後も引き継ぐ）')
+    parser.add_argument('--receipt-timeout', type=int, default=default(300),
+                        help='1件の領収書の処理時間の上限（秒、超えるとブラウザを再起動して再試行）')
+    parser.add_argument('--max-browser-memory-mb', type=int, default=default(2048),
+                        help='ブラウザの使用メモリ（RSS）の上限（MB、超えるとブラウザを再起動）')
+    parser.add_argument('--max-js-heap-mb', type=int, default=default(512),
+                        help='ページのJSヒープの上限（MB、超えるとタブを作り直す）')
+    parser.add_argument('--recycle-tab-every', type=int, default=default(50),
+                        help='指定した件数ごとにタブを作り直す（0で無効）')
+    parser.add_argument('--no-watchdog', action='store_true', default=default(False),
+                        help='ブラウザの監視（処理時間の上限、タブの作り直し、再起動）を行わない')
+    parser.add_argument('--shard', type=parse_shard, default=default(None),
+                        help='領収書をN分割したうちK番目だけを処理する（例: 1/3）。結果は shard-K-of-N フォルダに保存')
+    parser.add_argument('--plan', action='store_true', default=default(False),
+                        help='一覧ページだけを読み、発行済み・未発行・保存済みの件数と所要時間の見積もりを表示して終了する')
+    parser.add_argument('--plan-output', default=default(None),
+                        help='--plan の結果をJSONで保存するファイル')
+    parser.add_argument('--status-file', default=default(None),
+                        help='進捗（件数・処理速度・残り時間）を定期的に書き出すJSONファイル')
+    parser.add_argument('--metrics-file', default=default(None),
+                        help='進捗をPrometheusのテキスト形式で書き出すファイル（node_exporter の textfile collector 用）')
+    parser.add_argument('--metrics-interval', type=float, default=default(10.0),
+                        help='進捗ファイルを書き出す間隔（秒）')
+    parser.add_argument('--verify-workers', type=int, default=default(2),
+                        help='保存した領収書を検証するプロセス数')
+    parser.add_argument('--no-verify', action='store_true', default=default(False),
+                        help='保存した領収書を検証しない')
+    parser.add_argument('--timings-file', default=default(PHASE_TIMINGS_PATH),
+                        help='処理の段階ごとの所要時間の実績を保存するファイル（--plan の見積もりに使用）')
+    parser.add_argument('--selector-stats', default=default(SELECTOR_STATS_PATH),
+                        help='要素の取得方法ごとの実績を保存するファイル')
+    parser.add_argument('--index-path', default=default(DEFAULT_INDEX_PATH),
+                        help='全文検索索引（SQLite）のパス')
+    parser.add_argument('--no-index', action='store_true', default=default(False),
+                        help='全文検索索引を更新しない')
+
+# ログファイルの既定の名前と、指定がなくてもログファイルに出力するコマンド（None はサブコマンドの省略）
+DEFAULT_LOG_FILE = "receipt_download_manual.log"
+LOGGED_COMMANDS = (None, 'run', 'soak', 'accounts')
+
+def parse_arguments(argv=None):
     """コマンドライン引数を解析する"""
     parser = argparse.ArgumentParser(description='Crowdworksから領収書をダウンロードするスクリプト')
-    parser.add_argument('--download-dir', default=None,
-                        help='領収書のダウンロード先ディレクトリ')
-    parser.add_argument('--log-file', default='receipt_download_manual.log',
-                        help='ログファイル名')
+    parser.add_argument('--log-file', default=None,
+                        help=f'ログファイル名（既定: {DEFAULT_LOG_FILE}、run・soak・accounts 以外は指定した場合だけ出力）')
+    parser.add_argument('--log-format', choices=['json', 'text'], default='json',
+                        help='ログの形式（json: 1行1レコードで実行ID・領収書ID・処理段階を含む、text: 従来の形式）')
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING'], default='INFO',
+                        help='出力するログの最低レベル')
+    parser.add_argument('--log-max-mb', type=float, default=10,
+                        help='ログファイルを切り替えるサイズ（MB）')
+    parser.add_argument('--log-backups', type=int, default=5,
+                        help='残す古いログファイルの数')
     parser.add_argument('--config', default='config.json',
                         help='設定ファイルのパス')
-    parser.add_argument('--headless', action='store_true',
-                        help='ヘッドレスモードで実行（手動ログイン時は無効）')
-    return parser.parse_args()
+    add_run_arguments(parser)
+    
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run', help='ログインして領収書をダウンロードする（サブコマンド省略時と同じ）')
+    add_run_arguments(run_parser, suppress_defaults=True)
+    status_parser = subparsers.add_parser('status', help='保存済みの件数・容量・最終保存日時を表示する')
+    status_parser.add_argument('directory', nargs='?', help='ダウンロード先のディレクトリ')
+    status_parser.add_argument('--json', action='store_true', help='JSONで出力する')
+    ledger_parser = subparsers.add_parser('list-ledger', help='マニフェストの記録を一覧表示する')
+    ledger_parser.add_argument('directory', nargs='?', help='ダウンロード先のディレクトリ')
+    ledger_parser.add_argument('--month', default=None, help='支払月で絞り込む（YYYY-MM）')
+    ledger_parser.add_argument('--format', choices=['tsv', 'jsonl'], default='tsv', help='出力形式')
+    verify_parser = subparsers.add_parser('verify', help='保存済みファイルの有無と内容を確認する')
+    verify_parser.add_argument('directory', nargs='?', help='ダウンロード先のディレクトリ')
+    verify_parser.add_argument('--workers', type=int, default=max((os.cpu_count() or 2) - 1, 1),
+                               help='検査に使うプロセス数')
+    verify_parser.add_argument('--requeue', action='store_true',
+                               help='問題のある領収書を requeue.jsonl に記録し、次回の実行で取得し直す')
+    bench_parser = subparsers.add_parser('bench', help='ブラウザを使わない処理の所要時間を計測する')
+    bench_parser.add_argument('--repeat', type=int, default=20, help='各処理の繰り返し回数')
+    bench_parser.add_argument('--json', action='store_true', help='JSONで出力する')
+    bench_parser.add_argument('--fixtures', default=None, metavar='DIR',
+                              help='--record で記録した一覧ページの解析も計測する')
+    accounts_parser = subparsers.add_parser('accounts', help='設定ファイルの複数アカウントを並行して実行する')
+    accounts_parser.add_argument('config_file', help='アカウントの設定ファイル（JSON）')
+    accounts_parser.add_argument('--only', nargs='+', default=None, metavar='NAME',
+                                 help='指定したアカウントだけを実行する')
+    accounts_parser.add_argument('--max-browsers', type=int, default=None,
+                                 help='同時に起動するブラウザの数（既定: 設定ファイルの max_browsers、なければ2）')
+    accounts_parser.add_argument('--max-cpu', type=int, default=None,
+                                 help='全体で使うCPUの数（既定: 設定ファイルの max_cpu、なければCPU数）')
+    accounts_parser.add_argument('--rate-limit', type=float, default=None,
+                                 help='全アカウント合計のリクエスト数の上限（毎秒、既定: 設定ファイルの rate_limit）')
+    accounts_parser.add_argument('--interval', type=float, default=10.0,
+                                 help='進捗を表示する間隔（秒）')
+    soak_parser = subparsers.add_parser('soak', help='合成サイトで多数の領収書を処理し、メモリと処理時間の増え方を計測する')
+    add_run_arguments(soak_parser, suppress_defaults=True)
+    soak_parser.add_argument('--receipts', type=int, default=2000, help='合成する領収書の数')
+    soak_parser.add_argument('--sample-every', type=int, default=50, help='計測する間隔（件数）')
+    soak_parser.add_argument('--warmup', type=int, default=100,
+                             help='傾きに含めない最初の件数（キャッシュなどが落ち着くまで）')
+    soak_parser.add_argument('--latency', type=float, default=0.0, help='合成サイトの各応答を遅らせる秒数')
+    soak_parser.add_argument('--max-python-growth-mb', type=float, default=20.0,
+                             help='Pythonの確保メモリ（tracemalloc）の1000件あたりの増加の上限（MB、超えると終了コード1）')
+    soak_parser.add_argument('--max-rss-growth-mb', type=float, default=50.0,
+                             help='PythonのRSSの1000件あたりの増加の上限（MB、解放済みでもOSに返らない領域を含むため大きめ）')
+    soak_parser.add_argument('--max-chrome-growth-mb', type=float, default=200.0,
+                             help='ChromeのRSSの1000件あたりの増加の上限（MB）')
+    soak_parser.add_argument('--max-latency-growth-ms', type=float, default=500.0,
+                             help='1件あたりの処理時間の1000件あたりの増加の上限（ミリ秒）')
+    soak_parser.add_argument('--top', type=int, default=10, help='Pythonのメモリが増えた箇所を表示する数')
+    soak_parser.add_argument('--report', default=None, metavar='FILE', help='計測値と傾きをJSONで書き出す')
+    soak_parser.add_argument('--keep-work-dir', action='store_true', help='保存したPDFなどの作業用ディレクトリを残す')
+    replay_parser = subparsers.add_parser('replay', help='--record で記録した通信を返すサーバーを起動する')
+    replay_parser.add_argument('directory', help='記録したディレクトリ')
+    replay_parser.add_argument('--host', default='127.0.0.1', help='待ち受けるアドレス')
+    replay_parser.add_argument('--port', type=int, default=8000, help='待ち受けるポート')
+    replay_parser.add_argument('--latency', type=float, default=0.0, help='各応答を遅らせる秒数')
+    search_parser = subparsers.add_parser('search', help='ダウンロード済みの領収書を検索する')
+    search_parser.add_argument('query', nargs='*',
+                               help='検索語（空白区切りでAND検索、宛名・番号・本文が対象）')
+    search_parser.add_argument('--month', default=None,
+                               help='支払月で絞り込む（YYYY-MM）')
+    search_parser.add_argument('--limit', type=int, default=50,
+                               help='表示する最大件数')
+    search_parser.add_argument('--index-path', default=argparse.SUPPRESS,
+                               help='全文検索索引（SQLite）のパス')
+    merge_parser = subparsers.add_parser('merge', help='分割実行（--shard）の結果を1つにまとめる')
+    merge_parser.add_argument('sources', nargs='+',
+                              help='マージ元のディレクトリ（shard-* を含むディレクトリも指定可）')
+    merge_parser.add_argument('--output', required=True,
+                              help='マージ先のディレクトリ（既存のマニフェストがあれば追記）')
+    return parser.parse_args(argv)
 
 def load_config(config_path):
     """設定ファイルを読み込む"""
@@ -1233,18 +5264,35 @@ def load_config(config_path):
             return json.load(f)
     return {}
 
-def main():
+# ブラウザを使わないサブコマンド（Seleniumを読み込まずに実行する）
+COMMANDS = {
+    'search': run_search,
+    'merge': run_merge,
+    'status': run_status,
+    'list-ledger': run_list_ledger,
+    'verify': run_verify,
+    'bench': run_bench,
+    'replay': run_replay,
+    'accounts': run_accounts,
+}
+
+def main(argv=None):
     """メイン処理"""
-    global download_dir
+    args = parse_arguments(argv)
     
     # ログ設定を変更（コンソール出力を無効化）
-    setup_logging()
-    
-    # タイムスタンプ付きのダウンロードディレクトリを作成
-    download_dir = create_download_dir()
+    # 集計や検索などのコマンドは、指定がなければ作業ディレクトリにログファイルを作らない
+    if args.log_file or args.command in LOGGED_COMMANDS:
+        setup_logging(args.log_file or DEFAULT_LOG_FILE, args.log_format, args.log_level,
+                      int(args.log_max_mb * 1024 * 1024), args.log_backups)
+    if args.command in COMMANDS:
+        return COMMANDS[args.command](args)
+    if args.command == 'soak':
+        return run_soak(args)
     
     # 領収書ダウンロード処理の実行
-    download_receipts_with_manual_login(download_dir=download_dir)
+    with ReceiptClient.from_args(args) as client:
+        download_receipts_with_manual_login(client, plan_only=args.plan, plan_output=args.plan_output)
 
 def wait_for_page_load(driver, timeout=30):
     """ページの読み込みが完了するまで待機する"""
@@ -1256,6 +5304,10 @@ def wait_for_page_load(driver, timeout=30):
     except Exception as e:
         logger.warning(f"ページの読み込み待機中にエラー: {str(e)}")
         return False
+    finally:
+        # 通信の記録中は、読み込んだページの通信を保存する
+        if traffic_recorder is not None:
+            traffic_recorder.poll(driver)
 
 def safe_click(driver, element):
     """要素を安全にクリックする（複数の方法を試す）"""
@@ -1269,14 +5321,14 @@ def safe_click(driver, element):
             driver.execute_script("arguments[0].click();", element)
             return True
         except Exception as e:
-            logger.debug(f"JavaScriptクリックに失敗: {str(e)}")
+            logger.debug("JavaScriptクリックに失敗: %s", e)
         
         # 方法2: 通常のクリック
         try:
             element.click()
             return True
         except Exception as e:
-            logger.debug(f"通常クリックに失敗: {str(e)}")
+            logger.debug("通常クリックに失敗: %s", e)
         
         # 方法3: ActionChainsを使用
         try:
@@ -1284,7 +5336,7 @@ def safe_click(driver, element):
             ActionChains(driver).move_to_element(element).click().perform()
             return True
         except Exception as e:
-            logger.debug(f"ActionChainsクリックに失敗: {str(e)}")
+            logger.debug("ActionChainsクリックに失敗: %s", e)
         
         # 方法4: href属性を取得して直接移動
         try:
@@ -1294,7 +5346,7 @@ def safe_click(driver, element):
                 driver.get(href)
                 return True
         except Exception as e:
-            logger.debug(f"直接URL移動に失敗: {str(e)}")
+            logger.debug("直接URL移動に失敗: %s", e)
         
         logger.error("すべてのクリック方法が失敗しました")
         return False
@@ -1302,20 +5354,212 @@ def safe_click(driver, element):
         logger.error(f"safe_click処理中にエラー: {str(e)}")
         return False
 
-def display_progress(current, total, description="処理中"):
-    """進捗状況を表示する（時間表示なし）"""
+def display_progress(current, total, description="処理中", suffix=""):
+    """進捗状況を表示する（suffix に処理速度や残り時間を添える）"""
     progress = min(current / total * 100, 100)
     bar_length = 40  # バーの長さを調整
-    filled_length = int(bar_length * current / total)
+    filled_length = min(int(bar_length * current / total), bar_length)
     
     bar = '█' * filled_length + '░' * (bar_length - filled_length)
     
-    # シンプルな進捗バーのみを表示
-    print(f"\r{description}:[{bar}]{progress:.1f}%({current}/{total})", end='          \r')
+    print(f"\r{description}:[{bar}]{progress:.1f}%({current}/{total}){suffix}", end='          \r')
     
     if current == total:
         print()  # 改行
 
+# 領収書ごとの結果（printed: 発行済みを保存、issued: 発行して保存、screenshot: スクリーンショットで代替、
+# manual: 手動で保存、skipped: 保存済み、failed: 保存できなかった）
+RECEIPT_OUTCOMES = ("printed", "issued", "screenshot", "manual", "skipped", "failed")
+OUTCOME_LABELS = {"printed": "保存", "issued": "発行", "screenshot": "代替", "manual": "手動",
+                  "skipped": "スキップ", "failed": "失敗"}
+
+def receipt_outcome(entry, already_saved):
+    """処理に成功した領収書の結果の種類を返す"""
+    if already_saved:
+        return "skipped"
+    if entry.href in pending_captures:
+        return "screenshot"
+    saved = manifest.find_by_url(entry.href)
+    if saved is None:
+        return "manual"
+    if saved.get("capture") == "screenshot" or saved["file"].endswith(".png"):
+        return "screenshot"
+    return "printed" if entry.issued else "issued"
+
+class ProgressTracker:
+    """処理速度・残り時間・結果ごとの件数を集計し、状態ファイル（JSON）とPrometheus用のテキストに書き出す"""
+    WINDOW = 20
+
+    def __init__(self, status_file=None, metrics_file=None, interval=10.0):
+        self.status_file = status_file
+        self.metrics_file = metrics_file
+        self.interval = interval
+        self.started_at = time.time()
+        # 処理速度は時刻の補正や粗い時計の影響を受けないよう、単調増加の時計で計る
+        self._started_monotonic = time.monotonic()
+        self.counts = {outcome: 0 for outcome in RECEIPT_OUTCOMES}
+        self.retry_seconds = 0.0
+        self.saved_files = 0
+        self.saved_bytes = 0
+        self.expected = 0
+        self.expected_exact = False
+        self.completions = []
+        self.last_progress_at = self.started_at
+        self.last_written_at = 0.0
+        self.running = True
+        self._first_attempt_end = None
+        self._last_outcome = None
+
+    @property
+    def done(self):
+        return sum(self.counts.values())
+
+    def set_expected(self, total, exact=False):
+        self.expected = total
+        self.expected_exact = exact
+
+    def update_estimate(self, pages_done, total_pages, receipts_seen):
+        """一覧ページを読むたびに、読んだページの平均件数から総件数の見積もりを更新する"""
+        if self.expected_exact or not pages_done or total_pages < pages_done:
+            return
+        self.expected = receipts_seen + round(receipts_seen / pages_done * (total_pages - pages_done))
+
+    def begin(self):
+        self._first_attempt_end = None
+        self._last_outcome = None
+
+    def attempt_done(self, outcome):
+        """1回の試行が終わったときに呼ぶ（2回目以降の試行と待ち時間を再試行の時間として集計する）"""
+        if self._first_attempt_end is None:
+            self._first_attempt_end = time.monotonic()
+        self._last_outcome = outcome
+
+    def finish(self, outcome=None):
+        """1件の処理が終わったときに呼ぶ（outcome を省略すると最後の試行の結果を使う）"""
+        now = time.monotonic()
+        if self._first_attempt_end is not None:
+            self.retry_seconds += now - self._first_attempt_end
+        outcome = outcome or self._last_outcome or "failed"
+        self.counts[outcome] += 1
+        self.completions = (self.completions + [now])[-self.WINDOW:]
+        self.last_progress_at = time.time()
+        self.write()
+
+    def add_saved(self, size):
+        """新しく保存したファイルの容量を集計する"""
+        self.saved_files += 1
+        self.saved_bytes += size
+
+    def bytes_per_receipt(self):
+        """新しく保存した領収書1件あたりの平均容量（バイト）"""
+        return self.saved_bytes / self.saved_files if self.saved_files else 0.0
+
+    def rate_per_minute(self):
+        """直近 WINDOW 件の処理速度（件/分）"""
+        span = self.completions[-1] - self.completions[0] if len(self.completions) >= 2 else 0.0
+        if span <= 0:
+            # 直近の件数が足りないか、同じ時刻に終わった場合は開始からの平均を使う
+            elapsed = time.monotonic() - self._started_monotonic
+            return self.done / elapsed * 60 if self.done and elapsed > 0 else 0.0
+        return (len(self.completions) - 1) / span * 60
+
+    def eta_seconds(self):
+        rate = self.rate_per_minute()
+        if not self.expected or not rate:
+            return None
+        return max(self.expected - self.done, 0) / rate * 60
+
+    def display(self):
+        """進捗バーに処理速度・残り時間・結果ごとの件数を添えて表示する"""
+        eta = self.eta_seconds()
+        counts = " ".join(f"{OUTCOME_LABELS[outcome]}{count}" for outcome, count in self.counts.items() if count)
+        suffix = f" {self.rate_per_minute():.1f}件/分"
+        if eta is not None:
+            suffix += f" 残り約{format_duration(eta)}"
+        if counts:
+            suffix += f" [{counts}]"
+        if self.retry_seconds >= 1:
+            suffix += f" 再試行{format_duration(self.retry_seconds)}"
+        if self.expected:
+            display_progress(min(self.done + 1, self.expected), self.expected, "領収書ダウンロード", suffix)
+        else:
+            print(f"\r領収書ダウンロード: {self.done + 1} 件目{suffix}", end='          \r')
+
+    def snapshot(self):
+        eta = self.eta_seconds()
+        return {
+            "running": self.running,
+            "started_at": datetime.fromtimestamp(self.started_at).isoformat(timespec='seconds'),
+            "updated_at": datetime.now().isoformat(timespec='seconds'),
+            "last_progress_at": datetime.fromtimestamp(self.last_progress_at).isoformat(timespec='seconds'),
+            "done": self.done,
+            "expected": self.expected,
+            "expected_exact": self.expected_exact,
+            "counts": self.counts,
+            "rate_per_minute": round(self.rate_per_minute(), 2),
+            "eta_seconds": None if eta is None else round(eta),
+            "retry_seconds": round(self.retry_seconds, 1),
+            "saved_files": self.saved_files,
+            "saved_bytes": self.saved_bytes,
+            "bytes_per_receipt": round(self.bytes_per_receipt())
+        }
+
+    def prometheus_text(self):
+        """node_exporter の textfile collector 形式の内容を返す"""
+        lines = [
+            "# HELP receipt_download_receipts_total Receipts processed, by outcome.",
+            "# TYPE receipt_download_receipts_total counter",
+        ]
+        lines += [f'receipt_download_receipts_total{{outcome="{outcome}"}} {count}'
+                  for outcome, count in self.counts.items()]
+        lines += [
+            "# HELP receipt_download_saved_bytes_total Bytes of newly saved receipt files.",
+            "# TYPE receipt_download_saved_bytes_total counter",
+            f"receipt_download_saved_bytes_total {self.saved_bytes}",
+        ]
+        eta = self.eta_seconds()
+        gauges = [
+            ("receipt_download_expected_receipts", "Expected number of receipts in this run.", self.expected),
+            ("receipt_download_rate_per_minute", "Receipts per minute over the recent window.", round(self.rate_per_minute(), 3)),
+            ("receipt_download_eta_seconds", "Estimated seconds until the run finishes.", -1 if eta is None else round(eta)),
+            ("receipt_download_retry_seconds_total", "Seconds spent on retries.", round(self.retry_seconds, 3)),
+            ("receipt_download_bytes_per_receipt", "Average size of newly saved receipt files.", round(self.bytes_per_receipt())),
+            ("receipt_download_start_timestamp_seconds", "Unix time the run started.", round(self.started_at)),
+            ("receipt_download_last_progress_timestamp_seconds", "Unix time a receipt last finished.", round(self.last_progress_at)),
+            ("receipt_download_running", "1 while the run is in progress.", int(self.running)),
+        ]
+        for name, help_text, value in gauges:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def write(self, force=False):
+        """前回から interval 秒以上経っていれば、状態ファイルとメトリクスを書き出す"""
+        if not (self.status_file or self.metrics_file):
+            return
+        now = time.time()
+        if not force and now - self.last_written_at < self.interval:
+            return
+        self.last_written_at = now
+        for path, content in ((self.status_file, lambda: json.dumps(self.snapshot(), ensure_ascii=False, indent=2)),
+                              (self.metrics_file, self.prometheus_text)):
+            if not path:
+                continue
+            try:
+                temp_path = path + ".part"
+                with open(temp_path, "w", encoding="utf-8") as f:
+                    f.write(content())
+                os.replace(temp_path, path)
+            except OSError as e:
+                logger.warning(f"進捗の書き出しに失敗しました: {path}: {str(e)}")
+
+    def close(self):
+        self.running = False
+        self.write(force=True)
+        logger.info(f"処理結果: {self.counts}、再試行 {self.retry_seconds:.0f} 秒、"
+                    f"保存 {self.saved_files} 件 {self.saved_bytes} バイト（1件あたり {self.bytes_per_receipt():.0f} バイト）")
+
+progress_tracker = None
+
 def move_to_next_page(driver):
     """次のページに移動する（「次へ」リンクのみを使用）"""
     try:
@@ -1342,9 +5586,9 @@ def move_to_next_page(driver):
                 time.sleep(3)
                 
                 # 領収書リンクの存在を確認
-                receipt_links = get_receipt_links(driver)
-                if receipt_links:
-                    logger.info(f"次のページに {len(receipt_links)} 件の領収書が見つかりました")
+                entries = get_receipt_entries(driver)
+                if entries:
+                    logger.info(f"次のページに {len(entries)} 件の領収書が見つかりました")
                     return True
                 else:
                     logger.error("次のページで領収書リンクが見つかりません")
@@ -1365,6 +5609,8 @@ def process_single_receipt(driver, index, total):
     """単一の領収書を処理する"""
     logger.info(f"領収書 {index}/{total} の処理を開始します")
     display_progress(index-1, total, "領収書ダウンロード")
+    # PDF保存で抽出した領収書番号と領収書データ（スクリーンショットでの代替保存に引き継ぐ）
+    extracted = {}
     
     # 毎回領収書リンクを再取得（stale element referenceを回避）
     try:
@@ -1397,17 +5643,14 @@ def process_single_receipt(driver, index, total):
             # 既に発行済みの場合はPDF保存処理へ、そうでなければ発行処理へ
             if print_button:
                 # PDFとして保存（印刷ボタンを使わない）
-                pdf_file_name = save_as_pdf(driver, index)
+                pdf_file_name = save_as_pdf(driver, index, extracted=extracted)
                 if pdf_file_name:
                     logger.info(f"領収書 {index} を保存しました: {pdf_file_name}")
                     display_progress(index, total, "領収書ダウンロード")
                     return True
                 else:
                     # PDF保存に失敗した場合はスクリーンショットを取る
-                    logger.info("PDFとして保存に失敗しました。スクリーンショットを取ります...")
-                    screenshot_path = os.path.join(download_dir, f"領収書_{index:02d}.png")
-                    driver.save_screenshot(screenshot_path)
-                    logger.info(f"領収書 {index} をスクリーンショットとして保存しました: {screenshot_path}")
+                    save_screenshot_fallback(driver, index, **extracted)
                     display_progress(index, total, "領収書ダウンロード")
                     return True
             else:
@@ -1457,16 +5700,13 @@ def process_single_receipt(driver, index, total):
                                 hide_header_elements(driver)
                                 
                                 # 発行後のページをPDFとして保存
-                                pdf_file_name = save_as_pdf(driver, index)
+                                pdf_file_name = save_as_pdf(driver, index, extracted=extracted)
                                 if pdf_file_name:
                                     logger.info(f"領収書 {index} を保存しました: {pdf_file_name}")
                                     return True
                                 else:
                                     # PDF保存に失敗した場合はスクリーンショットを取る
-                                    logger.info("PDFとして保存に失敗しました。スクリーンショットを取ります...")
-                                    screenshot_path = os.path.join(download_dir, f"領収書_{index:02d}.png")
-                                    driver.save_screenshot(screenshot_path)
-                                    logger.info(f"領収書 {index} をスクリーンショットとして保存しました: {screenshot_path}")
+                                    save_screenshot_fallback(driver, index, **extracted)
                                     return True
                         except Exception as e:
                             logger.error(f"確認ダイアログの「はい」ボタン処理中にエラー: {str(e)}")
@@ -1500,16 +5740,13 @@ def process_single_receipt(driver, index, total):
                         hide_header_elements(driver)
                         
                         # 発行後のページをPDFとして保存
-                        pdf_file_name = save_as_pdf(driver, index)
+                        pdf_file_name = save_as_pdf(driver, index, extracted=extracted)
                         if pdf_file_name:
                             logger.info(f"領収書 {index} を保存しました: {pdf_file_name}")
                             return True
                         else:
                             # PDF保存に失敗した場合はスクリーンショットを取る
-                            logger.info("PDFとして保存に失敗しました。スクリーンショットを取ります...")
-                            screenshot_path = os.path.join(download_dir, f"領収書_{index:02d}.png")
-                            driver.save_screenshot(screenshot_path)
-                            logger.info(f"領収書 {index} をスクリーンショットとして保存しました: {screenshot_path}")
+                            save_screenshot_fallback(driver, index, **extracted)
                             return True
                 except Exception as e:
                     logger.error(f"発行ボタンの処理中にエラー: {str(e)}")
@@ -1517,7 +5754,7 @@ def process_single_receipt(driver, index, total):
             # 手動操作を求める
             print("=== 自動処理に失敗しました ===")
             print("手動で領収書を発行・保存してください。")
-            input("操作が完了したら、Enterキーを押して続行してください...")
+            ask_user("操作が完了したら、Enterキーを押して続行してください...")
             return True
         else:
             logger.error(f"領収書リンク {index} が見つかりません（リンク数: {len(current_links)}）")
@@ -1531,10 +5768,10 @@ def handle_receipt_error(driver, error, index, page_num):
     error_msg = str(error) if str(error) else "不明なエラー（エラーメッセージなし）"
     logger.error(f"領収書 {index} の処理中にエラーが発生: {error_msg}")
     
-    # スクリーンショットを保存（タイムスタンプなし）
-    screenshot_path = os.path.join(download_dir, f"error_screenshot_page{page_num}_receipt{index}.png")
-    driver.save_screenshot(screenshot_path)
-    logger.info(f"エラー時のスクリーンショットを保存: {screenshot_path}")
+    # スクリーンショットを保存（タイムスタンプなし、アーカイブ出力時はアーカイブ内に格納）
+    screenshot_name = f"errors/error_screenshot_page{page_num}_receipt{index}.png"
+    get_output_backend().write(screenshot_name, driver.get_screenshot_as_png())
+    logger.info(f"エラー時のスクリーンショットを保存: {screenshot_name}")
     
     # 手動介入を求める
     print(f"=== 領収書 {index} の処理中にエラーが発生しました ===")
@@ -1542,7 +5779,7 @@ def handle_receipt_error(driver, error, index, page_num):
     print("1: 再試行する")
     print("2: この領収書をスキップして次に進む")
     print("3: 処理を中止する")
-    choice = input("選択してください (1/2/3): ")
+    choice = ask_user("選択してください (1/2/3): ")
     
     if choice == "1":
         # 現在の領収書を再処理
@@ -1558,47 +5795,68 @@ def handle_receipt_error(driver, error, index, page_num):
 
 def find_pdf_url(driver):
     """ページ内のPDF URLを探す"""
-    pdf_url = None
-    
-    try:
+    method, pdf_url = get_selector_registry().run('pdf_url', [
         # 埋め込みPDFを検索
-        pdf_embed = driver.find_element(By.CSS_SELECTOR, "embed[type='application/pdf'], object[type='application/pdf'], iframe[src$='.pdf']")
-        pdf_url = pdf_embed.get_attribute("src")
-        logger.info(f"埋め込みPDFを見つけました: {pdf_url}")
-        return pdf_url
-    except:
-        logger.info("埋め込みPDFは見つかりませんでした")
-    
-    try:
+        ('埋め込みPDF', lambda: driver.find_element(
+            By.CSS_SELECTOR, "embed[type='application/pdf'], object[type='application/pdf'], iframe[src$='.pdf']"
+        ).get_attribute("src")),
         # PDFへのリンクを検索
-        pdf_link = driver.find_element(By.CSS_SELECTOR, "a[href$='.pdf'], a[href*='pdf'], a[download]")
-        pdf_url = pdf_link.get_attribute("href")
-        logger.info(f"PDFへのリンクを見つけました: {pdf_url}")
-        return pdf_url
-    except:
-        logger.info("PDFへのリンクは見つかりませんでした")
-    
-    return None
+        ('PDFへのリンク', lambda: driver.find_element(
+            By.CSS_SELECTOR, "a[href$='.pdf'], a[href*='pdf'], a[download]"
+        ).get_attribute("href"))
+    ], reorder=False)
+    if pdf_url:
+        logger.info(f"{method}を見つけました: {pdf_url}")
+    else:
+        logger.info("PDFのURLは見つかりませんでした")
+    return pdf_url
 
-def setup_logging():
-    """ログ出力を設定する（ファイルのみに出力し、コンソールには出力しない）"""
-    global logger
+def setup_logging(log_file=DEFAULT_LOG_FILE, log_format="json", level="INFO",
+                  max_bytes=10 * 1024 * 1024, backup_count=5):
+    """ログ出力を設定する（ファイルのみに出力し、コンソールには出力しない）
+
+    処理中のスレッドはレコードをキューに入れるだけで、整形とファイルへの書き込みは別スレッドで行う。
+    """
+    global logger, log_listener
+    from logging.handlers import QueueListener, RotatingFileHandler
     
     # ロガーの設定
     logger = logging.getLogger(__name__)
-    logger.setLevel(logging.INFO)
+    logger.setLevel(getattr(logging, level))
+    if log_listener is not None:
+        # 前の設定の書き込みスレッドを止め、ファイルも閉じる
+        log_listener.stop()
+        for handler in log_listener.handlers:
+            handler.close()
     
-    # ファイルハンドラの設定
-    file_handler = logging.FileHandler("receipt_download_manual.log")
-    file_handler.setLevel(logging.INFO)
-    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    # ファイルハンドラの設定（サイズが上限を超えたら切り替え、古いものは backup_count 個まで残す）
+    file_handler = RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    if log_format == "json":
+        file_handler.setFormatter(JsonLogFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
     
-    # ロガーにハンドラを追加
-    logger.handlers = []  # 既存のハンドラをクリア
-    logger.addHandler(file_handler)
+    # ロガーにはキューへ入れるハンドラだけを付ける（既存のハンドラはクリア）
+    log_queue = queue.SimpleQueue()
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+    logger.handlers = [queue_handler]
+    log_listener = QueueListener(log_queue, file_handler)
+    log_listener.start()
     
     # コンソール出力を無効化
     logger.propagate = False
 
+def stop_logging():
+    """キューに残ったログを書き出して、書き込みスレッドを止める"""
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        for handler in log_listener.handlers:
+            handler.close()
+        log_listener = None
+
+atexit.register(stop_logging)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,61 @@
+import argparse
+import os
+import sys
+
+from pypdf import PdfReader
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import receipt_download_manual_login as receipts
+
+
+def one_page_pdf(text):
+    content = f"BT /F1 12 Tf 50 800 Td ({text}) Tj ET".encode("ascii")
+    return receipts.build_pdf([
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 4 0 R >> >> /Contents 5 0 R >>",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        f"<< /Length {len(content)} >>\nstream\n".encode("ascii") + content + b"\nendstream",
+    ])
+
+
+def save_monthly_only(monkeypatch, directory, numbers):
+    """--merge-monthly --no-individual-files と同じ設定で領収書を保存する"""
+    os.makedirs(directory)
+    merger = receipts.MonthlyPdfMerger(directory, False)
+    exporter = receipts.MetadataExporter(directory)
+    monkeypatch.setattr(receipts, "download_dir", directory)
+    monkeypatch.setattr(receipts, "manifest", receipts.load_manifest(directory))
+    monkeypatch.setattr(receipts, "output_backend", receipts.DirectoryOutput(directory))
+    monkeypatch.setattr(receipts, "write_individual_files", False)
+    monkeypatch.setattr(receipts, "receipt_sinks", [merger, exporter])
+    try:
+        for number in numbers:
+            record = receipts.ReceiptRecord(receipt_number=number, payment_date="2024-01-15")
+            receipts.store_receipt_output(one_page_pdf(f"Receipt {number}"), number,
+                                          f"{receipts.BASE_URL}/receipt_sheets/{number}", record=record)
+    finally:
+        exporter.close()
+
+
+def test_merge_appends_monthly_only_shards(monkeypatch, tmp_path):
+    save_monthly_only(monkeypatch, str(tmp_path / "shard-1-of-2"), ["R-0001", "R-0002"])
+    save_monthly_only(monkeypatch, str(tmp_path / "shard-2-of-2"), ["R-0003"])
+    output = str(tmp_path / "merged")
+
+    assert receipts.run_merge(argparse.Namespace(sources=[str(tmp_path)], output=output)) == 0
+
+    reader = PdfReader(os.path.join(output, "領収書_2024-01.pdf"))
+    text = "".join(page.extract_text() for page in reader.pages)
+    assert len(reader.pages) == 3
+    for number in ("R-0001", "R-0002", "R-0003"):
+        assert f"Receipt {number}" in text
+    entries = list(receipts.ReceiptManifest(os.path.join(output, receipts.MANIFEST_FILE_NAME)).entries.values())
+    assert len(entries) == 3
+    assert all(entry["merged_file"] == entry["file"] == "領収書_2024-01.pdf" for entry in entries)
+    assert len(receipts.read_metadata_rows(output)) == 3
+
+    # 再実行しても追記しない
+    receipts.run_merge(argparse.Namespace(sources=[str(tmp_path)], output=output))
+    assert len(PdfReader(os.path.join(output, "領収書_2024-01.pdf")).pages) == 3
@@ -0,0 +1,37 @@
+import os
+import sys
+
+from pypdf import PdfReader
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import receipt_download_manual_login as receipts
+
+
+def one_page_pdf(text):
+    """ページツリーが2番以外（5番）にある1ページのPDF"""
+    content = f"BT /F1 12 Tf 50 800 Td ({text}) Tj ET".encode("ascii")
+    return receipts.build_pdf([
+        b"<< /Type /Catalog /Pages 5 0 R >>",
+        f"<< /Length {len(content)} >>\nstream\n".encode("ascii") + content + b"\nendstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        b"<< /Type /Page /Parent 5 0 R /MediaBox [0 0 595 842] /Contents 2 0 R >>",
+        b"<< /Type /Pages /Kids [4 0 R] /Count 1 /Resources << /Font << /F1 3 0 R >> >> >>",
+    ])
+
+
+def test_appended_pages_point_to_merged_page_tree(tmp_path):
+    path = str(tmp_path / "merged.pdf")
+    appender = receipts.IncrementalPdfAppender(path)
+    appender.append(one_page_pdf("First"))
+    receipts.IncrementalPdfAppender(path).append(one_page_pdf("Second"))
+
+    reader = PdfReader(path)
+    pages_ref = reader.trailer["/Root"].raw_get("/Pages")
+    assert len(reader.pages) == 2
+    for page, text in zip(reader.pages, ("First", "Second")):
+        parent = page.raw_get("/Parent")
+        assert parent.idnum == pages_ref.idnum
+        assert parent.get_object()["/Type"] == "/Pages"
+        # 元のページツリーから継承したリソースも引き継ぐ
+        assert text in page.extract_text()